@@ -1,9 +1,82 @@
-import random
-from ete3 import Tree
+from multiprocessing import Pool
+import os, re, sys, csv, argparse
+from newick_io import iter_newick, get_tree_files
 
-t = Tree("RAxML_bipartitions_root.newick")
+#不加参数时与原来相同：用ete3读取RAxML_bipartitions_root.newick，按层序遍历在result.csv后追加"叶节点,枝长"
+default_tree = "RAxML_bipartitions_root.newick"
+default_output = "result.csv"
 
-with open("result.csv", "a") as write_file:
-    for each_node in t.traverse():
-        if each_node.is_leaf():
-            write_file.write(each_node.name.replace("'","") + "," + str(each_node.dist) + "\n")
+#叶节点：紧跟在"("或","之后的名称，以及可选的":枝长"
+leaf_token = re.compile(r"[(,]\s*('(?:[^']|'')*'|[^\s(),:;']+)\s*(?::\s*([^\s(),:;]+))?")
+comment_token = re.compile(r"\[[^\]]*\]")
+
+
+#不构建树，直接从Newick字符串中取出叶节点的名称和枝长，没有枝长时与ete3相同为1.0
+def get_leaf_lengths(newick):
+    leaf_list = []
+    for name, length in leaf_token.findall(comment_token.sub("", newick)):
+        leaf_list.append((name.replace("'", ""), float(length) if length else 1.0))
+    return leaf_list
+
+
+#原来的做法：用ete3读取一棵树，按层序遍历的顺序追加叶节点的名称和枝长
+def extract_default(tree_file, output):
+    from ete3 import Tree
+    t = Tree(tree_file)
+    with open(output, "a") as write_file:
+        for each_node in t.traverse():
+            if each_node.is_leaf():
+                write_file.write(each_node.name.replace("'","") + "," + str(each_node.dist) + "\n")
+
+
+#一个文件中所有树的叶节点枝长，列表中每一项为(树的序号, [(叶节点, 枝长), ...])
+def extract_file(tree_file):
+    return tree_file, [(i, get_leaf_lengths(each_tree)) for i, each_tree in enumerate(iter_newick(tree_file))]
+
+
+#long: 每行一个叶节点；wide: 每行一棵树，每列一个叶节点，树中没有的叶节点为空。
+#用csv写出，含有逗号或引号的名称会加上引号
+def write_table(write_file, results, table_format):
+    writer = csv.writer(write_file, lineterminator="\n")
+    if table_format == "long":
+        writer.writerow(["File", "Tree", "Leaf", "Length"])
+        for tree_file, tree_list in results:
+            for i, leaf_list in tree_list:
+                writer.writerows([tree_file, i, name, length] for name, length in leaf_list)
+    else:
+        leaf_names = sorted({name for tree_file, tree_list in results for i, leaf_list in tree_list for name, length in leaf_list})
+        writer.writerow(["File", "Tree"] + leaf_names)
+        for tree_file, tree_list in results:
+            for i, leaf_list in tree_list:
+                leaf_dict = dict(leaf_list)
+                writer.writerow([tree_file, i] + [leaf_dict.get(name, "") for name in leaf_names])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract the branch lengths of the leaves from Newick trees")
+    parser.add_argument('-i', '--input', action="store", metavar='\b', type=str, nargs="+", help="Tree files (may contain many trees, - for stdin) or directories, default = " + default_tree)
+    parser.add_argument('-o', '--output', action="store", metavar='\b', type=str, default=default_output, help="Output table, default = " + default_output)
+    parser.add_argument('-f', '--format', action="store", metavar='\b', type=str, choices=["long", "wide"], default="long", help="long: one leaf per line, wide: one tree per line, default = long")
+    parser.add_argument('-j', '--jobs', action="store", metavar='\b', type=int, default=os.cpu_count(), help="Number of processes, default = number of cores")
+    args = parser.parse_args()
+
+    if not args.input:
+        extract_default(default_tree, args.output)
+        return
+
+    tree_files = get_tree_files(args.input, tree_prefixes=("RAxML_",))
+    if not tree_files:
+        print("没有找到树文件")
+        sys.exit(1)
+    if args.jobs > 1 and len(tree_files) > 1 and "-" not in tree_files:
+        with Pool(min(args.jobs, len(tree_files))) as p:
+            results = p.map(extract_file, tree_files, chunksize=max(1, len(tree_files) // (args.jobs * 4)))
+    else:
+        results = [extract_file(each) for each in tree_files]
+    with open(args.output, "w", newline="") as write_file:
+        write_table(write_file, results, args.format)
+    print("共 " + str(sum(len(tree_list) for tree_file, tree_list in results)) + " 棵树，结果写入" + args.output)
+
+
+if __name__ == "__main__":
+    main()
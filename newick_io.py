@@ -0,0 +1,61 @@
+#treepl.py和extract.py共用的Newick树文件读取
+import os, re, sys
+
+
+'''
+函数 iter_newick: 逐个读取文件中的Newick树，每次只在内存中保留一棵树。带引号的名称和[]中的注释里的
+";"不作为树的结尾，与treepl.py中newick_token的规则相同
+输入 tree_file: 树文件的名称，可以含有多棵树，"-"为标准输入
+输出 每棵树的Newick字符串
+'''
+newick_special = re.compile(r"['\[\];]")
+newick_comment = re.compile(r"\[[^\]]*\]")
+
+def iter_newick(tree_file):
+    rest = ""
+    quoted = commented = False
+    read_file = sys.stdin if tree_file == "-" else open(tree_file, "r")
+    try:
+        for each_block in iter(lambda: read_file.read(1 << 20), ""):
+            scan_start = len(rest)
+            rest = rest + each_block
+            tree_start = 0
+            #引号中的"''"为转义的引号，相当于先结束再开始引号
+            for match in newick_special.finditer(rest, scan_start):
+                char = match.group()
+                if commented:
+                    commented = char != "]"
+                elif quoted:
+                    quoted = char != "'"
+                elif char == "'":
+                    quoted = True
+                elif char == "[":
+                    commented = True
+                elif char == ";":
+                    each_tree = rest[tree_start:match.start()].strip()
+                    if newick_comment.sub("", each_tree).strip():
+                        yield each_tree + ";"
+                    tree_start = match.end()
+            rest = rest[tree_start:]
+    finally:
+        if read_file is not sys.stdin:
+            read_file.close()
+    if newick_comment.sub("", rest).strip():
+        yield rest.strip() + ";"
+
+
+'''
+函数 get_tree_files: 获取树文件，文件夹中取扩展名为树文件的文件
+输入 path_list: 文件或文件夹的列表；tree_prefixes: 文件夹中以这些前缀开头的文件也作为树文件(如"RAxML_")
+输出 树文件的列表
+'''
+def get_tree_files(path_list, tree_prefixes=()):
+    tree_files = []
+    for each_path in path_list:
+        if os.path.isdir(each_path):
+            for each in sorted(os.listdir(each_path)):
+                if each.endswith((".tre", ".tree", ".trees", ".nwk", ".newick")) or each.startswith(tuple(tree_prefixes)):
+                    tree_files.append(os.path.join(each_path, each))
+        else:
+            tree_files.append(each_path)
+    return tree_files
@@ -6,33 +6,428 @@ fasta序列可以是任何名称
 import argparse
 import sys
 import os
+import mmap
+import json
+import hashlib
+import math
+import contextlib
+import warnings
+import itertools
+from multiprocessing import Pool
+import numpy as np
 
 
-#fasta序列转化为phy文件，并且返回fasta的物种数目以及位点数目
-def fasta2phy(fasta_file):
-    with open(fasta_file, "r") as read_file:
-        species_num = 0
-        species_len = 0
-        for each_line in read_file:
-            if len(each_line) > 2:
-                if each_line[0] == ">":
-                    species_num = species_num + 1
-                else:
-                    species_len = len(each_line.replace("\n", ""))
-    with open(fasta_file.replace(".fasta", "") + ".phy", "a") as write_file:
-        with open(fasta_file, "r") as read_file:
-            write_file.write(" " + str(species_num) + " " + str(species_len) + "\n")
-            for each_line in read_file:
-                if len(each_line) > 2:
-                    if each_line[0] == ">":
-                        write_file.write(each_line.replace("\n","").replace(">","") + " ")
+#比对矩阵中碱基的编码：A、C、G、T(U)为0-3，其他字符(N、-、?以及简并碱基)都编码
+#为4，视为缺失
+base_code = np.full(256, 4, dtype=np.uint8)
+for n, each_base in enumerate("ACGT"):
+    base_code[ord(each_base)] = n
+    base_code[ord(each_base.lower())] = n
+base_code[ord("U")] = base_code[ord("u")] = 3
+
+#用内存映射扫描一遍fasta文件，返回每条序列的名称、序列各行在文件中的位置
+#(起点, 终点)以及序列长度。序列可以分成多行，空行会被忽略
+def index_fasta(fasta_mmap):
+    records = []
+    pos = 0
+    size = len(fasta_mmap)
+    while pos < size:
+        line_end = fasta_mmap.find(b"\n", pos)
+        if line_end == -1:
+            line_end = size
+        start, end = pos, line_end
+        pos = line_end + 1
+        #去掉行尾的\r和空白
+        while end > start and fasta_mmap[end - 1] in b"\r \t":
+            end = end - 1
+        if end == start:
+            continue
+        if fasta_mmap[start] == ord(">"):
+            name = fasta_mmap[start + 1:end].decode()
+            records.append([name, [], 0])
+        elif records:
+            records[-1][1].append((start, end))
+            records[-1][2] = records[-1][2] + end - start
+        else:
+            raise ValueError("Sequence found before the first fasta header")
+    return records
+
+#检查fasta中所有序列的长度是否相同，返回序列长度
+def check_fasta_records(records, fasta_file):
+    if not records:
+        raise ValueError("No sequence found in " + fasta_file)
+    species_len = records[0][2]
+    for name, spans, length in records:
+        if length != species_len:
+            raise ValueError("Length of " + name + " (" + str(length) + ") differs from " + records[0][0] + " (" + str(species_len) + ") in " + fasta_file)
+    return species_len
+
+#把一段序列写入phy文件。可以时用os.sendfile在内核中直接复制，否则从内存映射中
+#切片写入
+def copy_span(write_file, fasta_mmap, read_fd, start, end):
+    if hasattr(os, "sendfile"):
+        write_file.flush()
+        try:
+            while start < end:
+                sent = os.sendfile(write_file.fileno(), read_fd, start, 
+                                   end - start)
+                if sent == 0:
+                    break
+                start = start + sent
+        except OSError: #有些系统只支持向socket发送
+            pass
+    write_file.write(fasta_mmap[start:end])
+
+#fasta序列转化为phy文件，并且返回fasta的物种数目以及位点数目。
+#只读取一遍fasta文件，所有序列的长度必须相同，phy文件每次运行都会被覆盖
+def fasta2phy(fasta_file, phy_file=None):
+    if phy_file is None:
+        phy_file = fasta_file.replace(".fasta", "") + ".phy"
+    with open(fasta_file, "rb") as read_file:
+        if os.fstat(read_file.fileno()).st_size == 0:
+            raise ValueError(fasta_file + " is empty")
+        with mmap.mmap(read_file.fileno(), 0, access=mmap.ACCESS_READ) as fasta_mmap:
+            records = index_fasta(fasta_mmap)
+            species_len = check_fasta_records(records, fasta_file)
+            species_num = len(records)
+            with open(phy_file, "wb", buffering=1 << 20) as write_file:
+                write_file.write((" " + str(species_num) + " " + str(species_len) + "\n").encode())
+                for name, spans, length in records:
+                    write_file.write((name + " ").encode())
+                    if len(spans) == 1:
+                        copy_span(write_file, fasta_mmap, read_file.fileno(), *spans[0])
                     else:
-                        write_file.write(each_line.replace("\n","") + "\n")
+                        for start, end in spans:
+                            write_file.write(fasta_mmap[start:end])
+                    write_file.write(b"\n")
     return str(species_num), str(species_len)
        
-#写出map.txt文件
-def make_mapfile(fasta_file, outgroup):
-    with open("map.txt", "a") as write_file:
+#把fasta比对读入为一个uint8矩阵(物种 x 位点)，碱基按base_code编码，返回物种
+#名称和矩阵
+def encode_alignment(fasta_file):
+    with open(fasta_file, "rb") as read_file:
+        if os.fstat(read_file.fileno()).st_size == 0:
+            raise ValueError(fasta_file + " is empty")
+        with mmap.mmap(read_file.fileno(), 0, access=mmap.ACCESS_READ) as fasta_mmap:
+            records = index_fasta(fasta_mmap)
+            species_len = check_fasta_records(records, fasta_file)
+            alignment = np.empty((len(records), species_len), dtype=np.uint8)
+            for k, (name, spans, length) in enumerate(records):
+                pos = 0
+                for start, end in spans:
+                    alignment[k, pos:pos + end - start] = base_code[np.frombuffer(fasta_mmap, dtype=np.uint8, count=end - start, offset=start)]
+                    pos = pos + end - start
+    return [each_record[0] for each_record in records], alignment
+
+#hyde的统计量只与每种位点模式出现的次数有关。把比对中相同的位点(列)合并为一种
+#模式并记录出现的次数，返回模式矩阵(物种 x 模式)和每种模式的次数。
+#少于4个物种有确定碱基的位点不能用于任何四物种的检验，直接丢弃；其他位点中的
+#缺失碱基保留为4，与--ignore_amb_sites一样在每个四物种的检验中分别忽略。
+#位点分块合并，内存只与块的大小和模式数有关
+def compress_site_patterns(alignment, chunk_size=1 << 20):
+    species_num, species_len = alignment.shape
+    pattern_dtype = np.dtype((np.void, species_num))
+    pattern_chunks = []
+    weight_chunks = []
+    for start in range(0, species_len, chunk_size):
+        columns = np.ascontiguousarray(alignment[:, start:start + chunk_size].T)
+        columns = columns[(columns != 4).sum(axis=1) >= 4]
+        patterns, weights = np.unique(columns.view(pattern_dtype).ravel(), return_counts=True)
+        pattern_chunks.append(patterns)
+        weight_chunks.append(weights)
+    patterns, inverse = np.unique(np.concatenate(pattern_chunks), return_inverse=True)
+    weights = np.zeros(len(patterns), dtype=np.int64)
+    np.add.at(weights, inverse.ravel(), np.concatenate(weight_chunks))
+    patterns = np.frombuffer(patterns.tobytes(), dtype=np.uint8).reshape(-1, species_num).T
+    return np.ascontiguousarray(patterns), weights
+
+#写出位点模式：<prefix>.patterns.npy(模式矩阵)、<prefix>.patterns.weights.npy
+#(次数)和<prefix>.patterns.taxa.json(物种名称)，可以内存映射读取，原生引擎
+#(-e native)使用；同时写出phylip比对<prefix>.patterns.phy，每种模式按次数重复，
+#即按模式排列的、去掉了无用位点的原比对，可以作为hyde.py或其他软件的输入，
+#hyde.py使用--ignore_amb_sites时结果与原比对相同。每次只展开一个物种的序列
+def write_site_patterns(prefix, taxa, patterns, weights):
+    np.save(prefix + ".patterns.npy", patterns)
+    np.save(prefix + ".patterns.weights.npy", weights)
+    with open(prefix + ".patterns.taxa.json", "w") as write_file:
+        json.dump(taxa, write_file, indent=1)
+    base_letter = np.frombuffer(b"ACGTN", dtype=np.uint8)
+    with open(prefix + ".patterns.phy", "wb", buffering=1 << 20) as write_file:
+        write_file.write((" " + str(len(taxa)) + " " + str(int(weights.sum())) + "\n").encode())
+        for name, each_row in zip(taxa, patterns):
+            write_file.write((name + " ").encode() + np.repeat(base_letter[each_row], weights).tobytes() + b"\n")
+
+#读取fasta比对并压缩为位点模式，返回物种名称、模式矩阵和每种模式的次数
+def load_site_patterns(fasta_file):
+    taxa, alignment = encode_alignment(fasta_file)
+    patterns, weights = compress_site_patterns(alignment)
+    print(fasta_file + ": " + str(alignment.shape[1]) + " sites compressed into " + str(patterns.shape[1]) + " site patterns (" + str(weights.sum()) + " sites used)")
+    return taxa, patterns, weights
+
+def read_site_patterns(prefix):
+    with open(prefix + ".patterns.taxa.json", "r") as read_file:
+        taxa = json.load(read_file)
+    return taxa, np.load(prefix + ".patterns.npy", mmap_mode="r"), np.load(prefix + ".patterns.weights.npy")
+
+#原生的hyde引擎(每个分类单元只有一个个体时使用)，结果与hyde.py使用
+#--ignore_amb_sites时相同。
+#每种碱基以及"不缺失"在每个物种中各保存为一个按位压缩的位点掩码，一个uint64
+#保存64种位点模式。对每个(Out, P1, Hybrid, P2)用位运算得到四个物种两两之间碱基
+#相同和不同的位点，组合为hyde的15类位点(hyde_patterns，字母相同表示碱基相同，
+#例如ABBA为Out = P2且P1 = Hybrid)，再用popcount按位点模式的次数加权计数。
+#四个物种中有缺失碱基的位点不计入
+engine_data = {}
+
+#numpy 2.0之前没有np.bitwise_count，用查表计算每个字节中1的个数
+popcount_table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+#最后一维所有uint64中1的个数之和
+def popcount_sum(words):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return popcount_table[np.ascontiguousarray(words).view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+#把布尔型的位点掩码按位压缩为uint64，最后一维的长度为word_num
+def pack_site_mask(site_mask, word_num):
+    packed = np.packbits(site_mask, axis=-1, bitorder="little")
+    padded = np.zeros(site_mask.shape[:-1] + (word_num * 8,), dtype=np.uint8)
+    padded[..., :packed.shape[-1]] = packed
+    return padded.view(np.uint64)
+
+#位点模式的掩码：masks[0:4]为每个物种中是A、C、G、T的模式，masks[4]为不缺失的模式
+def make_site_masks(patterns):
+    word_num = (patterns.shape[1] + 63) // 64
+    masks = np.empty((5, patterns.shape[0], word_num), dtype=np.uint64)
+    for each_base in range(4):
+        masks[each_base] = pack_site_mask(patterns == each_base, word_num)
+    masks[4] = pack_site_mask(patterns != 4, word_num)
+    return masks
+
+#按二进制位拆分每种模式的次数：weight_planes[k]为次数的第k位为1的模式，
+#加权计数即为sum(2^k * popcount(mask & weight_planes[k]))
+def make_weight_planes(weights, word_num):
+    weights = np.asarray(weights, dtype=np.int64)
+    plane_num = max(int(weights.max(initial=0)).bit_length(), 1)
+    return np.stack([pack_site_mask(((weights >> k) & 1).astype(bool), word_num) for k in range(plane_num)])
+
+#第start到stop个(P1, Hybrid, P2)的物种编号，每行一个检验
+def triple_array(ingroup, start, stop):
+    return np.fromiter(itertools.chain.from_iterable(make_triples(ingroup, start, stop)), dtype=np.int64).reshape(-1, 3)
+
+#各个进程只保存内类群的编号，每批检验的编号由make_triples按范围生成
+def init_engine(mask_file, ingroup, outgroup_code, weights=None):
+    engine_data["masks"] = np.load(mask_file, mmap_mode="r") if isinstance(mask_file, str) else mask_file
+    engine_data["ingroup"] = ingroup
+    engine_data["outgroup"] = outgroup_code
+    engine_data["weights"] = weights
+
+#计算第start到end个(P1, Hybrid, P2)的15类位点数，列的顺序与hyde_patterns相同。
+#每次处理一批，内存只与每批的大小有关
+def count_triple_patterns(task):
+    start, end, weight_planes = task
+    masks = engine_data["masks"]
+    out = engine_data["outgroup"]
+    batch_size = max(1, (1 << 17) // masks.shape[2])
+    counts = np.zeros((end - start, len(hyde_patterns)), dtype=np.int64)
+
+    def equal(a, b):
+        same = masks[0][a] & masks[0][b]
+        for each_base in range(1, 4):
+            same |= masks[each_base][a] & masks[each_base][b]
+        return same
+
+    def weighted_count(site_mask):
+        total = 0
+        for k, each_plane in enumerate(weight_planes):
+            total = total + (popcount_sum(site_mask & each_plane) << k)
+        return total
+
+    for batch_start in range(start, end, batch_size):
+        p1, hybrid, p2 = triple_array(engine_data["ingroup"], batch_start, min(batch_start + batch_size, end)).T
+        sites = masks[4][p1] & masks[4][hybrid] & masks[4][p2] & masks[4][out]
+        #e为碱基相同的位点，d为四个物种都不缺失且碱基不同的位点，数字0-3依次为
+        #Out、P1、Hybrid、P2
+        e01, e02, e03 = equal(out, p1), equal(out, hybrid), equal(out, p2)
+        e12, e13, e23 = equal(p1, hybrid), equal(p1, p2), equal(hybrid, p2)
+        d01, d02, d03, d12, d13, d23 = [sites & ~each for each in (e01, e02, e03, e12, e13, e23)]
+        e01, e02, e03, e12, e13, e23 = [sites & each for each in (e01, e02, e03, e12, e13, e23)]
+        pattern_masks = (
+            lambda: e01 & e02 & e03,              #AAAA
+            lambda: e01 & e02 & d03,              #AAAB
+            lambda: e01 & e03 & d02,              #AABA
+            lambda: e01 & e23 & d02,              #AABB
+            lambda: e01 & d02 & d03 & d23,        #AABC
+            lambda: e02 & e03 & d01,              #ABAA
+            lambda: e02 & e13 & d01,              #ABAB
+            lambda: e02 & d01 & d03 & d13,        #ABAC
+            lambda: e03 & e12 & d01,              #ABBA
+            lambda: e12 & e13 & d01,              #BAAA
+            lambda: e12 & d01 & d03 & d13,        #ABBC
+            lambda: e03 & d01 & d02 & d12,        #CABC
+            lambda: e13 & d01 & d02 & d12,        #BACA
+            lambda: e23 & d01 & d02 & d12,        #BCAA
+            lambda: d01 & d02 & d03 & d12 & d13 & d23) #ABCD
+        rows = slice(batch_start - start, batch_start - start + len(p1))
+        for j, each_mask in enumerate(pattern_masks):
+            counts[rows, j] = weighted_count(each_mask())
+    return counts
+
+#hyde.py中的正态分布p值(Abramowitz & Stegun 7.1.26对erf的近似)，使结果与hyde.py
+#完全相同
+def hyde_pvalue(zscore):
+    a1, a2, a3, a4, a5, p = 0.254829592, -0.284496736, 1.421413741, -1.453152027, 1.061405429, 0.3275911
+    sign = -1 if zscore < 0 else 1
+    z = math.fabs(zscore) / math.sqrt(2.0)
+    t = 1.0 / (1.0 + p * z)
+    y = 1.0 - (((((a5 * t + a4) * t) + a3) * t + a2) * t + a1) * t * math.exp(-z * z)
+    return 1.0 - (0.5 * (1.0 + sign * y))
+
+#由15类位点数计算Z值、P值和γ，公式和运算顺序与hyde.py(phyde的_calc_gh)相同。
+#p9、p7、p4为ABBA、ABAB、AABB的比例，Z值为两个不变量ABBA - ABAB和AABB - ABAB的
+#比值的检验统计量，无法计算时为-99999.9；γ = c/(1 + c)，c = (ABBA - ABAB)/(AABB - ABAB)
+def hyde_statistics(counts):
+    counts = np.asarray(counts, dtype=float)
+    aabb, abab, abba = counts[:, 3], counts[:, 6], counts[:, 8]
+    nobs = counts.sum(axis=1)
+    #每个分类单元只有一个个体，平均位点数与位点数相同
+    avobs = nobs
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p9 = (abba + 0.05) / nobs
+        p7 = (abab + 0.05) / nobs
+        p4 = (aabb + 0.05) / nobs
+        obs_invp1 = avobs * (p9 - p7)
+        obs_invp2 = avobs * (p4 - p7)
+        no_signal = obs_invp1 == 0
+        obs_invp1 = np.where(no_signal, obs_invp1 + 1.0, obs_invp1)
+        obs_invp2 = np.where(no_signal, obs_invp2 + 1.0, obs_invp2)
+        obs_var_invp1 = avobs * p9 * (1 - p9) + avobs * p7 * (1 - p7) + 2 * avobs * p9 * p7
+        obs_var_invp2 = avobs * p4 * (1 - p4) + avobs * p7 * (1 - p7) + 2 * avobs * p4 * p7
+        obs_cov_invp1_invp2 = -1 * avobs * p9 * p4 + avobs * p9 * p7 + avobs * p7 * p4 + avobs * p7 * (1 - p7)
+        ratio = obs_invp2 / obs_invp1
+        gh = (obs_invp1) * (ratio) / np.sqrt(obs_var_invp1 * (ratio * ratio) - 2.0 * obs_cov_invp1_invp2 * ratio + obs_var_invp2)
+        c = (avobs * (abba - abab)) / (avobs * (aabb - abab))
+        gamma = c / (1 + c)
+    valid = (nobs > 0) & ~((p7 > p9) & (p7 < p4)) & (gh > -99999.9) & (gh < 99999.9)
+    zscore = np.where(valid, gh, -99999.9)
+    pvalue = np.array([hyde_pvalue(each) for each in zscore.tolist()])
+    return zscore, pvalue, gamma
+
+#把(start, end)范围的检验分成大约jobs*4个任务
+def split_tasks(triple_num, jobs, weight_planes):
+    task_size = max(1, -(-triple_num // (jobs * 4)))
+    return [(start, min(start + task_size, triple_num), weight_planes) for start in range(0, triple_num, task_size)]
+
+#对所有的(P1, Hybrid, P2)运行原生引擎，按顺序依次返回每个任务的结果，
+#task_function默认为计数。jobs大于1时位点掩码先写入一个临时的.npy文件，各个进程
+#内存映射读取
+def run_engine_tasks(masks, ingroup, outgroup_code, task_groups, jobs, prefix, weights=None, task_function=count_triple_patterns):
+    if jobs <= 1:
+        init_engine(masks, ingroup, outgroup_code, weights)
+        for each_tasks in task_groups:
+            for each_task in each_tasks:
+                yield task_function(each_task)
+        return
+    mask_file = prefix + ".hyde_masks_" + str(os.getpid()) + ".npy"
+    np.save(mask_file, masks)
+    try:
+        with Pool(jobs, initializer=init_engine, initargs=(mask_file, ingroup, outgroup_code, weights)) as p:
+            for each_tasks in task_groups:
+                for each_result in p.imap(task_function, each_tasks):
+                    yield each_result
+    finally:
+        os.remove(mask_file)
+
+#写出与hyde.py相同格式的结果表格。count_chunks为按顺序排列的各个任务的计数，
+#每个任务算完就写出，不需要同时保存所有检验的结果。"-out-filtered.txt"与hyde.py
+#相同，用所有检验的总数做Bonferroni校正。每行的物种名称由make_triples依次生成
+def write_native_hyde_output(prefix, taxa, ingroup, count_chunks):
+    triples = make_triples([taxa[k] for k in ingroup])
+    with open(prefix + "-out.txt", "w") as write_file:
+        write_file.write(hyde_header)
+        for each_counts in count_chunks:
+            zscore, pvalue, gamma = hyde_statistics(each_counts)
+            for k, (each_row, each_triple) in enumerate(zip(each_counts.tolist(), triples)):
+                result = dict(zip(hyde_patterns, [float(each) for each in each_row]), Zscore=float(zscore[k]), Pvalue=float(pvalue[k]), Gamma=float(gamma[k]))
+                write_hyde_row(write_file, each_triple, result)
+    write_filtered_hyde_output(prefix + "-out.txt", prefix + "-out-filtered.txt", max(count_triples(len(ingroup)), 1))
+
+#bootstrap的一个重复：对所有用到的位点有放回地抽取同样多的位点。位点只通过所属
+#的模式影响结果，按每种模式的比例做多项分布抽样与逐个抽取位点编号再按模式计数
+#的分布相同，直接得到该重复中每种模式的次数，不需要生成重抽样后的比对
+def resample_weights(weights, rng):
+    weights = np.asarray(weights, dtype=np.int64)
+    return rng.multinomial(weights.sum(), weights/weights.sum())
+
+#bootstrap时每次处理的检验数与重复数的乘积，每次只保存这么多个γ和Z值
+bootstrap_chunk_values = 1 << 21
+
+#bootstrap的一个任务：第start到end个检验在一个重复中的γ和Z值。每个重复的次数由
+#它自己的SeedSequence产生，与进程数以及检验如何分块无关；seed_sequence为None时
+#使用原始的次数。重复中无法计算的Z值(-99999.9)和γ记为NaN
+def bootstrap_task(task):
+    seed_sequence, start, end = task
+    weights = engine_data["weights"]
+    if seed_sequence is not None:
+        weights = resample_weights(weights, np.random.default_rng(seed_sequence))
+    weight_planes = make_weight_planes(weights, engine_data["masks"].shape[2])
+    zscore, pvalue, gamma = hyde_statistics(count_triple_patterns((start, end, weight_planes)))
+    if seed_sequence is not None:
+        zscore[np.abs(zscore) == 99999.9] = np.nan
+        gamma[~np.isfinite(gamma)] = np.nan
+    return gamma, zscore
+
+#写出一块检验的bootstrap结果：原始的γ和Z值，以及所有重复中的平均值和95%置信区间。
+#triples为这块检验的物种名称
+def write_bootstrap_rows(write_file, triples, gamma, zscore, gamma_replicates, zscore_replicates):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) #所有重复都无法计算的检验为NaN
+        summary = []
+        for value_replicates in (gamma_replicates, zscore_replicates):
+            summary.append((np.nanmean(value_replicates, axis=0), np.nanpercentile(value_replicates, 2.5, axis=0), np.nanpercentile(value_replicates, 97.5, axis=0)))
+    for k, each_triple in enumerate(triples):
+        write_file.write("\t".join(list(each_triple) + [str(gamma[k])] + [str(each[k]) for each in summary[0]] + [str(zscore[k])] + [str(each[k]) for each in summary[1]] + [str(len(gamma_replicates))]) + "\n")
+
+#对bootstrap的每个重复运行原生引擎，结果写入"<prefix>-bootstrap.txt"。检验按
+#bootstrap_chunk_values分块，每块中原始数据和所有重复的任务一起在进程池中运行，
+#算完一块就写出，内存只与块的大小有关。所有重复共用同一份位点掩码，只有模式的
+#次数不同。每个重复的随机数由SeedSequence(seed).spawn分出，seed相同时结果相同
+def run_native_bootstrap(taxa, ingroup, masks, weights, outgroup_code, prefix, jobs, bootstrap, seed):
+    seed_sequences = np.random.SeedSequence(seed).spawn(bootstrap)
+    ingroup_names = [taxa[k] for k in ingroup]
+    triple_num = count_triples(len(ingroup))
+    chunk_size = max(1, bootstrap_chunk_values // bootstrap)
+    chunks = [(start, min(start + chunk_size, triple_num)) for start in range(0, triple_num, chunk_size)]
+    task_groups = ([(each_seed, start, end) for each_seed in [None] + seed_sequences] for start, end in chunks)
+    results = run_engine_tasks(masks, ingroup, outgroup_code, task_groups, jobs, prefix, weights, bootstrap_task)
+    with open(prefix + "-bootstrap.txt", "w") as write_file, contextlib.closing(results):
+        write_file.write("P1\tHybrid\tP2\tGamma\tGamma_mean\tGamma_2.5\tGamma_97.5\tZscore\tZscore_mean\tZscore_2.5\tZscore_97.5\tReplicates\n")
+        for chunk_num, (start, end) in enumerate(chunks, 1):
+            gamma, zscore = next(results)
+            replicates = [next(results) for each_seed in seed_sequences]
+            gamma_replicates = np.stack([each[0] for each in replicates])
+            zscore_replicates = np.stack([each[1] for each in replicates])
+            write_bootstrap_rows(write_file, make_triples(ingroup_names, start, end), gamma, zscore, gamma_replicates, zscore_replicates)
+            print("Bootstrap: " + str(end) + "/" + str(triple_num) + " triples finished (" + str(bootstrap) + " replicates)")
+
+#用原生引擎对一个比对运行hyde，结果写入"<prefix>-out.txt"。bootstrap大于0时
+#再运行bootstrap个重复，结果写入"<prefix>-bootstrap.txt"。所有检验的物种编号不
+#会同时保存，各个进程按任务的范围自己生成
+def run_native_hyde(taxa, patterns, weights, outgroup, prefix, jobs, bootstrap=0, seed=None):
+    if outgroup not in taxa:
+        raise ValueError("Outgroup " + outgroup + " not found in the alignment")
+    outgroup_code = taxa.index(outgroup)
+    ingroup = [k for k in range(len(taxa)) if k != outgroup_code]
+    triple_num = count_triples(len(ingroup))
+    masks = make_site_masks(patterns)
+    weight_planes = make_weight_planes(weights, masks.shape[2])
+    print("Testing " + str(triple_num) + " triples on " + str(patterns.shape[1]) + " site patterns with " + str(jobs) + " processes")
+    write_native_hyde_output(prefix, taxa, ingroup, run_engine_tasks(masks, ingroup, outgroup_code, [split_tasks(triple_num, jobs, weight_planes)], jobs, prefix))
+    if bootstrap > 0 and triple_num:
+        run_native_bootstrap(taxa, ingroup, masks, weights, outgroup_code, prefix, jobs, bootstrap, seed)
+
+#写出map.txt文件，每次运行都会覆盖之前的文件
+def make_mapfile(fasta_file, outgroup, mapfile="map.txt"):
+    with open(mapfile, "w") as write_file:
         with open(fasta_file, "r") as read_file:
             for each_line in read_file:
                 if len(each_line) > 2:
@@ -42,38 +437,312 @@ def make_mapfile(fasta_file, outgroup):
                         else:
                             write_file.write(each_line.replace(">", "").replace("\n", "") + " " + each_line.replace(">", "").replace("\n", "") + "\n")
 
-'''
-if __name__ == "__main__":
-    """
-    Runs the script.
-    """
-    fasta_file_list = get_file_list()
+
+#从map.txt中读取所有的分类单元，外群除外，顺序与map.txt一致
+def get_taxa_from_mapfile(mapfile, outgroup):
+    taxa = []
+    with open(mapfile, "r") as read_file:
+        for each_line in read_file:
+            line_list = each_line.split()
+            if len(line_list) == 2 and line_list[1] != outgroup and line_list[1] not in taxa:
+                taxa.append(line_list[1])
+    return taxa
+
+#所有需要检验的(P1, Hybrid, P2)的数量
+def count_triples(taxa_num):
+    return math.comb(taxa_num, 3) * 3
+
+#按hyde(HydeData.list_triples)的方式和顺序生成需要检验的(P1, Hybrid, P2)：
+#每三个分类单元检验三种假设，分别以其中一个为杂交种。只生成第start到stop个，
+#起点由序号直接算出，不需要先生成前面的检验
+def make_triples(taxa, start=0, stop=None):
+    n = len(taxa)
+    stop = count_triples(n) if stop is None else min(stop, count_triples(n))
+    if start >= stop:
+        return
+    #第start个检验所在的三个分类单元的组合(i < j < k，按字典序排列)
+    rest, hypothesis = divmod(start, 3)
+    i = 0
+    while rest >= math.comb(n - 1 - i, 2):
+        rest = rest - math.comb(n - 1 - i, 2)
+        i = i + 1
+    j = i + 1
+    while rest >= n - 1 - j:
+        rest = rest - (n - 1 - j)
+        j = j + 1
+    k = j + 1 + rest
+    triple_index = start
+    while triple_index < stop:
+        a, b, c = taxa[i], taxa[j], taxa[k]
+        for each_triple in ((a, b, c), (a, c, b), (b, a, c))[hypothesis:stop - triple_index + hypothesis]:
+            yield each_triple
+        triple_index = triple_index + 3 - hypothesis
+        hypothesis = 0
+        k = k + 1
+        if k == n:
+            j = j + 1
+            if j == n - 1:
+                i = i + 1
+                j = i + 1
+            k = j + 1
+
+#hyde输出文件的列：检验的三个分类单元、统计量以及15种位点模式的计数
+hyde_patterns = ("AAAA", "AAAB", "AABA", "AABB", "AABC", "ABAA", "ABAB", "ABAC", "ABBA", "BAAA", "ABBC", "CABC", "BACA", "BCAA", "ABCD")
+hyde_header = "\t".join(("P1", "Hybrid", "P2", "Zscore", "Pvalue", "Gamma") + hyde_patterns) + "\n"
+
+#按hyde.py的格式写出一个检验的结果(数值用str转换，与hyde.py中print的结果相同)
+def write_hyde_row(write_file, triple, result):
+    write_file.write("\t".join(list(triple) + [str(result[each]) for each in ("Zscore", "Pvalue", "Gamma") + hyde_patterns]) + "\n")
+
+#按hyde.py的标准从完整的结果中筛选显著的检验：P值小于pvalue除以检验的总数
+#(Bonferroni校正)，Z值不是-99999.9且0 < γ < 1。分片运行时必须用所有分片的检验
+#总数，而不是每个分片的检验数
+def write_filtered_hyde_output(out_file, filtered_file, triple_num, pvalue=0.05):
+    with open(out_file, "r") as read_file, open(filtered_file, "w") as write_file:
+        write_file.write(read_file.readline())
+        for each_line in read_file:
+            line_list = each_line.split("\t")
+            zscore, p_value, gamma = float(line_list[3]), float(line_list[4]), float(line_list[5])
+            if p_value < pvalue / triple_num and abs(zscore) != 99999.9 and 0.0 < gamma < 1.0:
+                write_file.write(each_line)
+
+#分片使用HyDe的python接口(phyde)运行，每个进程只读取一次比对
+shard_data = {}
+
+def init_hyde_shard(infile, mapfile, outgroup, nind, ntaxa, nsites, taxa):
+    shard_data.clear()
+    shard_data["taxa"] = taxa
+    try:
+        import phyde
+        shard_data["data"] = phyde.HydeData(infile, mapfile, outgroup, int(nind), int(ntaxa), int(nsites), True, True)
+    except (ImportError, KeyError, ValueError, OSError, SystemExit) as error:
+        #初始化出错时进程池会不停地重启进程，错误留给每个分片报告
+        shard_data["error"] = "Can not read the input with phyde: " + repr(error)
+
+#运行一个分片的hyde，该分片的检验为第shard_num*shard_size到(shard_num+1)*shard_size
+#个，在进程中生成。结果先写入临时文件，完成后再改名，返回分片编号和出错信息
+#(成功时为None)
+def run_hyde_shard(shard_job):
+    shard_num, shard_prefix, shard_size = shard_job
+    error = shard_data.get("error")
+    if error is None:
+        try:
+            with open(shard_prefix + "-out.txt.tmp", "w") as write_file:
+                write_file.write(hyde_header)
+                for each_triple in make_triples(shard_data["taxa"], shard_num * shard_size, (shard_num + 1) * shard_size):
+                    write_hyde_row(write_file, each_triple, shard_data["data"].test_triple(*each_triple))
+            os.replace(shard_prefix + "-out.txt.tmp", shard_prefix + "-out.txt")
+        except (KeyError, ValueError, OSError) as each_error:
+            error = repr(each_error)
+    if error is not None:
+        with open(shard_prefix + ".log", "w") as log_file:
+            log_file.write(error + "\n")
+    return shard_num, error
+
+#先写入临时文件再替换，程序中途退出时不会留下不完整的记录文件
+def write_shard_manifest(manifest_file, shard_manifest):
+    with open(manifest_file + ".tmp", "w") as write_file:
+        json.dump(shard_manifest, write_file, indent=1)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+#把多个hyde结果按顺序合并为一个文件，只保留第一个文件的表头。给出tag_list时
+#在每一行前加上一列标签(例如基因名称)，列名为tag_name
+def merge_hyde_outputs(hyde_file_list, merged_file, tag_list=None, tag_name="Gene"):
+    if not any(os.path.exists(each_file) for each_file in hyde_file_list):
+        return
+    if tag_list is None:
+        tag_list = [None] * len(hyde_file_list)
+    with open(merged_file, "w") as write_file:
+        header_written = False
+        for each_file, each_tag in zip(hyde_file_list, tag_list):
+            if not os.path.exists(each_file):
+                continue
+            tag = "" if each_tag is None else each_tag + "\t"
+            with open(each_file, "r") as read_file:
+                header = read_file.readline()
+                if not header_written:
+                    write_file.write(("" if each_tag is None else tag_name + "\t") + header)
+                    header_written = True
+                for each_line in read_file:
+                    write_file.write(tag + each_line)
+
+#把所有的(P1, Hybrid, P2)分成每份shard_size个的分片，用jobs个进程分别运行
+#hyde，每个分片的结果保存在"<prefix>-shards"文件夹中。分片通过HyDe的python接口
+#(phyde.HydeData.test_triple)检验，与hyde.py使用-tr/--triples指定检验的三联体
+#相同，结果的格式也与hyde.py相同。主进程只传递分片的编号，每个分片的检验在运行
+#该分片的进程中生成，内存与检验的总数无关；jobs为1时在当前进程中依次运行。
+#每完成一个分片就记录到manifest.json中，中途退出后重新运行时跳过已经完成的分片。
+#所有分片完成后按顺序合并为"<prefix>-out.txt"，再用所有检验的总数做Bonferroni
+#校正得到"<prefix>-out-filtered.txt"，与hyde.py一次运行所有检验的结果相同。
+#有分片失败时返回False
+def run_hyde_sharded(infile, mapfile, outgroup, nind, ntaxa, nsites, prefix, jobs, shard_size):
+    shard_dir = prefix + "-shards"
+    os.makedirs(shard_dir, exist_ok=True)
+    manifest_file = os.path.join(shard_dir, "manifest.json")
+    #输入文件、map.txt或分片大小改变时之前的分片结果不能再使用。phy文件每次运行
+    #都会重新写出，所以用它的内容而不是修改时间判断
+    infile_hash = hashlib.sha1()
+    with open(infile, "rb") as read_file:
+        for each_block in iter(lambda: read_file.read(1 << 20), b""):
+            infile_hash.update(each_block)
+    with open(mapfile, "r") as read_file:
+        run_key = [infile_hash.hexdigest(), read_file.read(), nsites, shard_size]
+    try:
+        with open(manifest_file, "r") as read_file:
+            shard_manifest = json.load(read_file)
+        if shard_manifest["key"] != run_key:
+            shard_manifest = {"key": run_key, "done": []}
+    except (OSError, ValueError, KeyError):
+        shard_manifest = {"key": run_key, "done": []}
+
+    taxa = get_taxa_from_mapfile(mapfile, outgroup)
+    triple_num = count_triples(len(taxa))
+    if triple_num == 0:
+        print("Less than three taxa besides the outgroup in " + mapfile + ", nothing to test")
+        return False
+    shard_num = -(-triple_num // shard_size)
+    shard_prefix_list = [os.path.join(shard_dir, "shard_" + str(k)) for k in range(shard_num)]
+    done = set(shard_manifest["done"])
+    pending = [k for k in range(shard_num) if not (k in done and os.path.exists(shard_prefix_list[k] + "-out.txt"))]
+    print(str(shard_num) + " shards, " + str(shard_num - len(pending)) + " finished before, running the others with " + str(jobs) + " processes")
+
+    failed = []
+    if pending:
+        shard_jobs = ((k, shard_prefix_list[k], shard_size) for k in pending)
+        initargs = (infile, mapfile, outgroup, nind, ntaxa, nsites, taxa)
+        if jobs <= 1:
+            init_hyde_shard(*initargs)
+            results = map(run_hyde_shard, shard_jobs)
+        else:
+            p = Pool(jobs, initializer=init_hyde_shard, initargs=initargs)
+            results = p.imap_unordered(run_hyde_shard, shard_jobs)
+        try:
+            for finished_num, (each_shard, error) in enumerate(results, 1):
+                if error is None:
+                    shard_manifest["done"].append(each_shard)
+                    write_shard_manifest(manifest_file, shard_manifest)
+                else:
+                    failed.append(each_shard)
+                print("Shard " + str(each_shard) + (" failed: " + error if error else " finished") + " " + str(finished_num) + "/" + str(len(pending)))
+        finally:
+            if jobs > 1:
+                p.terminate()
+                p.join()
+    if failed:
+        print("Shards " + ", ".join(str(each) for each in sorted(failed)) + " failed, see the .log files in " + shard_dir + " and run again to retry them")
+        return False
+    merge_hyde_outputs([each + "-out.txt" for each in shard_prefix_list], prefix + "-out.txt")
+    write_filtered_hyde_output(prefix + "-out.txt", prefix + "-out-filtered.txt", triple_num)
+    return True
+
+#批量模式中运行一个基因的hyde。每个基因的phy文件、map.txt和hyde结果都写在该
+#基因自己的文件夹中，与单个比对时一样分片运行(在当前进程中依次运行，输出写入
+#"<基因>.log")，返回基因名称和出错信息(成功时为None)。任何错误都只使该基因失败
+def run_hyde_gene(gene_job):
+    gene, fasta_file, gene_dir, outgroup, engine, bootstrap, seed, shard_size = gene_job
+    try:
+        os.makedirs(gene_dir, exist_ok=True)
+        prefix = os.path.join(gene_dir, gene)
+        if engine == "native":
+            #每个基因已经占用进程池中的一个进程，原生引擎在该进程中直接运行
+            taxa, patterns, weights = load_site_patterns(fasta_file)
+            run_native_hyde(taxa, patterns, weights, outgroup, prefix, 1, bootstrap, seed)
+            return gene, None
+        species_num, species_len = fasta2phy(fasta_file, prefix + ".phy")
+        mapfile = os.path.join(gene_dir, "map.txt")
+        make_mapfile(fasta_file, outgroup, mapfile)
+        with open(prefix + ".log", "w") as log_file, contextlib.redirect_stdout(log_file):
+            finished = run_hyde_sharded(prefix + ".phy", mapfile, "out", species_num, species_num, species_len, prefix, 1, shard_size)
+    except Exception as error:
+        return gene, type(error).__name__ + ": " + str(error)
+    if not finished:
+        return gene, "hyde failed, see " + prefix + ".log"
+    return gene, None
+
+#对文件夹中的每个fasta文件(每个基因一个)分别运行hyde。所有基因共用一个有jobs
+#个进程的进程池，较大的比对先运行，使各个进程的负担更均衡。每个基因的文件写在
+#"<文件夹>_hyde/<基因>/"中，所有基因的结果合并为"<文件夹>-out.txt"，第一列为
+#基因名称。有基因失败时返回False
+def run_hyde_batch(fasta_dir, outgroup, jobs, engine, bootstrap=0, seed=None, shard_size=10000):
+    fasta_dir = os.path.normpath(fasta_dir)
+    scratch_dir = fasta_dir + "_hyde"
+    fasta_file_list = [os.path.join(fasta_dir, each) for each in os.listdir(fasta_dir) if each.endswith(".fasta")]
+    fasta_file_list.sort(key=os.path.getsize, reverse=True)
+    gene_jobs = []
     for each_fasta in fasta_file_list:
-        species_num, species_len = fasta2phy(each_fasta)
-        make_mapfile(each_fasta)
-        infile = each_fasta.replace(".fasta", "") + ".phy"
-        mapfile = "map.txt"
-        outgroup = "out"
-        nind = species_num
-        ntaxa = species_num
-        nsites = species_len
-        os.system("python hyde.py -i " + infile + " -j 6" + " --ignore_amb_sites -m " + mapfile + " -o " + outgroup + " -n " + nind + " -t " + ntaxa + " -s " + nsites + " --prefix " + each_fasta.replace(".fasta", ""))
-'''
+        gene = os.path.basename(each_fasta).replace(".fasta", "")
+        gene_jobs.append((gene, each_fasta, os.path.join(scratch_dir, gene), outgroup, engine, bootstrap, seed, shard_size))
+    print(str(len(gene_jobs)) + " alignments, running hyde with " + str(jobs) + " processes")
+
+    failed = {}
+    with Pool(jobs) as p:
+        for finished_num, (gene, error) in enumerate(p.imap_unordered(run_hyde_gene, gene_jobs), 1):
+            if error:
+                failed[gene] = error
+            print("Gene " + gene + (" failed: " + error if error else " finished") + " " + str(finished_num) + "/" + str(len(gene_jobs)))
+    #合并时按基因名称排序，结果与运行的先后顺序无关
+    gene_list = sorted(each_job[0] for each_job in gene_jobs if each_job[0] not in failed)
+    for suffix in ("-out.txt", "-out-filtered.txt", "-bootstrap.txt"):
+        merge_hyde_outputs([os.path.join(scratch_dir, gene, gene + suffix) for gene in gene_list], fasta_dir + suffix, gene_list)
+    if failed:
+        print(str(len(failed)) + " alignments failed: " + ", ".join(sorted(failed)))
+        return False
+    return True
 
 def main():
     #解析参数
     #参数分为必须参数(required)和可选参数(additional)
     parser = argparse.ArgumentParser(description="Options for visual_hyde.py", add_help=True)
     required = parser.add_argument_group("Required arguments")
-    required.add_argument('-i', '--infile', action="store", metavar='\b', type=str, required=True, help="Name of the hyde input fasta file")  
+    required.add_argument('-i', '--infile', action="store", metavar='\b', type=str, required=True, help="Name of the hyde input fasta file, or a directory of per-gene fasta files to run hyde on each of them")  
     required.add_argument('-o', '--outgroup', action="store", metavar='\b', type=str, required=True, help="Name of the outgroup")
+    additional = parser.add_argument_group("Additional arguments")
+    additional.add_argument('-j', '--jobs', action="store", metavar='\b', type=int, default=os.cpu_count(), help="Number of hyde processes, default = number of cores")
+    additional.add_argument('-p', '--patterns', action="store_true", default=False, help="Also write the unique site patterns of the alignment and their counts (<prefix>.patterns.npy, .patterns.weights.npy, .patterns.taxa.json) and <prefix>.patterns.phy, a phylip alignment with each pattern repeated by its count (sites sorted by pattern, sites with less than 4 known bases removed)")
+    additional.add_argument('-e', '--engine', action="store", metavar='\b', type=str, default="hyde", choices=["hyde", "native"], help="hyde: run hyde.py; native: count the site patterns of every triple with the built-in vectorized engine (one individual per taxon), default = hyde")
+    additional.add_argument('-b', '--bootstrap', action="store", metavar='\b', type=int, default=0, help="Number of bootstrap replicates (resampling sites) used to estimate the confidence intervals of gamma and Z-score, uses the native engine, default = 0")
+    additional.add_argument('--seed', action="store", metavar='\b', type=int, default=None, help="Random seed of the bootstrap replicates")
+    additional.add_argument('--shard_size', action="store", metavar='\b', type=int, default=10000, help="Number of (P1, Hybrid, P2) triples in each shard, default = 10000")
 
 
     args                           = parser.parse_args()
     input_fasta                    = args.infile
     outgroup                       = args.outgroup
+    jobs                           = args.jobs
+    shard_size                     = args.shard_size
+    write_patterns                 = args.patterns
+    engine                         = args.engine
+    bootstrap                      = args.bootstrap
+    seed                           = args.seed
     
-    species_num, species_len = fasta2phy(input_fasta)
+    #bootstrap的重复只改变每种位点模式的次数，只有原生引擎可以直接使用
+    if bootstrap > 0 and engine != "native":
+        print("--bootstrap uses the native engine")
+        engine = "native"
+    if os.path.isdir(input_fasta):
+        if not run_hyde_batch(input_fasta, outgroup, jobs, engine, bootstrap, seed, shard_size):
+            sys.exit(1)
+        return
+    prefix = input_fasta.replace(".fasta", "")
+    try:
+        if write_patterns or engine == "native":
+            taxa, patterns, weights = load_site_patterns(input_fasta)
+            if write_patterns:
+                write_site_patterns(prefix, taxa, patterns, weights)
+        if engine != "native":
+            species_num, species_len = fasta2phy(input_fasta)
+    except ValueError as error:
+        print(error)
+        print("Can not convert the fasta file, script end")
+        sys.exit(1)
+    if engine == "native":
+        try:
+            run_native_hyde(taxa, patterns, weights, outgroup, prefix, jobs, bootstrap, seed)
+        except ValueError as error:
+            print(error)
+            print("Script end")
+            sys.exit(1)
+        return
     make_mapfile(input_fasta, outgroup)
     infile = input_fasta.replace(".fasta", "") + ".phy"
     mapfile = "map.txt"
@@ -81,8 +750,11 @@ def main():
     nind = species_num
     ntaxa = species_num
     nsites = species_len
-    os.system("python hyde.py -i " + infile + " -j 60" + " --ignore_amb_sites -m " + mapfile + " -o " + outgroup + " -n " + nind + " -t " + ntaxa + " -s " + nsites + " --prefix " + input_fasta.replace(".fasta", ""))
+    finished = run_hyde_sharded(infile, mapfile, outgroup, nind, ntaxa, nsites, input_fasta.replace(".fasta", ""), jobs, shard_size)
+    os.remove("map.txt")
+    if not finished:
+        sys.exit(1)
 
 
-main()
-os.remove("map.txt")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
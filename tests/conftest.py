@@ -0,0 +1,37 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+#仓库中的脚本都放在根目录，测试时直接导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#测试用的树，Label按树的遍历顺序排列
+tree_newick = "((t1,(t2,t3)),((t4,t5),(t6,(t7,t8))));"
+tree_label = ["t1", "t2", "t3", "t4", "t5", "t6", "t7", "t8"]
+
+
+#随机生成的hyde输出表格：包含正向和反向的检验、重复的检验、z值不同的检验以及
+#不在树中的物种
+@pytest.fixture
+def hyde_table():
+    rng = np.random.default_rng(7)
+    taxa = tree_label + ["x1"]
+    rows = []
+    for hybrid in taxa:
+        for p1 in taxa:
+            for p2 in taxa:
+                if len({hybrid, p1, p2}) < 3 or rng.random() < 0.4:
+                    continue
+                for i in range(1 + (rng.random() < 0.1)):
+                    rows.append((p1, hybrid, p2, round(rng.uniform(-2, 8), 4), round(rng.uniform(0.01, 0.99), 4)))
+    return pd.DataFrame(rows, columns=["P1", "Hybrid", "P2", "Zscore", "Gamma"])
+
+
+@pytest.fixture
+def tree_file(tmp_path):
+    file_name = tmp_path / "tree.nwk"
+    file_name.write_text(tree_newick + "\n")
+    return str(file_name)
@@ -0,0 +1,71 @@
+import os
+import sys
+import csv
+
+import pytest
+
+import extract
+
+
+def run_main(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["extract.py"] + list(argv))
+    extract.main()
+
+
+def test_default_mode_matches_ete3_levelorder(tmp_path, monkeypatch):
+    pytest.importorskip("ete3")
+    monkeypatch.chdir(tmp_path)
+    with open(extract.default_tree, "w") as write_file:
+        write_file.write("((a:1,(b:2,c:3):1):1,d:4);\n")
+    with open(extract.default_output, "w") as write_file:
+        write_file.write("x,0.5\n")
+    #与原来相同：按层序遍历，结果追加到result.csv后
+    run_main(monkeypatch)
+    with open(extract.default_output) as read_file:
+        assert read_file.read() == "x,0.5\nd,4.0\na,1.0\nb,2.0\nc,3.0\n"
+
+
+def test_extract_tables(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("trees")
+    with open(os.path.join("trees", "a.tre"), "w") as write_file:
+        write_file.write("[&R] ('x;1':1,(y:2,z)[z;]:0.5);\n(y:3,z:4);\n")
+    with open(os.path.join("trees", "RAxML_bestTree.run"), "w") as write_file:
+        write_file.write("(x:5,y:6);")
+    #文件夹中按文件名排序，只取树文件的扩展名和RAxML_开头的文件
+    with open(os.path.join("trees", "notes.txt"), "w") as write_file:
+        write_file.write("(not:1,a:2,tree:3);")
+    run_main(monkeypatch, "-i", "trees", "-o", "long.csv", "-j", "2")
+    a_file, raxml_file = os.path.join("trees", "a.tre"), os.path.join("trees", "RAxML_bestTree.run")
+    with open("long.csv") as read_file:
+        assert read_file.read() == ("File,Tree,Leaf,Length\n"
+                                    + raxml_file + ",0,x,5.0\n" + raxml_file + ",0,y,6.0\n"
+                                    + a_file + ",0,x;1,1.0\n" + a_file + ",0,y,2.0\n" + a_file + ",0,z,1.0\n"
+                                    + a_file + ",1,y,3.0\n" + a_file + ",1,z,4.0\n")
+    run_main(monkeypatch, "-i", raxml_file, a_file, "-o", "wide.csv", "-f", "wide", "-j", "1")
+    with open("wide.csv") as read_file:
+        assert read_file.read() == ("File,Tree,x,x;1,y,z\n"
+                                    + raxml_file + ",0,5.0,,6.0,\n"
+                                    + a_file + ",0,,1.0,2.0,1.0\n" + a_file + ",1,,,3.0,4.0\n")
+
+
+def test_extract_quoted_names(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open("quoted.tre", "w") as write_file:
+        write_file.write("('a,b':1,('say \"hi\"':2,c:3):1);\n")
+    #名称中的逗号和引号不会破坏表格
+    for table_format in ("long", "wide"):
+        run_main(monkeypatch, "-i", "quoted.tre", "-o", table_format + ".csv", "-f", table_format, "-j", "1")
+    with open("long.csv", newline="") as read_file:
+        assert list(csv.reader(read_file))[1:] == [["quoted.tre", "0", "a,b", "1.0"], ["quoted.tre", "0", 'say "hi"', "2.0"], ["quoted.tre", "0", "c", "3.0"]]
+    with open("wide.csv", newline="") as read_file:
+        assert list(csv.reader(read_file)) == [["File", "Tree", "a,b", "c", 'say "hi"'], ["quoted.tre", "0", "1.0", "3.0", "2.0"]]
+
+
+def test_extract_without_trees(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("empty")
+    with pytest.raises(SystemExit) as exit_info:
+        run_main(monkeypatch, "-i", "empty")
+    assert exit_info.value.code == 1
+    assert not os.path.exists(extract.default_output)
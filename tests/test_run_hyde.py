@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import shutil
+import itertools
+
+import numpy as np
+import pytest
+
+import run_hyde
+
+
+def read_phy(phy_file):
+    with open(phy_file) as read_file:
+        return read_file.read()
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_fasta2phy(tmp_path, newline):
+    fasta_file = tmp_path / "aln.fasta"
+    #第一条序列只有一行，第二条分成多行，中间有空行和行尾空白
+    fasta_file.write_bytes(newline.join([">sp1", "ACGTNACGT-", "", ">sp2 ", "ACGT", "NACG  ", "", "T-", ""]).encode())
+    (tmp_path / "aln.phy").write_text("old content that is longer than the new phy file\n" * 10)
+    assert run_hyde.fasta2phy(str(fasta_file)) == ("2", "10")
+    assert read_phy(tmp_path / "aln.phy") == " 2 10\nsp1 ACGTNACGT-\nsp2 ACGTNACGT-\n"
+
+
+def test_fasta2phy_errors(tmp_path):
+    fasta_file = tmp_path / "aln.fasta"
+    fasta_file.write_text(">sp1\nACGT\n>sp2\nACG\n")
+    with pytest.raises(ValueError, match="sp2"):
+        run_hyde.fasta2phy(str(fasta_file))
+    fasta_file.write_text("ACGT\n>sp1\nACGT\n")
+    with pytest.raises(ValueError):
+        run_hyde.fasta2phy(str(fasta_file))
+    fasta_file.write_text("")
+    with pytest.raises(ValueError, match="empty"):
+        run_hyde.fasta2phy(str(fasta_file))
+
+
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def read_text(file_name):
+    with open(file_name) as read_file:
+        return read_file.read()
+
+
+def run_main(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["run_hyde.py"] + list(argv))
+    run_hyde.main()
+
+
+def test_make_triples_order():
+    #与HydeData.list_triples的顺序相同
+    assert list(run_hyde.make_triples(["a", "b", "c", "d"]))[:6] == [
+        ("a", "b", "c"), ("a", "c", "b"), ("b", "a", "c"),
+        ("a", "b", "d"), ("a", "d", "b"), ("b", "a", "d")]
+    #从任意位置开始生成的检验与完整列表中的一段相同
+    taxa = [str(k) for k in range(7)]
+    all_triples = [each for a, b, c in itertools.combinations(taxa, 3) for each in ((a, b, c), (a, c, b), (b, a, c))]
+    assert run_hyde.count_triples(len(taxa)) == len(all_triples)
+    for start in range(len(all_triples) + 1):
+        for stop in (start, start + 1, start + 5, len(all_triples) + 3):
+            assert list(run_hyde.make_triples(taxa, start, stop)) == all_triples[start:stop]
+    #原生引擎的进程按范围生成物种编号
+    ingroup = [0, 2, 3, 5, 6]
+    index_triples = list(run_hyde.make_triples(ingroup))
+    for start, stop in ((0, 30), (4, 11), (29, 30), (7, 7)):
+        np.testing.assert_array_equal(run_hyde.triple_array(ingroup, start, stop), np.array(index_triples[start:stop], dtype=np.int64).reshape(-1, 3))
+
+
+def test_sharded_hyde_matches_single_run(tmp_path, monkeypatch):
+    pytest.importorskip("phyde")
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(os.path.join(data_dir, "hyde_small.fasta"), tmp_path)
+    #30个检验分为5个分片；hyde_small-out*.txt为hyde.py一次运行所有检验的结果
+    run_main(monkeypatch, "-i", "hyde_small.fasta", "-o", "out", "-j", "2", "--shard_size", "7")
+    for suffix in ("-out.txt", "-out-filtered.txt"):
+        assert read_text("hyde_small" + suffix) == read_text(os.path.join(data_dir, "hyde_small" + suffix))
+    assert not os.path.exists("map.txt")
+    with open(os.path.join("hyde_small-shards", "manifest.json")) as read_file:
+        assert sorted(json.load(read_file)["done"]) == [0, 1, 2, 3, 4]
+
+
+def test_failed_shard_exits_with_error(tmp_path, monkeypatch, capsys):
+    pytest.importorskip("phyde")
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(os.path.join(data_dir, "hyde_small.fasta"), tmp_path)
+    make_triples = run_hyde.make_triples
+    #最后一个分片(第28-29个检验)中有不存在的分类单元
+    monkeypatch.setattr(run_hyde, "make_triples", lambda taxa, start=0, stop=None: itertools.chain(make_triples(taxa, start, stop), [("sp1", "sp9", "sp2")] if start >= 28 else []))
+    for jobs in ("1", "2"):
+        with pytest.raises(SystemExit) as exit_info:
+            run_main(monkeypatch, "-i", "hyde_small.fasta", "-o", "out", "-j", jobs, "--shard_size", "7")
+        assert exit_info.value.code == 1
+        assert not os.path.exists("hyde_small-out.txt")
+        assert os.path.exists(os.path.join("hyde_small-shards", "shard_4.log"))
+        with open(os.path.join("hyde_small-shards", "manifest.json")) as read_file:
+            assert sorted(json.load(read_file)["done"]) == [0, 1, 2, 3]
+    #修复后只重新运行失败的分片
+    monkeypatch.setattr(run_hyde, "make_triples", make_triples)
+    run_main(monkeypatch, "-i", "hyde_small.fasta", "-o", "out", "-j", "1", "--shard_size", "7")
+    assert "5 shards, 4 finished before" in capsys.readouterr().out
+    assert read_text("hyde_small-out.txt") == read_text(os.path.join(data_dir, "hyde_small-out.txt"))
+
+
+#代替run_hyde_gene，名称中含有bad的基因失败，其余基因写出一行结果
+def fake_hyde_gene(gene_job):
+    gene, fasta_file, gene_dir = gene_job[:3]
+    if "bad" in gene:
+        return gene, "bad alignment"
+    os.makedirs(gene_dir, exist_ok=True)
+    with open(os.path.join(gene_dir, gene + "-out.txt"), "w") as write_file:
+        write_file.write(run_hyde.hyde_header + "\t".join(["sp1", "sp2", gene] + ["1.0"] * 18) + "\n")
+    return gene, None
+
+
+def test_batch_merges_genes_and_reports_failures(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("genes")
+    #文件大小不同，运行顺序与基因名称的顺序不同
+    for gene, size in (("g2", 10), ("g1", 30), ("g3", 20), ("bad", 5)):
+        with open(os.path.join("genes", gene + ".fasta"), "w") as write_file:
+            write_file.write(">out\n" + "A" * size + "\n")
+    monkeypatch.setattr(run_hyde, "run_hyde_gene", fake_hyde_gene)
+    with pytest.raises(SystemExit) as exit_info:
+        run_main(monkeypatch, "-i", "genes", "-o", "out", "-j", "2")
+    assert exit_info.value.code == 1
+    with open("genes-out.txt") as read_file:
+        lines = [each_line.split("\t") for each_line in read_file]
+    assert lines[0][:2] == ["Gene", "P1"]
+    assert [each[0] for each in lines[1:]] == ["g1", "g2", "g3"]
+    assert [each[3] for each in lines[1:]] == ["g1", "g2", "g3"]
+    assert not os.path.exists("genes-out-filtered.txt")
+    os.remove(os.path.join("genes", "bad.fasta"))
+    run_main(monkeypatch, "-i", "genes", "-o", "out", "-j", "2")
+
+
+def test_encode_alignment(tmp_path):
+    fasta_file = tmp_path / "aln.fasta"
+    fasta_file.write_text(">sp1\nACgt\nN-\n>sp2\nRYAC\nGT\n")
+    names, alignment = run_hyde.encode_alignment(str(fasta_file))
+    assert names == ["sp1", "sp2"]
+    assert alignment.dtype == np.uint8
+    np.testing.assert_array_equal(alignment[0, :4], run_hyde.base_code[np.frombuffer(b"ACGT", dtype=np.uint8)])
+    np.testing.assert_array_equal(alignment[:, 4:], run_hyde.base_code[np.frombuffer(b"N-GT", dtype=np.uint8)].reshape(2, 2))
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1 << 20])
+def test_compress_site_patterns(chunk_size):
+    rng = np.random.default_rng(1)
+    alignment = rng.choice(np.array([0, 1, 2, 3, 4], dtype=np.uint8), size=(6, 500), p=[0.1, 0.1, 0.1, 0.1, 0.6])
+    patterns, weights = run_hyde.compress_site_patterns(alignment, chunk_size=chunk_size)
+    #少于4个物种有碱基的位点被丢弃，其余位点按次数展开后与原来的位点相同
+    used = alignment[:, (alignment != 4).sum(axis=0) >= 4]
+    assert 0 < weights.sum() == used.shape[1] < alignment.shape[1]
+    assert len(np.unique(patterns, axis=1).T) == patterns.shape[1]
+    expanded = np.repeat(patterns, weights, axis=1)
+    np.testing.assert_array_equal(expanded[:, np.lexsort(expanded[::-1])], used[:, np.lexsort(used[::-1])])
+
+
+def test_write_site_patterns(tmp_path):
+    patterns = np.array([[0, 1], [2, 4], [3, 3], [0, 0]], dtype=np.uint8)
+    weights = np.array([5, 2])
+    prefix = str(tmp_path / "aln")
+    run_hyde.write_site_patterns(prefix, ["a", "b", "c", "d"], patterns, weights)
+    taxa, read_patterns, read_weights = run_hyde.read_site_patterns(prefix)
+    assert taxa == ["a", "b", "c", "d"]
+    np.testing.assert_array_equal(read_patterns, patterns)
+    np.testing.assert_array_equal(read_weights, weights)
+    #每种模式按次数重复，是一个正常的phylip比对
+    assert read_phy(prefix + ".patterns.phy") == " 4 7\na AAAAACC\nb GGGGGNN\nc TTTTTTT\nd AAAAAAA\n"
+
+
+def test_pattern_alignment_matches_hyde(tmp_path, monkeypatch):
+    pytest.importorskip("phyde")
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(os.path.join(data_dir, "hyde_small.fasta"), tmp_path)
+    #hyde.py在<prefix>.patterns.phy上的结果与在原比对上相同
+    taxa, patterns, weights = run_hyde.load_site_patterns("hyde_small.fasta")
+    run_hyde.write_site_patterns("pattern", taxa, patterns, weights)
+    run_hyde.make_mapfile("hyde_small.fasta", "out")
+    assert run_hyde.run_hyde_sharded("pattern.patterns.phy", "map.txt", "out", len(taxa), len(taxa), int(weights.sum()), "pattern", 1, 10000)
+    for suffix in ("-out.txt", "-out-filtered.txt"):
+        assert read_text("pattern" + suffix) == read_text(os.path.join(data_dir, "hyde_small" + suffix))
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_native_engine_matches_hyde(tmp_path, monkeypatch, jobs):
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(os.path.join(data_dir, "hyde_small.fasta"), tmp_path)
+    #hyde_small-out*.txt为hyde.py使用--ignore_amb_sites的结果，比对中有N、-、
+    #简并碱基、小写碱基和U
+    run_main(monkeypatch, "-i", "hyde_small.fasta", "-o", "out", "-e", "native", "-j", str(jobs))
+    for suffix in ("-out.txt", "-out-filtered.txt"):
+        assert read_text("hyde_small" + suffix) == read_text(os.path.join(data_dir, "hyde_small" + suffix))
+
+
+def test_popcount_without_bitwise_count(monkeypatch):
+    words = np.random.default_rng(2).integers(0, 1 << 63, size=(3, 5), dtype=np.uint64) * np.uint64(3)
+    expected = [sum(bin(int(each)).count("1") for each in each_row) for each_row in words]
+    assert run_hyde.popcount_sum(words).tolist() == expected
+    #numpy 2.0之前没有np.bitwise_count
+    monkeypatch.delattr(np, "bitwise_count", raising=False)
+    assert run_hyde.popcount_sum(words).tolist() == expected
+    assert run_hyde.popcount_sum(words[:, ::2]).tolist() == [sum(bin(int(each)).count("1") for each in each_row) for each_row in words[:, ::2]]
+
+
+def read_table(file_name):
+    with open(file_name) as read_file:
+        header = read_file.readline().rstrip("\n").split("\t")
+        return {tuple(each[:3]): dict(zip(header[3:], each[3:])) for each in (each_line.rstrip("\n").split("\t") for each_line in read_file)}
+
+
+def test_native_bootstrap(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(os.path.join(data_dir, "hyde_small.fasta"), tmp_path)
+    bootstrap_files = []
+    #seed相同时结果与进程数以及检验的分块无关
+    for jobs, chunk_values in (("1", 1 << 21), ("2", 100 * 7)):
+        monkeypatch.setattr(run_hyde, "bootstrap_chunk_values", chunk_values)
+        run_main(monkeypatch, "-i", "hyde_small.fasta", "-o", "out", "-j", jobs, "-b", "100", "--seed", "11")
+        bootstrap_files.append(read_text("hyde_small-bootstrap.txt"))
+    assert bootstrap_files[0] == bootstrap_files[1]
+    run_main(monkeypatch, "-i", "hyde_small.fasta", "-o", "out", "-j", "1", "-b", "100", "--seed", "12")
+    assert read_text("hyde_small-bootstrap.txt") != bootstrap_files[0]
+    #与hyde.py的检验顺序和点估计相同
+    assert read_text("hyde_small-out.txt") == read_text(os.path.join(data_dir, "hyde_small-out.txt"))
+    hyde_table = read_table("hyde_small-out.txt")
+    bootstrap_table = read_table("hyde_small-bootstrap.txt")
+    assert list(bootstrap_table) == list(hyde_table)
+    for triple, row in bootstrap_table.items():
+        assert row["Gamma"] == hyde_table[triple]["Gamma"]
+        assert row["Replicates"] == "100"
+    #sp3为sp1/sp2与sp4/sp5的杂交，γ约为0.28
+    for triple in read_table(os.path.join(data_dir, "hyde_small-out-filtered.txt")):
+        row = {key: float(value) for key, value in bootstrap_table[triple].items()}
+        assert abs(row["Gamma_mean"] - row["Gamma"]) < 0.03
+        assert row["Gamma_2.5"] < row["Gamma"] < row["Gamma_97.5"]
+        assert row["Zscore_2.5"] < row["Zscore"] < row["Zscore_97.5"]
+
+
+@pytest.mark.parametrize("engine", ["hyde", "native"])
+def test_main_exits_with_error(tmp_path, monkeypatch, capsys, engine):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "bad.fasta").write_text(">a\nACGT\n>b\nACG\n")
+    with pytest.raises(SystemExit) as exit_info:
+        run_main(monkeypatch, "-i", "bad.fasta", "-o", "a", "-e", engine)
+    assert exit_info.value.code == 1
+    assert "Can not convert the fasta file" in capsys.readouterr().out
+    (tmp_path / "good.fasta").write_text(">a\nACGT\n>b\nACGA\n>c\nACTT\n>d\nAGGT\n")
+    if engine == "native":
+        #外类群不在比对中，不是转换fasta的错误
+        with pytest.raises(SystemExit) as exit_info:
+            run_main(monkeypatch, "-i", "good.fasta", "-o", "out", "-e", engine)
+        assert exit_info.value.code == 1
+        output = capsys.readouterr().out
+        assert "Outgroup out not found in the alignment" in output
+        assert "Can not convert" not in output
+
+
+@pytest.mark.parametrize("engine", ["hyde", "native"])
+def test_batch_runs_genes_like_single_alignments(tmp_path, monkeypatch, capsys, engine):
+    if engine == "hyde":
+        pytest.importorskip("phyde")
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("genes")
+    shutil.copy(os.path.join(data_dir, "hyde_small.fasta"), os.path.join("genes", "g1.fasta"))
+    #无法读取的基因只使该基因失败
+    os.mkdir(os.path.join("genes", "broken.fasta"))
+    with pytest.raises(SystemExit) as exit_info:
+        run_main(monkeypatch, "-i", "genes", "-o", "out", "-j", "2", "-e", engine, "--shard_size", "7")
+    assert exit_info.value.code == 1
+    assert "Gene broken failed: IsADirectoryError" in capsys.readouterr().out
+    for suffix in ("-out.txt", "-out-filtered.txt"):
+        with open(os.path.join(data_dir, "hyde_small" + suffix)) as read_file:
+            header = read_file.readline()
+            expected = "Gene\t" + header + "".join("g1\t" + each_line for each_line in read_file)
+        assert read_text("genes" + suffix) == expected
+    if engine == "hyde":
+        assert os.path.exists(os.path.join("genes_hyde", "g1", "g1-shards", "manifest.json"))
@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import stat
+
+import numpy as np
+import pytest
+
+import treepl
+
+
+#代替treePL的脚本：配置文件中有fail时以该值退出；有prime时输出prime的结果；有cv时
+#把得分(log10(smooth) - 1)^2 + opt写入cvoutfile；有outfile时写出一棵树。每次运行
+#都把配置文件的绝对路径记录到FAKE_TREEPL_LOG中
+fake_treepl_script = """#!{python}
+import os, sys, math
+conf = {{}}
+for each_line in open(sys.argv[1]):
+    line = each_line.split("#")[0].strip()
+    if "=" in line:
+        key, value = line.split("=", 1)
+        conf[key.strip()] = value.strip()
+    elif line:
+        conf[line] = None
+with open(os.environ["FAKE_TREEPL_LOG"], "a") as log_file:
+    log_file.write(os.path.abspath(sys.argv[1]) + "\\n")
+if "fail" in conf:
+    print("treePL error")
+    sys.exit(int(conf["fail"]))
+if "prime" in conf:
+    print("PLACE THE LINES BELOW IN THE CONFIG FILE")
+    print("opt = 3")
+    print("optad = 2")
+    print("moredetail")
+    print("END OF PRIME")
+    sys.exit(0)
+if "cv" in conf:
+    smooth = float(conf["cvstart"])
+    with open(conf["cvoutfile"], "w") as write_file:
+        write_file.write("chisq: (%s) %s\\n" % (smooth, (math.log10(smooth) - 1) ** 2 + float(conf.get("opt") or 1)))
+if "outfile" in conf:
+    with open(conf["outfile"], "w") as write_file:
+        write_file.write("(a:1,b:1);\\n")
+"""
+
+
+@pytest.fixture
+def fake_treepl(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "treePL"
+    script.write_text(fake_treepl_script.format(python=sys.executable))
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    run_log = tmp_path / "treepl_runs.txt"
+    monkeypatch.setenv("FAKE_TREEPL_LOG", str(run_log))
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    monkeypatch.chdir(work_dir)
+
+    #依次返回每次运行的配置文件名称
+    def read_runs():
+        if not run_log.exists():
+            return []
+        return [os.path.relpath(each, str(work_dir)) for each in run_log.read_text().splitlines()]
+    return read_runs
+
+
+def write_text(file_name, text):
+    with open(file_name, "w") as write_file:
+        write_file.write(text)
+
+
+def read_text(file_name):
+    with open(file_name) as read_file:
+        return read_file.read()
+
+
+def run_main(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["treepl.py"] + list(argv))
+    treepl.main()
+
+
+def test_run_treepl_queue(fake_treepl, monkeypatch):
+    write_text("tree.tre", "((a,b),(c,d));\n")
+    write_text("small.conf", "treefile = tree.tre\nnumsites = 10\noutfile = small.out\n")
+    write_text("large.conf", "treefile = tree.tre\nnumsites = 1000\noutfile = large.out\n")
+    write_text("bad.conf", "treefile = tree.tre\nnumsites = 100\nfail = 3\n")
+    with pytest.raises(SystemExit) as exit_info:
+        run_main(monkeypatch, "-j", "1", "--no_prime_cache")
+    assert exit_info.value.code == 1
+    #预计运行时间长的先运行
+    assert fake_treepl() == ["large.conf", "bad.conf", "small.conf"]
+    with open(treepl.manifest_file) as read_file:
+        manifest = json.load(read_file)
+    assert {key: value["exit_code"] for key, value in manifest.items()} == {"large.conf": 0, "bad.conf": 3, "small.conf": 0}
+    assert manifest["small.conf"]["conf_hash"] == treepl.get_conf_hash("small.conf")
+    assert os.path.exists("small.out") and os.path.exists("large.out")
+    with open("bad.conf.log") as read_file:
+        assert read_file.read() == "treePL error\n"
+
+    #重新运行时只运行失败的和改变了的配置文件
+    write_text("bad.conf", "treefile = tree.tre\nnumsites = 100\noutfile = bad.out\n")
+    write_text("small.conf", "treefile = tree.tre\nnumsites = 20\noutfile = small.out\n")
+    run_main(monkeypatch, "-j", "2", "--no_prime_cache")
+    assert sorted(fake_treepl()[3:]) == ["bad.conf", "small.conf"]
+    run_main(monkeypatch, "-j", "2", "--no_prime_cache")
+    assert len(fake_treepl()) == 5
+
+
+def test_treepl_not_found(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PATH", str(tmp_path))
+    write_text("a.conf", "numsites = 10\n")
+    conf_file, exit_code, wall_time, peak_rss = treepl.main_software("a.conf")
+    assert (conf_file, exit_code) == ("a.conf", 127)
+    assert treepl.run_treepl_queue(["a.conf"], 1) == ["a.conf"]
+
+
+def test_run_sweep(fake_treepl, monkeypatch):
+    write_text("tree.tre", "((a,b),(c,d));\n")
+    write_text("template.conf", "treefile = tree.tre\nnumsites = 100\nsmooth = 5\nopt = 1\nprime\noutfile = dated.tre\n")
+    run_main(monkeypatch, "-j", "2", "-s", "template.conf", "--smooth", "0.1,1,10,100,1000", "--opt", "1,5", "--fine", "1")
+    with open("template_sweep.csv") as read_file:
+        lines = [each_line.rstrip("\n").split(",") for each_line in read_file]
+    assert lines[0] == ["Pass", "Smooth", "Opt", "Optad", "Optcvad", "CV_score", "Exit_code", "Wall_time", "Run_dir"]
+    rows = {(each[0], float(each[1]), each[2]): float(each[5]) for each in lines[1:]}
+    #opt = 5的最好得分为5，比opt = 1的最好得分(1)差1.1倍以上，被淘汰；
+    #opt = 1在最好的smooth(10)两侧各插入一个smooth值
+    assert len(rows) == 12
+    assert rows[("coarse", 10.0, "1")] == 1.0
+    assert rows[("coarse", 10.0, "5")] == 5.0
+    assert sorted(key[1] for key in rows if key[0] == "fine") == [3.16228, 31.6228]
+    assert {key[2] for key in rows if key[0] == "fine"} == {"1"}
+    assert all(each[6] == "0" for each in lines[1:])
+    #每个格点只对一个smooth值做交叉验证，树文件为绝对路径，模板中的smooth和prime被去掉
+    conf_dict = dict(treepl.read_conf(os.path.join("template_sweep", "coarse_s10.0_opt5", "sweep.conf")))
+    assert conf_dict["treefile"] == os.path.abspath("tree.tre")
+    assert conf_dict["opt"] == "5"
+    assert conf_dict["cvstart"] == conf_dict["cvstop"] == "10.0"
+    assert "smooth" not in conf_dict and "prime" not in conf_dict
+
+    #重新运行时所有格点都已经完成
+    run_count = len(fake_treepl())
+    best = treepl.run_sweep("template.conf", [0.1, 1.0, 10.0, 100.0, 1000.0], ["1", "5"], [], [], 1, 1.1, 2)
+    assert len(fake_treepl()) == run_count == 12
+    assert (best["smooth"], best["combo"], best["score"]) == (10.0, ("1", None, None), 1.0)
+
+
+def test_run_sweep_without_results(fake_treepl, monkeypatch):
+    write_text("template.conf", "treefile = tree.tre\nfail = 1\n")
+    with pytest.raises(SystemExit) as exit_info:
+        run_main(monkeypatch, "-j", "1", "-s", "template.conf", "--smooth", "1,10")
+    assert exit_info.value.code == 1
+
+
+def test_prime_cache(fake_treepl, monkeypatch, capsys):
+    write_text("tree.tre", "((a,b),(c,d));\n")
+    write_text("a.conf", "treefile = tree.tre\nnumsites = 100\nmrca = ab a b\nprime\noutfile = a.out\n")
+    write_text("b.conf", "treefile = tree.tre\nnumsites = 100\nmrca =  ab  a b\nprime\noutfile = b.out\n")
+    #没有treefile和树文件不存在的配置文件不使用缓存，直接交给treePL
+    write_text("c.conf", "numsites = 100\nprime\n")
+    write_text("d.conf", "treefile = missing.tre\nnumsites = 100\nprime\n")
+    run_main(monkeypatch, "-j", "1")
+    assert "c.conf, d.conf" in capsys.readouterr().out
+    runs = fake_treepl()
+    #校准点和位点数相同的a和b只运行一次prime
+    assert runs[0] in (os.path.join(treepl.primed_dir, "a.prime.conf"), os.path.join(treepl.primed_dir, "b.prime.conf"))
+    assert sorted(runs[1:]) == ["c.conf", "d.conf", os.path.join(treepl.primed_dir, "a.conf"), os.path.join(treepl.primed_dir, "b.conf")]
+    primed_conf = treepl.read_conf(os.path.join(treepl.primed_dir, "b.conf"))
+    assert primed_conf[-3:] == [("opt", "3"), ("optad", "2"), ("moredetail", None)]
+    assert "prime" not in dict(primed_conf)
+    assert dict(primed_conf)["outfile"] == os.path.abspath("b.out")
+    assert os.path.exists("a.out") and os.path.exists("b.out")
+
+    #再次运行时使用缓存的prime结果，所有配置文件都已经完成
+    run_main(monkeypatch, "-j", "1")
+    assert len(fake_treepl()) == 5
+    #校准点改变后重新运行prime
+    write_text("b.conf", "treefile = tree.tre\nnumsites = 100\nmrca = ab a c\nprime\noutfile = b.out\n")
+    run_main(monkeypatch, "-j", "1")
+    assert fake_treepl()[5:] == [os.path.join(treepl.primed_dir, "b.prime.conf"), os.path.join(treepl.primed_dir, "b.conf")]
+
+
+def test_iter_newick(tmp_path, monkeypatch):
+    #带引号的名称和注释中的";"不是树的结尾；树的数量足够多，跨过每次读取的1 MB
+    tree = "[&R] ('a;b':1.5,[x;y]('it''s':2,c:3)[&rate=0.1;]:1);\n"
+    tree_file = tmp_path / "trees.tre"
+    tree_file.write_text(tree * 30000 + "[end;]\n(d,e)\n")
+    trees = list(treepl.iter_newick(str(tree_file)))
+    assert len(trees) == 30001
+    assert set(trees[:-1]) == {tree.strip()}
+    assert trees[-1] == "[end;]\n(d,e);"
+    assert [name for parent, length, name in treepl.parse_newick(trees[0]) if name] == ["a;b", "it's", "c"]
+    monkeypatch.setattr(sys, "stdin", open(str(tree_file)))
+    assert sum(1 for each in treepl.iter_newick("-")) == 30001
+
+
+def write_dated_trees(file_name, ages):
+    with open(file_name, "w") as write_file:
+        for ab, cd, root in ages.tolist():
+            write_file.write("((a:%r,b:%r):%r,(c:%r,d:%r):%r);\n" % (ab, ab, root - ab, cd, cd, root - cd))
+
+
+def read_summary(output):
+    with open(output + ".csv") as read_file:
+        header = read_file.readline().rstrip("\n").split(",")
+        return [dict(zip(header, each_line.rstrip("\n").split(","))) for each_line in read_file]
+
+
+@pytest.mark.parametrize("tree_num", [50, 3000])
+def test_summarize_trees(tmp_path, monkeypatch, tree_num):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(tree_num)
+    ages = np.column_stack([rng.uniform(1, 2, tree_num), rng.gamma(4, 0.25, tree_num), rng.uniform(3, 4, tree_num)])
+    os.mkdir("trees")
+    write_dated_trees(os.path.join("trees", "run1.tre"), ages[:tree_num // 2])
+    write_dated_trees(os.path.join("trees", "run2.tre"), ages[tree_num // 2:])
+    #叶节点不同的树不汇总
+    write_text(os.path.join("trees", "run3.tre"), "((a:1,b:1):1,(c:1,e:1):1);\n")
+    write_text(os.path.join("trees", "notes.txt"), "not a tree")
+    run_main(monkeypatch, "-a", "trees", "-o", "summary")
+    rows = {each["Clade"]: each for each in read_summary("summary") if each["Leaves"] != "1"}
+    for clade, node_ages in (("a..d", ages[:, 2]), ("a..b", ages[:, 0]), ("c..d", ages[:, 1])):
+        row = rows[clade]
+        assert int(row["Trees"]) == tree_num and float(row["Support"]) == 1.0
+        #Welford算法的平均值和标准差与直接计算的相同
+        assert float(row["Mean_age"]) == pytest.approx(node_ages.mean(), rel=1e-9)
+        assert float(row["SD_age"]) == pytest.approx(node_ages.std(ddof=1), rel=1e-9)
+        #数据少时分位数为准确值，数据多时P²的估计接近准确值
+        for column, p in (("Q2.5", 2.5), ("Q50", 50), ("Q97.5", 97.5)):
+            if tree_num < treepl.p2_buffer:
+                assert float(row[column]) == pytest.approx(np.percentile(node_ages, p), rel=1e-9)
+            else:
+                assert abs(float(row[column]) - np.percentile(node_ages, p)) < 0.03 * node_ages.std()
+    with open("summary.tre") as read_file:
+        summary_tree = read_file.read()
+    assert summary_tree.startswith("((a:") and "height_95%_quantile=" in summary_tree
+    #从标准输入读取时，没有-r的参考树(第一棵树)也参与汇总
+    write_text("all.tre", read_text(os.path.join("trees", "run1.tre")) + read_text(os.path.join("trees", "run2.tre")))
+    with open("all.tre") as read_file:
+        monkeypatch.setattr(sys, "stdin", read_file)
+        run_main(monkeypatch, "-a", "-", "-o", "stdin_summary")
+    assert read_summary("stdin_summary") == read_summary("summary")
+
+
+def test_summarize_without_trees(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("empty")
+    with pytest.raises(SystemExit) as exit_info:
+        run_main(monkeypatch, "-a", "empty")
+    assert exit_info.value.code == 1
+    assert "没有找到树文件" in capsys.readouterr().out
+    write_text("comment.tre", "[no trees here;]\n")
+    with pytest.raises(SystemExit) as exit_info:
+        run_main(monkeypatch, "-a", "comment.tre")
+    assert exit_info.value.code == 1
+    assert "comment.tre中没有树" in capsys.readouterr().out
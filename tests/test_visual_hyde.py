@@ -0,0 +1,474 @@
+import os
+import json
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+import visual_hyde as vh
+from conftest import tree_label
+
+
+#原来逐格查找的实现：先找[P1, P2]的检验，没有时用反向检验的1-γ，都没有时为0，
+#上三角为None
+def baseline_hotmap_table(Label, hybrid, hyde_table, zscore):
+  sub_table = hyde_table[(hyde_table["Hybrid"] == hybrid) & 
+                         (hyde_table["Zscore"] > zscore)]
+  df = pd.DataFrame(np.zeros((len(Label), len(Label))), index=Label, 
+                    columns=Label)
+  for i, each_index in enumerate(Label):
+    for j, each_column in enumerate(Label):
+      forward = sub_table[(sub_table["P1"] == each_index) & 
+                          (sub_table["P2"] == each_column)]["Gamma"]
+      reverse = sub_table[(sub_table["P1"] == each_column) & 
+                          (sub_table["P2"] == each_index)]["Gamma"]
+      if len(forward):
+        df.iat[i, j] = list(forward)[0]
+      elif len(reverse):
+        df.iat[i, j] = 1 - list(reverse)[0]
+      if j > i:
+        df.iat[i, j] = None
+  return df
+
+
+@pytest.mark.parametrize("zscore", [-np.inf, 0, 3])
+def test_gamma_tensor_matches_cell_lookup(hyde_table, zscore):
+  gamma_tensor = vh.make_gamma_tensor(tree_label, hyde_table, zscore)
+  assert gamma_tensor.dtype == np.float32
+  assert gamma_tensor.shape == (len(tree_label), 
+                                len(tree_label)*(len(tree_label) + 1)//2)
+  for k, hybrid in enumerate(tree_label):
+    expected = baseline_hotmap_table(tree_label, hybrid, hyde_table, zscore)
+    gamma_table = vh.unpack_gamma_table(gamma_tensor[k], len(tree_label))
+    #与float64的表格相比只差float32的舍入
+    np.testing.assert_array_equal(gamma_table.astype(np.float32), 
+      expected.to_numpy(dtype=float).astype(np.float32))
+    #hyde输出中只有4位小数的γ还原为原来的十进制数
+    forward = ~np.isnan(gamma_table) & np.isin(gamma_table, hyde_table["Gamma"])
+    np.testing.assert_array_equal(gamma_table[forward], 
+                                  expected.to_numpy(dtype=float)[forward])
+
+
+def test_hotmap_table_gamma(hyde_table):
+  expected = baseline_hotmap_table(tree_label, "t4", hyde_table, 3)
+  gamma_table = vh.make_hotmap_table_gamma(tree_label, "t4", hyde_table, 3)
+  assert list(gamma_table.index) == tree_label
+  assert list(gamma_table.columns) == tree_label
+  np.testing.assert_allclose(gamma_table.to_numpy(), expected.to_numpy(dtype=float), 
+                             rtol=0, atol=1e-7)
+
+
+def test_gamma_tensor_hybrid_list(hyde_table):
+  gamma_tensor = vh.make_gamma_tensor(tree_label, hyde_table, 3)
+  sub_tensor = vh.make_gamma_tensor(tree_label, hyde_table, 3, ["t6", "t2"])
+  np.testing.assert_array_equal(sub_tensor, gamma_tensor[[5, 1]])
+
+
+@pytest.fixture
+def hyde_file(tmp_path, hyde_table):
+  file_name = str(tmp_path / "hyde-out.txt")
+  hyde_table.to_csv(file_name, sep="\t", index=False)
+  return file_name
+
+
+def assert_same_hyde_table(hyde_table, expected):
+  assert len(hyde_table) == len(expected)
+  for each_column in ("P1", "Hybrid", "P2"):
+    assert list(hyde_table[each_column].astype(str)) == list(expected[each_column])
+  np.testing.assert_array_equal(hyde_table["Zscore"], expected["Zscore"])
+  assert hyde_table["Zscore"].dtype == np.float64
+  np.testing.assert_array_equal(hyde_table["Gamma"], 
+                                expected["Gamma"].astype(np.float32))
+
+
+def test_hyde_cache_round_trip(hyde_file, hyde_table, monkeypatch):
+  first = vh.load_hyde_output(hyde_file, 0)
+  assert_same_hyde_table(first, hyde_table[hyde_table["Zscore"] > 0])
+  assert os.path.exists(os.path.join(vh.get_hyde_cache_dir(hyde_file), "key.json"))
+  #第二次读取只用缓存，不再解析文本；阈值更高时也可以使用缓存
+  def no_parse(*args):
+    raise AssertionError("hyde output parsed again")
+  monkeypatch.setattr(vh, "parse_hyde_output", no_parse)
+  second = vh.load_hyde_output(hyde_file, 0)
+  assert_same_hyde_table(second, hyde_table[hyde_table["Zscore"] > 0])
+  assert len(vh.load_hyde_output(hyde_file, 3)) == len(second)
+
+
+def test_hyde_cache_invalidation(hyde_file, hyde_table):
+  vh.load_hyde_output(hyde_file, 3)
+  #缓存时的阈值高于需要的阈值，缓存中缺少行
+  assert vh.read_hyde_cache(hyde_file, 0) is None
+  assert vh.read_hyde_cache(hyde_file, 3) is not None
+  #hyde输出改变后缓存过期
+  hyde_table.iloc[:10].to_csv(hyde_file, sep="\t", index=False)
+  os.utime(hyde_file, ns=(0, 0))
+  assert vh.read_hyde_cache(hyde_file, 3) is None
+  assert_same_hyde_table(vh.load_hyde_output(hyde_file), hyde_table.iloc[:10])
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1000000])
+def test_parse_hyde_output_in_chunks(hyde_file, hyde_table, monkeypatch, chunk_size):
+  monkeypatch.setattr(vh, "hyde_chunk_size", chunk_size)
+  hyde_arrays = vh.parse_hyde_output(hyde_file, 3)
+  expected = hyde_table[hyde_table["Zscore"] > 3]
+  taxa = hyde_arrays["taxa"]
+  for each_column in ("P1", "Hybrid", "P2"):
+    assert hyde_arrays[each_column].dtype == np.int32
+    assert list(taxa[hyde_arrays[each_column]]) == list(expected[each_column])
+  np.testing.assert_array_equal(hyde_arrays["Gamma"], 
+                                expected["Gamma"].astype(np.float32))
+  #没有通过筛选的行中的物种名称也要收集，用于检查物种名称
+  assert set(taxa) == set(hyde_table[["P1", "Hybrid", "P2"]].to_numpy().ravel())
+
+
+def test_zscore_filter_in_float64(tmp_path):
+  #3.00000001和3.0000001在float32中都等于3.0
+  file_name = str(tmp_path / "hyde-out.txt")
+  pd.DataFrame({"P1": ["t1", "t1", "t2"], "Hybrid": ["t3", "t4", "t5"], 
+                "P2": ["t2", "t2", "t1"], 
+                "Zscore": [3.00000001, 3.0000001, 3.0], 
+                "Gamma": [0.28, 0.1, 0.3]}).to_csv(file_name, sep="\t", 
+                                                   index=False)
+  for cache in (True, True, False):
+    hyde_table = vh.load_hyde_output(file_name, 3, cache=cache)
+    assert list(hyde_table["Hybrid"].astype(str)) == ["t3", "t4"]
+  hyde_table = vh.load_hyde_output(file_name, cache=False)
+  assert list(hyde_table[hyde_table["Zscore"] > 3.00000001]["Hybrid"]
+              .astype(str)) == ["t4"]
+
+
+def test_gamma_table_csv_matches_input(tmp_path):
+  #γ保存为float32，写出的表格中仍为hyde输出中的十进制数
+  gamma = np.array([0, 0.28, 0.1, 1/3, 0.5, 0.2704918], dtype=np.float32)
+  table = pd.DataFrame(vh.unpack_gamma_table(gamma, 3), index=list("abc"), 
+                       columns=list("abc"))
+  table.to_csv(str(tmp_path / "gamma.csv"))
+  with open(str(tmp_path / "gamma.csv")) as read_file:
+    assert read_file.read() == (",a,b,c\na,0.0,,\nb,0.28,0.1,\n"
+                                "c,0.33333334,0.5,0.2704918\n")
+  np.testing.assert_array_equal(vh.widen_gamma(gamma).astype(np.float32), 
+                                gamma)
+
+
+#原来的节点叠加：对每个格子遍历节点之后的所有物种的表格
+def baseline_node_table(table_dict, each_node, Label):
+  leaves = each_node.get_leaf_names()
+  df = pd.DataFrame(np.zeros((len(Label), len(Label))), index=Label, 
+                    columns=Label)
+  for i, each_index in enumerate(Label):
+    for j, each_column in enumerate(Label):
+      if j > i:
+        df.iat[i, j] = None
+      if j > i or each_index in leaves or each_column in leaves:
+        continue
+      gamma_list = [table_dict[each].at[each_index, each_column] 
+                    for each in leaves]
+      left = sum(table_dict[each].at[each_index, each_column] 
+                 for each in each_node.children[0].get_leaf_names())
+      right = sum(table_dict[each].at[each_index, each_column] 
+                  for each in each_node.children[1].get_leaf_names())
+      non_gamma = [each for each in gamma_list if each == 0]
+      if left != 0 and right != 0 and len(non_gamma)/len(leaves) <= 0.5:
+        df.iat[i, j] = sum(gamma_list)/(len(gamma_list) - len(non_gamma) + 0.000001)
+  return df
+
+
+def test_node_stacks_match_per_cell_stacking(hyde_table, tree_file):
+  t, Label = vh.Tree(tree_file), tree_label
+  table_dict = {each: baseline_hotmap_table(Label, each, hyde_table, 1) 
+                for each in Label}
+  gamma_tensor = vh.make_gamma_tensor(Label, hyde_table, 1)
+  node_num = 0
+  for each_node, node_table in vh.find_common_hybrid_in_nodes(t, Label, gamma_tensor):
+    node_num += 1
+    expected = baseline_node_table(table_dict, each_node, Label)
+    np.testing.assert_allclose(node_table.to_numpy(), expected.to_numpy(dtype=float), 
+                               rtol=1e-6, atol=1e-6)
+  assert node_num == len(Label) - 1
+
+
+#不经过ete3渲染的树图：空白图片，每个分枝的标记位置按Label中的区间排列
+def make_test_tree_panel(Label):
+  position = {}
+  for start in range(len(Label)):
+    for end in range(start + 1, len(Label) + 1):
+      position[(start, end)] = (20*start + 10, 40*(start + end)/2)
+  return {"image": Image.new("RGB", (200, 40*len(Label)), "white"), 
+          "position": position, "face_size": 30}
+
+
+def make_test_draw_args(tile_size):
+  return {"tree_panel": make_test_tree_panel(tree_label), "Label": tree_label, 
+          "picture_size": 1000, "tile_size": tile_size}
+
+
+def make_figure_jobs(Label, hyde_table, tmp_path):
+  gamma_tensor = vh.make_gamma_tensor(Label, hyde_table, 1)
+  figure_jobs = [(str(tmp_path / each), k, 0, each) 
+                 for k, each in enumerate(Label)]
+  node_table = vh.make_hotmap_table_gamma(Label, "t3", hyde_table, 2)
+  figure_jobs.append((str(tmp_path / "node_1"), node_table, 1, Label[:3]))
+  return gamma_tensor, figure_jobs
+
+
+def read_output_files(out_dir):
+  output = {}
+  for root, dirs, files in os.walk(out_dir):
+    for each in files:
+      if each == vh.figure_manifest_file:
+        continue
+      with open(os.path.join(root, each), "rb") as read_file:
+        output[os.path.relpath(os.path.join(root, each), out_dir)] = read_file.read()
+  return output
+
+
+def test_figure_jobs_in_parallel(hyde_table, tmp_path, monkeypatch):
+  draw_args = make_test_draw_args(64)
+  for jobs in (1, 2):
+    out_dir = tmp_path / ("jobs" + str(jobs))
+    out_dir.mkdir()
+    #每次运行使用各自的记录文件，避免直接复制另一次运行画好的图
+    monkeypatch.chdir(out_dir)
+    gamma_tensor, figure_jobs = make_figure_jobs(tree_label, hyde_table, out_dir)
+    vh.run_figure_jobs(figure_jobs, gamma_tensor, tree_label, draw_args, jobs, 
+                       "run", False)
+  serial = read_output_files(tmp_path / "jobs1")
+  assert len(serial) > 9*4
+  assert serial == read_output_files(tmp_path / "jobs2")
+  #并行时的临时γ张量文件已删除
+  assert not [each for each in os.listdir(tmp_path / "jobs2") 
+              if each.endswith(".npy")]
+
+
+def test_render_hotmap_in_memory(hyde_table):
+  hotmap_renderer = vh.make_hotmap_renderer(len(tree_label))
+  gamma_table = vh.make_hotmap_table_gamma(tree_label, "t4", hyde_table, 1)
+  hotpic = vh.render_hotmap(gamma_table, hotmap_renderer)
+  assert hotpic.size == (6000, 6000)
+  #与原来保存为hotmap.png再读取的图像完全相同
+  png = BytesIO()
+  hotmap_renderer["canvas"].figure.savefig(png, format="png", dpi=200)
+  np.testing.assert_array_equal(np.array(hotpic), np.array(Image.open(png)))
+
+  #合并的图：左上为树图，热图缩小到树图的高度后放在树图右侧
+  tree_panel = make_test_tree_panel(tree_label)
+  treepic = vh.draw_tree(tree_panel, 0, "t4", tree_label)
+  combine = vh.make_combined_figure(treepic, hotpic.copy(), 1000)
+  width, height = treepic.size
+  assert combine.size == (width + height, width + height)
+  thumbnail = hotpic.copy()
+  thumbnail.thumbnail((height, height))
+  thumbnail = thumbnail.convert("RGB")
+  np.testing.assert_array_equal(
+    np.array(combine.crop((width - 10, 10, width - 10 + height, 10 + height))), 
+    np.array(thumbnail))
+  #树图的右边缘被热图覆盖
+  np.testing.assert_array_equal(np.array(combine.crop((10, 10, width - 10, 10 + height))), 
+                                np.array(treepic.crop((0, 0, width - 20, height))))
+
+
+def test_draw_tree_with_bitmap_font(monkeypatch):
+  tree_panel = make_test_tree_panel(tree_label)
+  expected = vh.draw_tree(tree_panel, 3, tree_label[3:5], tree_label)
+  #Pillow 10.1之前的点阵字体不支持anchor
+  draw_text = ImageDraw.ImageDraw.text
+  def old_text(self, xy, text, *args, **kwargs):
+    if kwargs.get("anchor") and not isinstance(kwargs.get("font"), ImageFont.FreeTypeFont):
+      raise ValueError("anchor not supported")
+    return draw_text(self, xy, text, *args, **kwargs)
+  monkeypatch.setattr(ImageDraw.ImageDraw, "text", old_text)
+  monkeypatch.setattr(vh, "get_face_font", lambda face_size: ImageFont.load_default_imagefont())
+  treepic = vh.draw_tree(tree_panel, 3, tree_label[3:5], tree_label)
+  box = vh.get_tree_marker(tree_panel, 3, tree_label[3:5], tree_label)[0]
+  marker = np.array(treepic.crop(tuple(int(each) for each in box)))
+  #标记中画出了黑色的节点编号，位于标记中部
+  text_rows = np.nonzero((marker.sum(axis=2) == 0).any(axis=1))[0]
+  assert len(text_rows)
+  assert abs((text_rows[0] + text_rows[-1])/2 - marker.shape[0]/2) <= 2
+  assert treepic.size == expected.size
+
+
+def test_hotmap_renderer_reuse(hyde_table):
+  first = vh.make_hotmap_table_gamma(tree_label, "t1", hyde_table, 1)
+  second = vh.make_hotmap_table_gamma(tree_label, "t6", hyde_table, 1)
+  hotmap_renderer = vh.make_hotmap_renderer(len(tree_label))
+  vh.render_hotmap(first, hotmap_renderer)
+  #重复使用的画布上不会残留上一张热图
+  np.testing.assert_array_equal(
+    np.array(vh.render_hotmap(second, hotmap_renderer)), 
+    np.array(vh.render_hotmap(second, vh.make_hotmap_renderer(len(tree_label)))))
+
+
+def test_update_skips_unchanged_figures(hyde_table, tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  draw_args = make_test_draw_args(64)
+  drawn = []
+  run_figure_job = vh.run_figure_job
+  def count_job(job):
+    drawn.append(os.path.basename(job[0]))
+    run_figure_job(job)
+  monkeypatch.setattr(vh, "run_figure_job", count_job)
+  gamma_tensor, figure_jobs = make_figure_jobs(tree_label, hyde_table, tmp_path)
+  vh.run_figure_jobs(figure_jobs, gamma_tensor, tree_label, draw_args, 1, "run", True)
+  assert len(drawn) == len(figure_jobs)
+
+  #输入没有变化时全部跳过
+  drawn.clear()
+  vh.run_figure_jobs(figure_jobs, gamma_tensor, tree_label, draw_args, 1, "run", True)
+  assert drawn == []
+  #γ表格改变、输出文件缺失或运行参数改变时重新绘制
+  gamma_tensor[2, 0] = 0.5
+  os.remove(str(tmp_path / "t5.csv"))
+  vh.run_figure_jobs(figure_jobs, gamma_tensor, tree_label, draw_args, 1, "run", True)
+  assert drawn == ["t3", "t5"]
+  drawn.clear()
+  vh.run_figure_jobs(figure_jobs, gamma_tensor, tree_label, draw_args, 1, "other", True)
+  assert len(drawn) == len(figure_jobs)
+  #不使用--update时全部重新绘制
+  drawn.clear()
+  vh.run_figure_jobs(figure_jobs, gamma_tensor, tree_label, draw_args, 1, "other", False)
+  assert len(drawn) == len(figure_jobs)
+
+
+@pytest.mark.parametrize("unique_tests", [False, True])
+def test_gamma_sweep_matches_each_threshold(hyde_table, tree_file, unique_tests):
+  if unique_tests:
+    #一次hyde运行的输出：每个杂交种和一对亲本只有一个检验，只需要阈值的掩码
+    pair = hyde_table[["P1", "P2"]].apply(sorted, axis=1, result_type="expand")
+    hyde_table = hyde_table[~pd.concat([hyde_table["Hybrid"], pair], axis=1).duplicated()]
+  zscore_list = [0, 1.5, 3, 6]
+  gamma_sweep = vh.make_gamma_sweep(tree_label, hyde_table, zscore_list, tree_label)
+  assert bool(gamma_sweep["exact_rows"]) != unique_tests
+  t = vh.Tree(tree_file)
+  for m, zscore in enumerate(zscore_list):
+    np.testing.assert_array_equal(vh.get_sweep_tensor(gamma_sweep, m), 
+      vh.make_gamma_tensor(tree_label, hyde_table, zscore))
+  #只遍历一次树得到的所有阈值的节点表格，与在每个阈值下分别叠加的结果相同
+  node_tables = list(vh.find_common_hybrid_in_nodes_sweep(t, tree_label, gamma_sweep))
+  for m, zscore in enumerate(zscore_list):
+    gamma_tensor = vh.make_gamma_tensor(tree_label, hyde_table, zscore)
+    for (each_node, table_list), (node, expected) in zip(
+        node_tables, vh.find_common_hybrid_in_nodes(t, tree_label, gamma_tensor)):
+      assert each_node is node
+      np.testing.assert_array_equal(table_list[m].to_numpy(), expected.to_numpy())
+
+
+def test_identical_figures_are_copied(hyde_table, tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  draw_args = make_test_draw_args(64)
+  drawn = []
+  run_figure_job = vh.run_figure_job
+  def count_job(job):
+    drawn.append(job[0])
+    run_figure_job(job)
+  monkeypatch.setattr(vh, "run_figure_job", count_job)
+  gamma_tensor = vh.make_gamma_tensor(tree_label, hyde_table, 1)
+  for each_dir in ("a", "b"):
+    (tmp_path / each_dir).mkdir()
+  #同一次运行中输入相同的图直接复制
+  figure_jobs = [(os.path.join(each_dir, "t2"), 1, 0, "t2") for each_dir in ("a", "b")]
+  vh.run_figure_jobs(figure_jobs, gamma_tensor, tree_label, draw_args, 1, "run", False)
+  assert drawn == [os.path.join("a", "t2")]
+  assert read_output_files(tmp_path / "a") == read_output_files(tmp_path / "b")
+  #不使用--update时不复制以前运行中画的图
+  drawn.clear()
+  (tmp_path / "c").mkdir()
+  vh.run_figure_jobs([(os.path.join("c", "t2"), 1, 0, "t2")], gamma_tensor, 
+                     tree_label, draw_args, 1, "run", False)
+  assert drawn == [os.path.join("c", "t2")]
+  drawn.clear()
+  (tmp_path / "d").mkdir()
+  vh.run_figure_jobs([(os.path.join("d", "t2"), 1, 0, "t2")], gamma_tensor, 
+                     tree_label, draw_args, 1, "run", True)
+  assert drawn == []
+  assert vh.read_figure_manifest()[os.path.join("d", "t2")] == \
+    vh.read_figure_manifest()[os.path.join("a", "t2")]
+
+
+def test_hotmap_tiles(hyde_table, tmp_path):
+  gamma_table = vh.make_hotmap_table_gamma(tree_label, "t5", hyde_table, 1)
+  fig_name = str(tmp_path / "t5")
+  vh.init_worker(None, tree_label, make_test_draw_args(32))
+  assert vh.worker_data["hotmap_renderer"] is None
+  vh.run_figure_job((fig_name, gamma_table, 0, "t5"))
+  #8个物种每格16像素，最高一层128x128，每层长宽减半直到1个像素
+  with open(fig_name + "_hotmap.dzi") as read_file:
+    dzi = read_file.read()
+  assert 'TileSize="32"' in dzi and 'Width="128" Height="128"' in dzi
+  levels = sorted(int(each) for each in os.listdir(fig_name + "_hotmap_files"))
+  assert levels == list(range(8))
+  assert len(os.listdir(fig_name + "_hotmap_files/7")) == 16
+  assert len(os.listdir(fig_name + "_hotmap_files/5")) == 1
+  #最高一层每个像素的颜色就是其所在格子的颜色，网格线为黑色
+  i, j = np.argwhere(np.nan_to_num(gamma_table.to_numpy()) != 0)[0]
+  y, x = i*16 + 8, j*16 + 8
+  tile = np.array(Image.open(fig_name + "_hotmap_files/7/" + str(x//32) + "_" + 
+                             str(y//32) + ".png"))
+  rgba = np.array(vh.hotmap_cmap(gamma_table.iat[i, j], bytes=True), dtype=float)
+  expected = rgba[:3]*rgba[3]/255 + 255*(1 - rgba[3]/255)
+  np.testing.assert_array_equal(tile[y % 32, x % 32], expected.astype(np.uint8))
+  assert (tile[y % 32 - 8, :] == 0).all()
+  with open(fig_name + ".json") as read_file:
+    tile_index = json.load(read_file)
+  assert tile_index["hotmap"] == "t5_hotmap.dzi"
+  assert tile_index["taxa"] == tree_label
+  assert tile_index["tree_marker"]["text"] == "o"
+
+
+def test_packed_lower_triangle():
+  len_Label = 7
+  row, col = np.tril_indices(len_Label)
+  np.testing.assert_array_equal(vh.get_packed_index(row, col), 
+                                np.arange(len(row)))
+  table = np.random.default_rng(1).random((len_Label, len_Label))
+  gamma_table = vh.unpack_gamma_table(table[row, col], len_Label)
+  np.testing.assert_array_equal(np.tril(gamma_table).astype(np.float32), 
+                                np.tril(table).astype(np.float32))
+  assert np.isnan(gamma_table[np.triu_indices(len_Label, 1)]).all()
+
+
+def test_hybrid_blocks(tree_file, tmp_path):
+  clade_interval = sorted(set(vh.make_clade_index(vh.Tree(tree_file), tree_label).values()))
+  gamma_table = vh.unpack_gamma_table(np.zeros(36), len(tree_label))
+  #(t4, t5)与(t2, t3)两个分枝围成的色块，以及两个零散的格子
+  gamma_table[3:5, 1:3] = 0.3
+  gamma_table[7, 0] = 0.9
+  gamma_table[6, 5] = 0.8
+  blocks = vh.find_hybrid_blocks("t1", gamma_table, clade_interval, tree_label, 0.5)
+  assert (blocks["Cells"] > 1).all()
+  vh.write_hybrid_blocks(str(tmp_path / "blocks.csv"), [blocks])
+  blocks = pd.read_csv(tmp_path / "blocks.csv")
+  first = blocks.iloc[0]
+  assert (first["P1_clade"], first["P2_clade"]) == ("t4..t5", "t2..t3")
+  assert (first["Cells"], first["Detected"], first["Coverage"]) == (4, 4, 1)
+  assert first["Mean_gamma"] == pytest.approx(0.3)
+  assert (blocks["Detected"].diff().dropna() <= 0).all()
+  #min_cells为1时单个格子也会作为色块
+  blocks = vh.find_hybrid_blocks("t1", gamma_table, clade_interval, tree_label, 0.5, 1)
+  assert ((blocks["P1_clade"] == "t8") & (blocks["P2_clade"] == "t1")).any()
+
+
+def test_api_writes_no_files(hyde_file, hyde_table, tree_file, tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  before = sorted(os.listdir(tmp_path))
+  gamma_result = vh.compute_gamma_tensor(tree_file, hyde_file, 1)
+  node_tables = list(vh.compute_node_tables(tree_file, gamma_result))
+  assert sorted(os.listdir(tmp_path)) == before
+  assert len(node_tables) == len(tree_label) - 1
+  #DataFrame与文件的结果相同
+  from_table = vh.compute_gamma_tensor(tree_file, hyde_table, 1)
+  np.testing.assert_allclose(gamma_result["gamma_tensor"], from_table["gamma_tensor"], 
+                             atol=1e-6)
+  np.testing.assert_array_equal(vh.get_gamma_table(gamma_result, "t3").to_numpy(), 
+    vh.unpack_gamma_table(gamma_result["gamma_tensor"][2], len(tree_label)))
+  #指定cache=True时与命令行相同写出缓存
+  vh.compute_gamma_tensor(tree_file, hyde_file, 1, cache=True)
+  assert os.path.isdir(vh.get_hyde_cache_dir(hyde_file))
+
+  vh.save_gamma_tensor(str(tmp_path / "gamma.npy"), gamma_result)
+  loaded = vh.load_gamma_tensor(str(tmp_path / "gamma.npy"))
+  assert isinstance(loaded["gamma_tensor"], np.memmap)
+  assert loaded["taxa"] == gamma_result["taxa"]
+  np.testing.assert_array_equal(loaded["gamma_tensor"], gamma_result["gamma_tensor"])
@@ -1,10 +1,18 @@
 from multiprocessing import Pool
-import os, time, random
+import os, re, sys, math, time, json, bisect, hashlib, argparse, itertools, subprocess
+from newick_io import iter_newick, get_tree_files
 
 '''
-首先定义需要的进程数th
+记录每个配置文件运行结果的文件，重新运行时跳过已经成功完成的配置文件
 '''
-th = 30
+manifest_file = "treepl_manifest.json"
+
+
+'''
+prime结果的缓存文件，以及去掉prime、加入prime结果后的配置文件所在的文件夹
+'''
+prime_cache_file = "treepl_prime_cache.json"
+primed_dir = "treepl_primed"
 
 
 '''
@@ -15,45 +23,660 @@ th = 30
 def get_file_list():      
     file_name = []       
     for each in os.listdir(os.getcwd()):        
-        if ".conf" in each:
+        if each.endswith(".conf"):
             file_name.append(each)
     return file_name
 
+
+'''
+函数 parse_conf_lines / read_conf: 解析treePL配置文件的各行，"#"之后为注释
+输入 lines: 配置文件的各行；conf_file: 配置文件的名称
+输出 conf_list: 按顺序排列的(选项, 值)的列表，没有值的选项(如prime、cv)的值为None
 '''
-函数 get_th_list: 将所有文件平均的分给各个进程
-输入 file_name: 所有文件的名称列表
-输出 th_list： 一个列表，列表中的各个元素为各个进程所应该处理的文件
-'''
-def get_th_list(file_name):
-    th_list = []
-    for each_num in range(th):
-        th_list.append([])
-    print("本程序共使用 " + str(len(th_list)) + " 个进程")
-    n = 0
-    for each_file in file_name:       
-        th_list[n].append(each_file)
-        if n == th - 1:
-            n = 0
+def parse_conf_lines(lines):
+    conf_list = []
+    for each_line in lines:
+        line = each_line.split("#")[0].strip()
+        if not line:
+            continue
+        if "=" in line:
+            key, value = line.split("=", 1)
+            conf_list.append((key.strip(), value.strip()))
         else:
-            n = n + 1
-    return th_list
+            conf_list.append((line, None))
+    return conf_list
+
+def read_conf(conf_file):
+    with open(conf_file, "r") as read_file:
+        return parse_conf_lines(read_file)
+
+
+'''
+函数 estimate_cost: 估计一个配置文件的运行时间，为树中的物种数乘以位点数
+输入 conf_file: 配置文件的名称
+输出 一个数值，越大表示运行时间越长
+'''
+def estimate_cost(conf_file):
+    conf_dict = dict(read_conf(conf_file))
+    taxa_num = 1
+    treefile = conf_dict.get("treefile")
+    if treefile and os.path.exists(treefile):
+        with open(treefile, "r") as read_file:
+            for each_block in iter(lambda: read_file.read(1 << 20), ""):
+                taxa_num = taxa_num + each_block.count(",")
+    try:
+        numsites = float(conf_dict.get("numsites") or 1)
+    except ValueError:
+        numsites = 1
+    return taxa_num * numsites
+
+
+'''
+函数 get_conf_hash: 配置文件内容的哈希值，配置文件改变后需要重新运行
+输入 conf_file: 配置文件的名称
+输出 哈希值
+'''
+def get_conf_hash(conf_file):
+    with open(conf_file, "rb") as read_file:
+        return hashlib.sha1(read_file.read()).hexdigest()
+
+
+'''
+函数 main_software: 在配置文件所在的文件夹中运行一个treePL，配置文件中的相对路径以该文件夹为准，
+输出写入"<配置文件>.log"
+输入 conf_file: 配置文件的名称
+输出 配置文件的名称、treePL的返回值、运行时间(秒)以及内存峰值(MB，无法获取时为None)
+'''
+def main_software(conf_file):
+    start_time = time.time()
+    peak_rss = None
+    run_dir = os.path.dirname(conf_file) or None
+    with open(conf_file + ".log", "w") as log_file:
+        try:
+            process = subprocess.Popen(["treePL", os.path.basename(conf_file)], stdout=log_file, stderr=subprocess.STDOUT, cwd=run_dir)
+        except OSError as error:
+            log_file.write(str(error) + "\n")
+            return conf_file, 127, time.time() - start_time, peak_rss
+        if hasattr(os, "wait4"):
+            #wait4可以得到这一个子进程的资源使用情况，Linux中ru_maxrss的单位为KB
+            pid, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            peak_rss = rusage.ru_maxrss / 1024
+        else:
+            process.wait()
+    return conf_file, process.returncode, time.time() - start_time, peak_rss
+
+
+'''
+函数 read_manifest / write_manifest: 读取和写出运行记录，先写入临时文件再替换，
+程序中途退出时不会留下不完整的记录文件
+'''
+def read_manifest():
+    try:
+        with open(manifest_file, "r") as read_file:
+            return json.load(read_file)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(manifest):
+    with open(manifest_file + ".tmp", "w") as write_file:
+        json.dump(manifest, write_file, indent=1)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+'''
+函数 run_treepl_queue: 用jobs个进程运行所有的配置文件。预计运行时间长的配置文件
+先运行，每个进程完成一个配置文件后再取下一个。每完成一个配置文件就把返回值、运行
+时间和内存峰值记录到manifest_file中，已经成功完成且内容没有改变的配置文件不再运行
+输入 file_name: 所有配置文件的名称列表；jobs: 进程数
+输出 运行失败的配置文件的列表
+'''
+def run_treepl_queue(file_name, jobs):
+    manifest = read_manifest()
+    pending = []
+    for each_file in file_name:
+        record = manifest.get(each_file)
+        if record and record["exit_code"] == 0 and record["conf_hash"] == get_conf_hash(each_file):
+            continue
+        pending.append(each_file)
+    pending.sort(key=estimate_cost, reverse=True)
+    print("共 " + str(len(file_name)) + " 个配置文件，其中 " + str(len(file_name) - len(pending)) + " 个已经完成，使用 " + str(jobs) + " 个进程运行其余的配置文件")
+
+    failed = []
+    print("----start----")
+    with Pool(jobs) as p:
+        for finished_num, (conf_file, exit_code, wall_time, peak_rss) in enumerate(p.imap_unordered(main_software, pending), 1):
+            manifest[conf_file] = {"exit_code": exit_code, "wall_time": round(wall_time, 3), "peak_rss_mb": peak_rss, "conf_hash": get_conf_hash(conf_file)}
+            write_manifest(manifest)
+            if exit_code != 0:
+                failed.append(conf_file)
+            print(conf_file + " exit code " + str(exit_code) + ", " + str(round(wall_time, 1)) + " s " + str(finished_num) + "/" + str(len(pending)))
+    print("-----end-----")
+    if failed:
+        print("以下配置文件运行失败，详见对应的.log文件：" + ", ".join(failed))
+    return failed
+
+
+'''
+函数 write_conf: 写出treePL的配置文件
+输入 conf_list: (选项, 值)的列表；conf_file: 配置文件的名称
+输出 无
+'''
+def write_conf(conf_list, conf_file):
+    with open(conf_file, "w") as write_file:
+        for key, value in conf_list:
+            if value is None:
+                write_file.write(key + "\n")
+            else:
+                write_file.write(key + " = " + value + "\n")
+
+
+'''
+平滑参数扫描时由扫描设定的选项，模板中的这些选项会被去掉
+'''
+sweep_keys = ("smooth", "opt", "optad", "optcvad", "cv", "randomcv", "cvstart", "cvstop", "cvmultstep", "cvoutfile", "prime")
+
+
+'''
+函数 make_sweep_conf: 由模板生成扫描中一个格点的配置文件，只对一个smooth值做交叉验证。
+treefile改为绝对路径，其他输出都写在格点自己的文件夹中
+输入 template_list: 模板的(选项, 值)列表；run_dir: 格点的文件夹；smooth、opt、optad、optcvad:
+     格点的参数，opt、optad、optcvad为None时使用模板中的值
+输出 配置文件的名称
+'''
+def make_sweep_conf(template_list, run_dir, smooth, opt, optad, optcvad):
+    template_dict = dict(template_list)
+    conf_list = []
+    for key, value in template_list:
+        if key == "treefile":
+            value = os.path.abspath(value)
+        if key not in sweep_keys:
+            conf_list.append((key, value))
+    for key, value in (("opt", opt), ("optad", optad), ("optcvad", optcvad)):
+        if value is None:
+            value = template_dict.get(key)
+        if value is not None:
+            conf_list.append((key, value))
+    conf_list.extend([("cv", None), ("cvstart", repr(smooth)), ("cvstop", repr(smooth)), ("cvmultstep", "0.1"), ("cvoutfile", "cv.out")])
+    os.makedirs(run_dir, exist_ok=True)
+    conf_file = os.path.join(run_dir, "sweep.conf")
+    write_conf(conf_list, conf_file)
+    return conf_file
+
+
+'''
+函数 read_cv_score: 读取treePL交叉验证的结果，每行的格式为"chisq: (smooth) score"
+输入 run_dir: 格点的文件夹
+输出 交叉验证的得分(越小越好)，没有结果时为nan
+'''
+def read_cv_score(run_dir):
+    try:
+        with open(os.path.join(run_dir, "cv.out"), "r") as read_file:
+            scores = re.findall(r"\(\s*([-+\d.eE]+)\s*\)\s*([-+\d.eE]+)", read_file.read())
+    except OSError:
+        return float("nan")
+    if not scores:
+        return float("nan")
+    return min(float(score) for smooth, score in scores)
+
+
+'''
+函数 run_sweep: smooth与opt、optad、optcvad的网格扫描。先对所有的组合做粗扫描，最好得分比
+全部组合的最好得分差prune倍以上的opt、optad、optcvad组合被淘汰；其余的组合在各自最好的smooth
+值与相邻的smooth值之间(对数尺度)各插入fine个smooth值再做细扫描。每个格点在"<模板>_sweep"中有
+自己的文件夹，由run_treepl_queue运行，中途退出后可以继续。所有格点的结果写入"<模板>_sweep.csv"
+输入 template: 模板配置文件；smooth_list、opt_list、optad_list、optcvad_list: 参数的取值，
+     后三者为空时使用模板中的值；fine: 细扫描插入的smooth值个数；prune: 淘汰的倍数；jobs: 进程数
+输出 得分最好的格点，没有任何结果时为None
+'''
+def run_sweep(template, smooth_list, opt_list, optad_list, optcvad_list, fine, prune, jobs):
+    template_list = read_conf(template)
+    sweep_dir = template.replace(".conf", "") + "_sweep"
+    smooth_list = sorted(smooth_list)
+    combo_list = list(itertools.product(opt_list or [None], optad_list or [None], optcvad_list or [None]))
+
+    def make_point(sweep_pass, smooth, combo):
+        name = sweep_pass + "_s" + repr(smooth) + "".join("_" + key + value for key, value in zip(("opt", "optad", "optcvad"), combo) if value is not None)
+        run_dir = os.path.join(sweep_dir, name)
+        return {"pass": sweep_pass, "smooth": smooth, "combo": combo, "run_dir": run_dir, "conf": make_sweep_conf(template_list, run_dir, smooth, *combo)}
+
+    def run_points(point_list):
+        run_treepl_queue([each["conf"] for each in point_list], jobs)
+        manifest = read_manifest()
+        for each in point_list:
+            record = manifest.get(each["conf"], {})
+            each["score"] = read_cv_score(each["run_dir"])
+            each["exit_code"] = record.get("exit_code")
+            each["wall_time"] = record.get("wall_time")
+
+    #粗扫描
+    coarse = [make_point("coarse", smooth, combo) for combo in combo_list for smooth in smooth_list]
+    run_points(coarse)
+    best_score = {}
+    for each in coarse:
+        if not math.isnan(each["score"]) and each["score"] < best_score.get(each["combo"], (math.inf, None))[0]:
+            best_score[each["combo"]] = (each["score"], each["smooth"])
+
+    #细扫描
+    fine_points = []
+    if best_score:
+        overall_best = min(score for score, smooth in best_score.values())
+        for combo, (score, smooth) in best_score.items():
+            if score > overall_best * prune:
+                print("淘汰 opt/optad/optcvad = " + str(combo) + "，最好的得分为 " + str(score))
+                continue
+            position = smooth_list.index(smooth)
+            for neighbour in smooth_list[max(position - 1, 0):position + 2]:
+                if neighbour == smooth or neighbour <= 0 or smooth <= 0:
+                    continue
+                for k in range(1, fine + 1):
+                    fine_smooth = float("%.6g" % math.exp(math.log(smooth) + (math.log(neighbour) - math.log(smooth)) * k / (fine + 1)))
+                    fine_points.append(make_point("fine", fine_smooth, combo))
+        run_points(fine_points)
 
+    with open(sweep_dir + ".csv", "w") as write_file:
+        write_file.write("Pass,Smooth,Opt,Optad,Optcvad,CV_score,Exit_code,Wall_time,Run_dir\n")
+        for each in coarse + fine_points:
+            write_file.write(",".join("" if value is None else str(value) for value in [each["pass"], each["smooth"], *each["combo"], each["score"], each["exit_code"], each["wall_time"], each["run_dir"]]) + "\n")
+    finished = [each for each in coarse + fine_points if not math.isnan(each["score"])]
+    if not finished:
+        print("没有得到任何交叉验证的结果，详见" + sweep_dir + "中的.log文件")
+        return None
+    best = min(finished, key=lambda each: each["score"])
+    print("最好的格点：smooth = " + repr(best["smooth"]) + "，opt/optad/optcvad = " + str(best["combo"]) + "，得分 " + str(best["score"]))
+    return best
+
+
+'''
+配置文件中的路径选项，以及prime给出的、需要写入配置文件的选项
+'''
+path_keys = ("treefile", "outfile", "cvoutfile")
+prime_keys = ("opt", "optad", "optcvad", "moredetail", "moredetailad", "moredetailcvad")
+
+
+'''
+函数 get_prime_key: 树文件的内容、校准点(mrca、min、max)和位点数相同的配置文件，prime的结果相同
+输入 conf_list: 配置文件的(选项, 值)列表，没有treefile时引发KeyError，树文件无法读取时引发OSError
+输出 哈希值
+'''
+def get_prime_key(conf_list):
+    prime_hash = hashlib.sha1()
+    conf_dict = dict(conf_list)
+    with open(conf_dict["treefile"], "rb") as read_file:
+        for each_block in iter(lambda: read_file.read(1 << 20), b""):
+            prime_hash.update(each_block)
+    for key, value in conf_list:
+        if key in ("mrca", "min", "max", "numsites"):
+            prime_hash.update(("\n" + key + " = " + " ".join(str(value).split())).encode())
+    return prime_hash.hexdigest()
+
+
+'''
+函数 read_prime_lines: 从treePL的输出中读取prime给出的设置，
+即"PLACE THE LINES BELOW IN THE CONFIG FILE"之后的各行
+输入 log_file: treePL输出的文件
+输出 (选项, 值)的列表，没有找到时为None
+'''
+def read_prime_lines(log_file):
+    try:
+        with open(log_file, "r") as read_file:
+            log_lines = read_file.read().splitlines()
+    except OSError:
+        return None
+    for i, each_line in enumerate(log_lines):
+        if "PLACE THE LINES BELOW IN THE CONFIG FILE" in each_line:
+            prime_lines = []
+            for each in parse_conf_lines(log_lines[i + 1:]):
+                if each[0] not in prime_keys:
+                    break
+                prime_lines.append(each)
+            return prime_lines or None
+    return None
+
+
+'''
+函数 make_conf_copy: 复制配置文件到primed_dir中，路径改为绝对路径
+输入 conf_list: 配置文件的(选项, 值)列表；conf_file: 新配置文件的名称；prime_lines: 为None时
+     保留prime，否则去掉prime和原有的prime_keys，加入prime_lines
+输出 新配置文件的名称
+'''
+def make_conf_copy(conf_list, conf_file, prime_lines=None):
+    new_list = []
+    for key, value in conf_list:
+        if key in path_keys:
+            value = os.path.abspath(value)
+        if prime_lines is not None and (key == "prime" or key in prime_keys):
+            continue
+        new_list.append((key, value))
+    if prime_lines is not None:
+        new_list.extend(prime_lines)
+    os.makedirs(primed_dir, exist_ok=True)
+    write_conf(new_list, conf_file)
+    return conf_file
+
+
+'''
+函数 prime_configs: 含有prime的配置文件按get_prime_key分组，每组只运行一次prime，结果记录在
+prime_cache_file中；这些配置文件替换为primed_dir中去掉prime、加入prime结果的配置文件。
+没有treefile或树文件无法读取的配置文件作为配置错误报告，原样交给treePL运行
+输入 file_name: 所有配置文件的名称列表；jobs: 进程数
+输出 需要运行的配置文件的列表，以及prime失败的配置文件的列表
+'''
+def prime_configs(file_name, jobs):
+    try:
+        with open(prime_cache_file, "r") as read_file:
+            prime_cache = json.load(read_file)
+    except (OSError, ValueError):
+        prime_cache = {}
+    group = {}
+    run_list = []
+    conf_errors = []
+    for each_file in file_name:
+        conf_list = read_conf(each_file)
+        if "prime" not in dict(conf_list):
+            run_list.append(each_file)
+            continue
+        try:
+            prime_key = get_prime_key(conf_list)
+        except (KeyError, OSError):
+            #没有treefile或树文件无法读取时不能分组，不使用缓存，由treePL直接运行并报告错误
+            conf_errors.append(each_file)
+            run_list.append(each_file)
+            continue
+        group.setdefault(prime_key, []).append((each_file, conf_list))
+    if conf_errors:
+        print("以下配置文件含有prime但没有treefile或树文件无法读取，不使用prime缓存：" + ", ".join(conf_errors))
+
+    #每组用第一个配置文件运行prime
+    pending = {}
+    for key, conf_group in group.items():
+        if key not in prime_cache:
+            each_file, conf_list = conf_group[0]
+            pending[make_conf_copy(conf_list, os.path.join(primed_dir, each_file.replace(".conf", ".prime.conf")))] = key
+    print("共 " + str(sum(len(each) for each in group.values())) + " 个配置文件含有prime，分为 " + str(len(group)) + " 组，需要运行 " + str(len(pending)) + " 次prime")
+    if pending:
+        with Pool(jobs) as p:
+            for conf_file, exit_code, wall_time, peak_rss in p.imap_unordered(main_software, sorted(pending, key=estimate_cost, reverse=True)):
+                prime_lines = read_prime_lines(conf_file + ".log")
+                print(conf_file + " exit code " + str(exit_code) + ", " + str(round(wall_time, 1)) + " s")
+                if exit_code == 0 and prime_lines:
+                    prime_cache[pending[conf_file]] = {"conf": conf_file, "lines": prime_lines}
+                    with open(prime_cache_file + ".tmp", "w") as write_file:
+                        json.dump(prime_cache, write_file, indent=1)
+                    os.replace(prime_cache_file + ".tmp", prime_cache_file)
+
+    failed = []
+    for key, conf_group in group.items():
+        for each_file, conf_list in conf_group:
+            if key not in prime_cache:
+                failed.append(each_file)
+                continue
+            prime_lines = [tuple(each) for each in prime_cache[key]["lines"]]
+            run_list.append(make_conf_copy(conf_list, os.path.join(primed_dir, each_file), prime_lines))
+    if failed:
+        print("以下配置文件的prime运行失败，详见" + primed_dir + "中对应的.log文件：" + ", ".join(failed))
+    return run_list, failed
+
+
+'''
+Newick的词法单元：带引号的名称、注释、括号逗号冒号分号、其他名称或数值
+'''
+newick_token = re.compile(r"\s*('(?:[^']|'')*'|\[[^\]]*\]|[(),:;]|[^\s(),:;\[\]']+)")
+
+
+'''
+函数 parse_newick: 不构建节点对象，直接解析Newick字符串
+输入 newick: Newick字符串
+输出 nodes: 按先序排列的节点列表，每个节点为[父节点的序号, 枝长, 名称]，根节点的父节点为-1，
+     内部节点的名称为None
+'''
+def parse_newick(newick):
+    nodes = []
+    stack = []
+    current = -1
+    previous = "("
+    for token in newick_token.findall(newick):
+        if token == "(":
+            nodes.append([stack[-1] if stack else -1, 0.0, None])
+            stack.append(len(nodes) - 1)
+        elif token == ")":
+            current = stack.pop()
+        elif token in (",", ";") or token.startswith("["):
+            pass
+        elif token == ":":
+            pass
+        elif previous == ":":
+            nodes[current][1] = float(token)
+        elif previous in ("(", ","):
+            #叶节点
+            nodes.append([stack[-1] if stack else -1, 0.0, token.strip("'").replace("''", "'")])
+            current = len(nodes) - 1
+        if not token.startswith("["):
+            previous = token
+    if stack:
+        raise ValueError("括号不匹配：" + newick[:50])
+    return nodes
+
+
+'''
+函数 get_node_ages: 计算每个节点的分支(以叶节点序号的位集合表示)和年龄，
+年龄为到根节点距离最远的叶节点与该节点到根节点距离之差
+输入 nodes: parse_newick的结果；leaf_index: 叶节点名称到序号的字典
+输出 node_bits: 每个节点的位集合；node_ages: 每个节点的年龄
+'''
+def get_node_ages(nodes, leaf_index):
+    node_bits = [0] * len(nodes)
+    depths = [0.0] * len(nodes)
+    for i, (parent, length, name) in enumerate(nodes):
+        depths[i] = (depths[parent] if parent >= 0 else 0.0) + length
+        if name is not None:
+            node_bits[i] = 1 << leaf_index[name]
+    for i in range(len(nodes) - 1, 0, -1):
+        node_bits[nodes[i][0]] |= node_bits[i]
+    max_depth = max(depths)
+    return node_bits, [max_depth - each for each in depths]
+
+
+'''
+函数 p2_init / p2_add / p2_value: P²算法(Jain & Chlamtac 1985)，只用5个标记估计分位数，
+内存与数据量无关。数据少时P²的误差较大，前p2_buffer个数据直接保存并计算准确的分位数，
+之后用这些数据中对应位置的值作为5个标记的初始值
+输入 p: 分位数(0-1)；state: p2_init的结果；x: 新的数据
+输出 p2_value输出分位数的估计值
+'''
+p2_buffer = 101
+
+def p2_init(p):
+    return {"p": p, "q": [], "n": None, "np": None, "dn": [0, p / 2, p, (1 + p) / 2, 1]}
+
+def p2_add(state, x):
+    q, n = state["q"], state["n"]
+    if n is None:
+        bisect.insort(q, x)
+        if len(q) == p2_buffer:
+            m = p2_buffer - 1
+            state["np"] = [m * each for each in state["dn"]]
+            state["n"] = [int(round(each)) for each in state["np"]]
+            state["q"] = [q[each] for each in state["n"]]
+        return
+    if x < q[0]:
+        q[0] = x
+        k = 0
+    elif x >= q[4]:
+        q[4] = x
+        k = 3
+    else:
+        k = 0
+        while x >= q[k + 1]:
+            k = k + 1
+    for i in range(k + 1, 5):
+        n[i] = n[i] + 1
+    for i in range(5):
+        state["np"][i] = state["np"][i] + state["dn"][i]
+    for i in range(1, 4):
+        d = state["np"][i] - n[i]
+        if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+            d = 1 if d > 0 else -1
+            #抛物线插值，超出相邻标记时改为线性插值
+            qp = q[i] + d / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+            if not q[i - 1] < qp < q[i + 1]:
+                qp = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+            q[i] = qp
+            n[i] = n[i] + d
+
+def p2_value(state):
+    q = state["q"]
+    if not q:
+        return float("nan")
+    if state["n"] is None:
+        position = state["p"] * (len(q) - 1)
+        low = int(position)
+        high = min(low + 1, len(q) - 1)
+        return q[low] + (q[high] - q[low]) * (position - low)
+    return q[2]
+
+
+'''
+汇总时估计的分位数
+'''
+summary_quantiles = (0.025, 0.5, 0.975)
+
+
+'''
+函数 summarize_trees: 逐棵读取定年的树，按参考树的拓扑汇总每个节点的年龄。每个分支以
+叶节点集合的位集合为键，用Welford算法在线计算年龄的平均值和方差，用P²算法估计分位数，
+内存只与参考树的节点数有关，与树的数量无关。结果写入"<output>.tre"(FigTree可以读取的
+带注释的树，枝长由平均年龄计算)和"<output>.csv"
+输入 tree_files: 树文件的列表；reference_file: 参考树，为None时使用第一棵树；output: 输出文件的前缀
+输出 汇总的树的数量，没有树文件或参考树文件中没有树时引发ValueError。标准输入("-")只能读取
+一次，没有参考树时第一棵树从同一个读取中取出后仍然参与汇总
+'''
+def summarize_trees(tree_files, reference_file, output):
+    if not tree_files:
+        raise ValueError("没有找到树文件")
+    tree_iters = [iter_newick(each_file) for each_file in tree_files]
+    if reference_file is None:
+        reference_file = tree_files[0]
+        reference = next(tree_iters[0], None)
+        if reference is not None:
+            tree_iters[0] = itertools.chain([reference], tree_iters[0])
+    elif reference_file == "-" and "-" in tree_files:
+        raise ValueError("参考树和树文件不能都从标准输入读取")
+    else:
+        reference = next(iter_newick(reference_file), None)
+    if reference is None:
+        raise ValueError(reference_file + "中没有树")
+    reference = parse_newick(reference)
+    leaf_names = [name for parent, length, name in reference if name is not None]
+    leaf_index = {name: i for i, name in enumerate(leaf_names)}
+    if len(leaf_index) != len(leaf_names):
+        raise ValueError("参考树中有重复的叶节点名称")
+    reference_bits = get_node_ages(reference, leaf_index)[0]
+    all_bits = (1 << len(leaf_names)) - 1
+    summary = {bits: {"n": 0, "mean": 0.0, "m2": 0.0, "quantiles": [p2_init(p) for p in summary_quantiles]} for bits in reference_bits}
+
+    tree_num = 0
+    skipped = 0
+    for each_tree in itertools.chain.from_iterable(tree_iters):
+        nodes = parse_newick(each_tree)
+        try:
+            node_bits, node_ages = get_node_ages(nodes, leaf_index)
+        except KeyError:
+            skipped = skipped + 1
+            continue
+        if node_bits[0] != all_bits:
+            skipped = skipped + 1
+            continue
+        tree_num = tree_num + 1
+        for bits, age in zip(node_bits, node_ages):
+            record = summary.get(bits)
+            if record is None:
+                continue
+            record["n"] = record["n"] + 1
+            delta = age - record["mean"]
+            record["mean"] = record["mean"] + delta / record["n"]
+            record["m2"] = record["m2"] + delta * (age - record["mean"])
+            for each_quantile in record["quantiles"]:
+                p2_add(each_quantile, age)
+    if skipped:
+        print("跳过了 " + str(skipped) + " 棵叶节点与参考树不同的树")
+    print("共汇总 " + str(tree_num) + " 棵树")
+
+    def get_stats(bits):
+        record = summary[bits]
+        sd = math.sqrt(record["m2"] / (record["n"] - 1)) if record["n"] > 1 else 0.0
+        return record["n"], record["mean"], sd, [p2_value(each) for each in record["quantiles"]]
+
+    with open(output + ".csv", "w") as write_file:
+        write_file.write("Node,Clade,Leaves,Trees,Support,Mean_age,SD_age," + ",".join("Q" + str(p * 100).rstrip("0").rstrip(".") for p in summary_quantiles) + "\n")
+        for i, bits in enumerate(reference_bits):
+            clade = [leaf_names[k] for k in range(len(leaf_names)) if bits >> k & 1]
+            n, mean, sd, quantiles = get_stats(bits)
+            write_file.write(",".join(str(each) for each in [i, clade[0] + ".." + clade[-1], len(clade), n, n / tree_num if tree_num else 0, mean, sd] + quantiles) + "\n")
+
+    #按参考树的拓扑写出带注释的树
+    children = [[] for each in reference]
+    for i, (parent, length, name) in enumerate(reference):
+        if parent >= 0:
+            children[parent].append(i)
+    def write_node(i):
+        n, mean, sd, quantiles = get_stats(reference_bits[i])
+        if reference[i][2] is not None:
+            text = reference[i][2]
+        else:
+            text = "(" + ",".join(write_node(child) for child in children[i]) + ")"
+            text = text + "[&height=%g,height_sd=%g,height_median=%g,height_95%%_quantile={%g,%g},support=%g]" % (mean, sd, quantiles[1], quantiles[0], quantiles[2], n / tree_num if tree_num else 0)
+        parent = reference[i][0]
+        if parent >= 0:
+            text = text + ":%g" % max(get_stats(reference_bits[parent])[1] - mean, 0.0)
+        return text
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), len(reference) * 2 + 100))
+    with open(output + ".tre", "w") as write_file:
+        write_file.write(write_node(0) + ";\n")
+    return tree_num
 
-def main_software(each_file_name_list):
-    print(each_file_name_list)
-    for each in each_file_name_list:
-        os.system("treePL " + each)
 
+def main():
+    parser = argparse.ArgumentParser(description="Run treePL for all the .conf files in the current directory")
+    parser.add_argument('-j', '--jobs', action="store", metavar='\b', type=int, default=os.cpu_count(), help="Number of treePL processes, default = number of cores")
+    parser.add_argument('-s', '--sweep', action="store", metavar='\b', type=str, help="Template config, run a cross-validation sweep of smooth (and opt/optad/optcvad) instead of the .conf files")
+    parser.add_argument('--smooth', action="store", metavar='\b', type=str, default="0.0001,0.001,0.01,0.1,1,10,100,1000", help="Comma separated smooth values of the coarse sweep")
+    parser.add_argument('--opt', action="store", metavar='\b', type=str, default="", help="Comma separated opt values of the sweep, default = value in the template")
+    parser.add_argument('--optad', action="store", metavar='\b', type=str, default="", help="Comma separated optad values of the sweep, default = value in the template")
+    parser.add_argument('--optcvad', action="store", metavar='\b', type=str, default="", help="Comma separated optcvad values of the sweep, default = value in the template")
+    parser.add_argument('--fine', action="store", metavar='\b', type=int, default=3, help="Number of smooth values inserted on each side of the best coarse value, default = 3")
+    parser.add_argument('--no_prime_cache', action="store_true", help="Run prime in every config instead of once per tree/calibration/numsites group")
+    parser.add_argument('--prune', action="store", metavar='\b', type=float, default=1.1, help="Drop opt/optad/optcvad combinations whose best coarse score is worse than this times the overall best, default = 1.1")
+    parser.add_argument('-a', '--summary', action="store", metavar='\b', type=str, nargs="+", help="Dated tree files (- for stdin) or directories, summarise node ages over all trees instead of running treePL")
+    parser.add_argument('-r', '--reference', action="store", metavar='\b', type=str, help="Reference topology of the summary, default = first tree")
+    parser.add_argument('-o', '--output', action="store", metavar='\b', type=str, default="treepl_summary", help="Prefix of the summary tree and table, default = treepl_summary")
+    args = parser.parse_args()
 
+    def split_list(value):
+        return [each.strip() for each in value.split(",") if each.strip()]
 
-file_name = get_file_list()
-th_list = get_th_list(file_name)
+    if args.summary:
+        try:
+            tree_num = summarize_trees(get_tree_files(args.summary), args.reference, args.output)
+        except ValueError as error:
+            print(error)
+            sys.exit(1)
+        if tree_num == 0:
+            sys.exit(1)
+        return
+    if args.sweep:
+        best = run_sweep(args.sweep, [float(each) for each in split_list(args.smooth)], split_list(args.opt), split_list(args.optad), split_list(args.optcvad), args.fine, args.prune, args.jobs)
+        if best is None:
+            sys.exit(1)
+        return
+    file_name = get_file_list()
+    prime_failed = []
+    if not args.no_prime_cache:
+        file_name, prime_failed = prime_configs(file_name, args.jobs)
+    failed = run_treepl_queue(file_name, args.jobs) + prime_failed
+    if failed:
+        sys.exit(1)
 
-p = Pool(th)
-for i in range(th):
-    p.apply_async(main_software,(th_list[i],))
 
-print("----start----")
-p.close()  # 关闭进程池，关闭后po不再接收新的请求
-p.join()  # 等待po中所有子进程执行完成，再执行下面的代码,可以设置超时时间join(timeout=)
-print("-----end-----") 
\ No newline at end of file
+if __name__ == "__main__":
+    main()
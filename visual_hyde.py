@@ -1,16 +1,41 @@
 import os 
 import sys
 import argparse
+import json
+import hashlib
+import base64
+import shutil
+import time
+try:
+  import resource
+except ImportError: #Windows中没有resource模块，不报告内存峰值
+  resource = None
+from io import BytesIO
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib
-from matplotlib import pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.colors import ListedColormap
+from matplotlib.figure import Figure
 import numpy as np
 import pandas as pd
-from ete3 import Tree, TreeStyle, NodeStyle, faces, random_color, TextFace
-from PIL import Image
+from ete3 import Tree, TreeStyle, NodeStyle, faces, random_color
+from PIL import Image, ImageDraw, ImageFont
 matplotlib.use('Agg')
 os.environ ['QT_QPA_PLATFORM'] ='offscreen'
 
+#缓存中保存的列，物种名称保存在taxa中，P1、Hybrid和P2保存为taxa的整数编码
+hyde_cache_columns = ("taxa", "P1", "Hybrid", "P2", "Zscore", "Gamma")
+#流式读取hyde输出时每一块的行数
+hyde_chunk_size = 1000000
+#热图的颜色：γ从0到0.5由透明渐变为蓝色再变为黑色，从0.5到1由黑色渐变为红色再变
+#为透明
+hotmap_cmap = ListedColormap(np.concatenate([
+  np.column_stack([np.zeros(5000), np.zeros(5000), 
+                   1 - np.arange(5000)/5000, np.arange(5000)/5000]),
+  np.column_stack([np.arange(4998)/5000, np.zeros(4998), np.zeros(4998), 
+                   1 - np.arange(4998)/5000])]))
+
 Description = (
   '''
    ----------------------------------------------------------------------------- 
@@ -26,6 +51,7 @@ Description = (
   matplotlib (conda install matplotlib)
   numpy (conda install numpy)
   pandas (conda install pandas)
+  pillow >= 9.2 (conda install pillow)
 
   Description:
   HyDe (Blischak et al., 2018) is a python package to detect hybridization using 
@@ -70,21 +96,34 @@ Description = (
 
 
 #如果用户没有给预先定义的大分枝，则简单定义一下大分枝，每个大分枝内的物种数量不超过5个
-def make_predefined_clade_file(tree_file):
+def find_predefined_clades(t):
+  maxnum_in_predefined_clade = 5
+  predefined_clades = []
   def return_species_name_clade(t):
     child_node = t.children
     for each_node in child_node:
       if len(each_node.get_leaf_names()) <= maxnum_in_predefined_clade:
-        
-        for each_species_name in each_node.get_leaf_names():
-          write_file.write(each_species_name + ",")
-        write_file.write("\n")
+        predefined_clades.append(each_node.get_leaf_names())
       else:
         return_species_name_clade(each_node)
+  return_species_name_clade(t)
+  return predefined_clades
+
+def make_predefined_clade_file(tree_file):
   t = Tree(tree_file)
-  maxnum_in_predefined_clade = 5
   with open("Predefined_clade.txt", "w") as write_file:
-    return_species_name_clade(t)
+    for each_clade in find_predefined_clades(t):
+      for each_species_name in each_clade:
+        write_file.write(each_species_name + ",")
+      write_file.write("\n")
+
+#物种名称的最短和最长的长度
+def get_name_len(Label):
+  name_len_list = []
+  for each_name in Label:
+    name_len_list.append(len(each_name))
+  name_len_list.sort()
+  return (name_len_list[0], name_len_list[-1])
 
 #处理树，得到一些信息
 def parse_tree(tree_file, Predefined_clade_file): 
@@ -110,136 +149,414 @@ def parse_tree(tree_file, Predefined_clade_file):
     for each_list in subtrees:
       Highlight_subtrees.append(each_list[:-1])
   #输出名称长度的列表
-  name_len_list = []
-  for each_name in Label:
-    name_len_list.append(len(each_name))
-  name_len_list.sort()
-  name_len = (name_len_list[0], name_len_list[-1])
+  name_len = get_name_len(Label)
   return t, Label, Highlight_subtrees, name_len
 
-#建立某个sample的hyde表格，表格的横纵坐标轴为sample name，表格的值为gamma
-def make_hotmap_table_gamma(Label, hypothesis_hybrid_species, csv_file_name, 
-                            zscore):
-  #该函数通过Hyde结果获取三个种杂交验证可信度的γ值
-  def get_gamma(hyde_out_table, each_index, each_column):
-    sub_table = hyde_out_table[(hyde_out_table["P1"] == each_index) & 
-                               (hyde_out_table["P2"] == each_column)]
-    if list(sub_table["Gamma"]) == []:
-      sub_table2 = hyde_out_table[(hyde_out_table["P1"] == each_column) & 
-                                  (hyde_out_table["P2"] == each_index)]
-      if list(sub_table2["Gamma"]) == []:
-        pass
-      else:
-        return 1 - list(sub_table2["Gamma"])[0]
-    else:
-      return list(sub_table["Gamma"])[0]
+#hyde结果的二进制缓存目录，放在hyde输出文件旁边
+def get_hyde_cache_dir(csv_file_name):
+  return csv_file_name + ".vhcache"
 
+#用hyde输出文件的大小和修改时间判断缓存是否过期，缓存的格式改变时
+#hyde_cache_version加1
+hyde_cache_version = 2
 
-  #先生成行和列数目是物种数目但内容随机的pandas表格，之后再将这些表格获取为相对应的γ值
-  hyde_table = pd.read_csv(csv_file_name, sep="\t")
-  sub_table = hyde_table[(hyde_table["Hybrid"] == hypothesis_hybrid_species) & 
-                         (hyde_table["Zscore"] > zscore)] #筛选z值
-  df = pd.DataFrame(np.random.randn(len(Label), len(Label)), index=Label, 
-                    columns=Label)
-  
-  for each_index in Label:
-    for each_column in Label:
-      gamma = get_gamma(sub_table, each_index, each_column)
-      if gamma != None:
-        '''
-        if gamma < 0.5:
-          gamma = gamma - 0
-        else:
-          gamma = 1 - gamma
-        '''
-        df.at[each_index, each_column] = gamma
-      else:
-        df.at[each_index, each_column] = 0
-  #下面的代码使热图只显示半个三角
+def get_hyde_file_key(csv_file_name):
+  file_stat = os.stat(csv_file_name)
+  return {"size": file_stat.st_size, "mtime": file_stat.st_mtime_ns, 
+          "version": hyde_cache_version}
+
+#分块流式解析hyde输出的文本表格，读取时直接丢弃z值不大于zscore的行，
+#内存只与通过筛选的行数有关。物种名称在读取时收集到哈希表中并编码为整数，
+#没有通过筛选的行中的名称也会被收集，用于检查物种名称。
+#Zscore保存为float64，之后按其他阈值筛选时与原来的结果相同；Gamma在筛选之后
+#保存为float32
+def parse_hyde_output(csv_file_name, zscore=-np.inf):
+  reader = pd.read_csv(csv_file_name, sep="\t", chunksize=hyde_chunk_size,
+                       usecols=["P1", "Hybrid", "P2", "Zscore", "Gamma"],
+                       dtype={"P1": str, "Hybrid": str, "P2": str,
+                              "Zscore": np.float64, "Gamma": np.float64})
+  taxa_code = {} #三列共用同一套物种编码
+  hyde_arrays = {"P1": [], "Hybrid": [], "P2": [], "Zscore": [], "Gamma": []}
+  for chunk in reader:
+    for each_column in ("Hybrid", "P1", "P2"):
+      for each_name in chunk[each_column].unique():
+        if each_name not in taxa_code:
+          taxa_code[each_name] = len(taxa_code)
+    chunk = chunk[chunk["Zscore"] > zscore] #筛选z值
+    for each_column in ("Hybrid", "P1", "P2"):
+      hyde_arrays[each_column].append(
+        chunk[each_column].map(taxa_code).to_numpy(dtype=np.int32))
+    hyde_arrays["Zscore"].append(chunk["Zscore"].to_numpy(dtype=np.float64))
+    hyde_arrays["Gamma"].append(chunk["Gamma"].to_numpy(dtype=np.float32))
+  for each_column, each_dtype in (("Hybrid", np.int32), ("P1", np.int32), 
+                                  ("P2", np.int32), ("Zscore", np.float64), 
+                                  ("Gamma", np.float32)):
+    hyde_arrays[each_column] = np.concatenate(
+      hyde_arrays[each_column] + [np.zeros(0, dtype=each_dtype)]).astype(
+      each_dtype)
+  hyde_arrays["taxa"] = np.array(list(taxa_code), dtype=str)
+  return hyde_arrays
+
+#读取缓存，缓存不存在、已过期或缓存时的z值阈值高于zscore时返回None
+def read_hyde_cache(csv_file_name, zscore=-np.inf):
+  cache_dir = get_hyde_cache_dir(csv_file_name)
+  try:
+    with open(os.path.join(cache_dir, "key.json"), "r") as read_file:
+      cache_key = json.load(read_file)
+    if cache_key.pop("zscore") > zscore:
+      return None
+    if cache_key != get_hyde_file_key(csv_file_name):
+      return None
+    hyde_arrays = {}
+    for each_column in hyde_cache_columns:
+      hyde_arrays[each_column] = np.load(os.path.join(cache_dir,
+                                         each_column + ".npy"), mmap_mode="r")
+  except (OSError, ValueError, KeyError):
+    return None
+  return hyde_arrays
+
+#写出缓存，key.json最后写出，保证只有完整的缓存才会被读取
+def write_hyde_cache(csv_file_name, hyde_arrays, zscore=-np.inf):
+  cache_dir = get_hyde_cache_dir(csv_file_name)
+  try:
+    os.makedirs(cache_dir, exist_ok=True)
+    key_file = os.path.join(cache_dir, "key.json")
+    if os.path.exists(key_file):
+      os.remove(key_file)
+    for each_column in hyde_cache_columns:
+      np.save(os.path.join(cache_dir, each_column + ".npy"),
+              hyde_arrays[each_column])
+    cache_key = get_hyde_file_key(csv_file_name)
+    cache_key["zscore"] = zscore
+    with open(key_file, "w") as write_file:
+      json.dump(cache_key, write_file)
+  except OSError:
+    print("Can not write cache of hyde output to " + cache_dir)
+
+#读取hyde输出，只在第一次运行时解析文本，之后的运行都直接内存映射缓存。
+#只保留z值大于zscore的行；缓存中保存的行的z值阈值不高于zscore时可以直接使用。
+#cache为False时不读取也不写出缓存。
+#返回的表格中P1、Hybrid和P2为共用同一套类别的Categorical，类别中包含hyde
+#输出中出现过的所有物种名称
+def load_hyde_output(csv_file_name, zscore=-np.inf, cache=True):
+  hyde_arrays = read_hyde_cache(csv_file_name, zscore) if cache else None
+  if hyde_arrays is None:
+    print("Parsing hyde output " + csv_file_name)
+    hyde_arrays = parse_hyde_output(csv_file_name, zscore)
+    if cache:
+      write_hyde_cache(csv_file_name, hyde_arrays, zscore)
+  hyde_table = {}
+  for each_column in ("P1", "Hybrid", "P2"):
+    hyde_table[each_column] = pd.Categorical.from_codes(
+      hyde_arrays[each_column], hyde_arrays["taxa"])
+  hyde_table["Zscore"] = hyde_arrays["Zscore"]
+  hyde_table["Gamma"] = hyde_arrays["Gamma"]
+  return pd.DataFrame(hyde_table, copy=False)
+
+#将hyde表格中的物种名称映射为其在Label中的整数位置，不在Label中的名称记为-1
+def encode_taxa(Label, names):
+  if isinstance(names.dtype, pd.CategoricalDtype):
+    #只需要映射一次类别，再按编码取值
+    category_code = pd.Index(Label).get_indexer(names.cat.categories)
+    return np.append(category_code, -1)[names.cat.codes.to_numpy()]
+  return pd.Index(Label).get_indexer(np.asarray(names))
+
+#热图只显示下三角(含对角线)，γ表格按行依次保存下三角的格子：第i行第j列
+#(i >= j)的格子保存在第i*(i+1)/2+j个位置
+def get_packed_index(row, col):
+  return row*(row + 1)//2 + col
+
+#把float32的γ转换为float64时取能还原该float32的最短十进制数(与
+#np.format_float_positional(..., unique=True)相同)，写出的表格中为0.28而不是
+#0.2800000011920929。从1位有效数字开始逐位尝试，最多9位，不需要逐个格式化
+def widen_gamma(packed_table):
+  value32 = np.asarray(packed_table, dtype=np.float32)
+  result = value32.astype(float)
+  #只处理不为0的有限值，没有通过筛选的格子为0
+  cell = np.flatnonzero(np.isfinite(result) & (result != 0))
+  value = result.ravel()[cell]
+  pending = np.ones(len(cell), dtype=bool)
+  exponent = np.floor(np.log10(np.abs(value)))
+  with np.errstate(over="ignore", invalid="ignore"):
+    for digits in range(1, 10):
+      if not pending.any():
+        break
+      #保留的小数位数，为负数时舍入到十位、百位等
+      decimals = digits - 1 - exponent
+      power = 10.0**np.abs(decimals)
+      rounded = np.where(decimals >= 0, np.round(value*power)/power, 
+                         np.round(value/power)*power)
+      found = pending & (rounded.astype(np.float32) == value32.ravel()[cell])
+      value[found] = rounded[found]
+      pending = pending & ~found
+  result.ravel()[cell] = value
+  return result
+
+#把保存下三角的一行数据还原为完整的γ表格，上三角为NaN
+def unpack_gamma_table(packed_table, len_Label):
+  gamma_table = np.full((len_Label, len_Label), np.nan)
+  gamma_table[np.tril_indices(len_Label)] = widen_gamma(packed_table)
+  return gamma_table
+
+#筛选z值并把物种名称编码为整数位置，去掉物种不在Label或hybrid_list中的检验
+def encode_hyde_table(Label, hyde_table, zscore, hybrid_list):
+  sub_table = hyde_table[hyde_table["Zscore"] > zscore] #筛选z值
+  #同一检验出现多次时保留第一条，与逐格查找时取第一条结果一致
+  sub_table = sub_table.drop_duplicates(["Hybrid", "P1", "P2"])
+  hybrid_code = encode_taxa(hybrid_list, sub_table["Hybrid"])
+  p1_code = encode_taxa(Label, sub_table["P1"])
+  p2_code = encode_taxa(Label, sub_table["P2"])
+  keep = (hybrid_code >= 0) & (p1_code >= 0) & (p2_code >= 0)
+  return hybrid_code[keep], p1_code[keep], p2_code[keep], sub_table[keep]
+
+#把每个检验的值散布到只保存下三角的张量中：正向检验的值写在[P1, P2]处，
+#反向检验的值写在[P2, P1]处。先写入反向检验，再用正向检验覆盖，正向检验优先；
+#上三角的格子不保存
+def scatter_hyde_table(tensor, hybrid_code, p1_code, p2_code, forward_value, 
+                       reverse_value):
+  for row_code, col_code, value in ((p2_code, p1_code, reverse_value), 
+                                    (p1_code, p2_code, forward_value)):
+    lower = row_code >= col_code
+    tensor[hybrid_code[lower], 
+           get_packed_index(row_code[lower], col_code[lower])] = value[lower]
+  return tensor
+
+#一次性把hyde结果散布到一个二维的float32 γ张量中，第k行为hybrid_list[k]的
+#热图表格的下三角：[P1, P2]处为γ，若只有反向的(P2, P1)检验则为1-γ，没有通过
+#z值筛选的格子为0。与完整的float64表格相比只占约四分之一的内存
+def make_gamma_tensor(Label, hyde_table, zscore, hybrid_list=None):
+  if hybrid_list is None:
+    hybrid_list = Label
   len_Label = len(Label)
-  for each_num_index in range(len_Label):
-    for each_num_index2 in range(len_Label):
-      if each_num_index2 > each_num_index:
-        df.iloc[each_num_index:each_num_index + 1, 
-                each_num_index2:each_num_index2 + 1] = None  
-  
-  return df
-
-#将所有待检测物种的热图表格都加入一个字典中
-def make_hyde_output_array_dict(Label, csv_file_name, zscore):
-  hyde_output_array_dict = {}
-  n = 0
-  for each_hypothesis_hybrid_species in Label:
-    n = n + 1
-    print("start parsing " + each_hypothesis_hybrid_species + 
-          "'s hyde output " + str(n) + "/" + str(len(Label)))
-    hyde_output_array = make_hotmap_table_gamma(Label, 
-                          each_hypothesis_hybrid_species, csv_file_name, zscore)
-    hyde_output_array_dict[each_hypothesis_hybrid_species] = hyde_output_array
-  return hyde_output_array_dict
-
-#找到某特定节点之后所有物种所共享的杂交事件，并输出一个表格
-def find_common_hybrid_in_nodes(hyde_output_array_dict, each_node, Label):
-  def get_num(each_index, each_column):
-    gamma_list = []
-    base_species_have_zscore = True
-
-    gamma_left_child_list = []
-    for each in each_node.children[0].get_leaf_names():
-      gamma_left_child = hyde_output_array_dict[each].at[each_index, 
-                                                         each_column]
-      gamma_left_child_list.append(gamma_left_child)
-    if sum(gamma_left_child_list) == 0:
-      base_species_have_zscore = False
-    gamma_right_child_list = []
-    for each in each_node.children[1].get_leaf_names():
-      gamma_right_child = hyde_output_array_dict[each].at[each_index, 
-                                                          each_column]
-      gamma_right_child_list.append(gamma_right_child)
-    if sum(gamma_right_child_list) == 0:   
-      base_species_have_zscore = False
-
-    number_of_non_gamma_species = 0
-    for each_leaves in each_node.get_leaf_names():
-      gamma = hyde_output_array_dict[each_leaves].at[each_index, each_column]
-      if gamma != 0:
-        gamma_list.append(gamma)
-      else:
-        number_of_non_gamma_species = number_of_non_gamma_species + 1
-    if base_species_have_zscore:
-      if number_of_non_gamma_species/len(each_node.get_leaf_names()) <= 0.5:
-        return sum(gamma_list)/(len(gamma_list) + 0.000001)
-      else:
-        return 0
-    else:
-      return 0
-  df = pd.DataFrame(np.random.randn(len(Label), len(Label)), index=Label, 
-                    columns=Label)
-  for each_index in Label:
-    if each_index not in each_node.get_leaf_names():
-      for each_column in Label:
-        if each_column not in each_node.get_leaf_names():
-          gamma = get_num(each_index, each_column)
-          df.at[each_index, each_column] = gamma
-        else:
-          df.at[each_index, each_column] = 0
+  hybrid_code, p1_code, p2_code, sub_table = encode_hyde_table(
+    Label, hyde_table, zscore, hybrid_list)
+  gamma = sub_table["Gamma"].to_numpy(dtype=float)
+  gamma_tensor = np.zeros((len(hybrid_list), len_Label*(len_Label + 1)//2), 
+                          dtype=np.float32)
+  return scatter_hyde_table(gamma_tensor, hybrid_code, p1_code, p2_code, 
+                            gamma, 1 - gamma)
+
+#找出有格子对应多个检验的杂交种：同一检验重复出现，或者一对亲本正反两个方向
+#都有检验(例如合并的多个基因的hyde结果)。返回它们在hybrid_list中的位置
+def find_ambiguous_hybrids(Label, hyde_table, zscore, hybrid_list):
+  sub_table = hyde_table[hyde_table["Zscore"] > zscore]
+  hybrid_code = encode_taxa(hybrid_list, sub_table["Hybrid"]).astype(np.int64)
+  p1_code = encode_taxa(Label, sub_table["P1"])
+  p2_code = encode_taxa(Label, sub_table["P2"])
+  keep = (hybrid_code >= 0) & (p1_code >= 0) & (p2_code >= 0)
+  cell_num = len(Label)*(len(Label) + 1)//2
+  cell = hybrid_code[keep]*cell_num + get_packed_index(
+    np.maximum(p1_code[keep], p2_code[keep]).astype(np.int64), 
+    np.minimum(p1_code[keep], p2_code[keep]))
+  cell, count = np.unique(cell, return_counts=True)
+  return np.unique(cell[count > 1] // cell_num)
+
+#z值扫描时所有阈值共用的γ张量：在最低的阈值下建立γ张量，同时记录每个格子的
+#检验通过了几个阈值(level)。格子只对应一个检验时(一次hyde运行中每个杂交种和
+#一对亲本只检验一次)，第m个阈值下格子的γ就是level大于m时的γ，其余为0，只需
+#要用阈值的掩码筛选一次算好的γ。有格子对应多个检验的杂交种提高阈值后格子的γ
+#可能来自另一个检验，这些杂交种的表格在每个阈值下单独计算，保存在exact_rows中
+def make_gamma_sweep(Label, hyde_table, zscore_list, hybrid_list):
+  hybrid_code, p1_code, p2_code, sub_table = encode_hyde_table(
+    Label, hyde_table, zscore_list[0], hybrid_list)
+  gamma = sub_table["Gamma"].to_numpy(dtype=float)
+  #与筛选z值时的比较方式相同
+  level = sum((sub_table["Zscore"] > each_zscore).to_numpy(dtype=np.int64) 
+              for each_zscore in zscore_list)
+  cell_num = len(Label)*(len(Label) + 1)//2
+  gamma_tensor = scatter_hyde_table(
+    np.zeros((len(hybrid_list), cell_num), dtype=np.float32), 
+    hybrid_code, p1_code, p2_code, gamma, 1 - gamma)
+  level_tensor = scatter_hyde_table(
+    np.zeros((len(hybrid_list), cell_num), 
+             dtype=np.min_scalar_type(len(zscore_list))), 
+    hybrid_code, p1_code, p2_code, level, level)
+  exact_rows = {}
+  ambiguous = find_ambiguous_hybrids(Label, hyde_table, zscore_list[0], 
+                                     hybrid_list)
+  if len(ambiguous):
+    ambiguous_list = [hybrid_list[k] for k in ambiguous]
+    exact_tensor = np.stack([make_gamma_tensor(Label, hyde_table, each_zscore, 
+                                               ambiguous_list) 
+                             for each_zscore in zscore_list], axis=1)
+    exact_rows = dict(zip(ambiguous.tolist(), exact_tensor))
+  return {"zscore_list": list(zscore_list), "gamma_tensor": gamma_tensor, 
+          "level_tensor": level_tensor, "exact_rows": exact_rows}
+
+#z值扫描中杂交种k在所有阈值下的γ表格(下三角)，第m行为第m个阈值
+def get_sweep_rows(gamma_sweep, k):
+  if k in gamma_sweep["exact_rows"]:
+    return gamma_sweep["exact_rows"][k].astype(float)
+  threshold = np.arange(len(gamma_sweep["zscore_list"]))[:, None]
+  return np.where(gamma_sweep["level_tensor"][k] > threshold, 
+                  gamma_sweep["gamma_tensor"][k].astype(float), 0)
+
+#z值扫描中第m个阈值下的γ张量，与make_gamma_tensor在该阈值下的结果相同
+def get_sweep_tensor(gamma_sweep, m):
+  gamma_tensor = np.where(gamma_sweep["level_tensor"] > m, 
+                          gamma_sweep["gamma_tensor"], np.float32(0))
+  for k, exact_row in gamma_sweep["exact_rows"].items():
+    gamma_tensor[k] = exact_row[m]
+  return gamma_tensor
+
+#报告γ张量占用的内存，以及保存为完整的float64表格时需要的内存
+def report_gamma_tensor_memory(gamma_tensor, len_Label):
+  print("Gamma tables use %.1f MB (%.1f MB as full float64 tables)" % (
+    gamma_tensor.nbytes/2**20, len(gamma_tensor)*len_Label**2*8/2**20))
+
+#报告本进程以及绘图进程的内存峰值(Linux中ru_maxrss的单位为KB)
+def report_peak_memory():
+  if resource is None:
+    return
+  print("Peak memory: %.1f MB (main process), %.1f MB (largest drawing process)"
+        % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 
+           resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024))
+
+#计算γ表格中通过z值筛选的格子数，即热图中有颜色的格子数
+def count_surviving_cells(hyde_output_array):
+  hyde_output_array = np.asarray(hyde_output_array, dtype=float)
+  return int(np.count_nonzero(np.nan_to_num(hyde_output_array)))
+
+#建立某个sample的hyde表格，表格的横纵坐标轴为sample name，表格的值为gamma
+def make_hotmap_table_gamma(Label, hypothesis_hybrid_species, hyde_table, 
+                            zscore):
+  gamma_tensor = make_gamma_tensor(Label, hyde_table, zscore, 
+                                   [hypothesis_hybrid_species])
+  return pd.DataFrame(unpack_gamma_table(gamma_tensor[0], len(Label)), 
+                      index=Label, columns=Label)
+
+#为树中的每个节点建立分枝索引。Label是按照树的遍历顺序排列的，所以每个分枝的
+#叶子在Label中都是一段连续的区间，用(start, end)表示
+def make_clade_index(t, Label):
+  leaf_position = {}
+  for n, each_name in enumerate(Label):
+    leaf_position[each_name] = n
+  clade_index = {}
+  for each_node in t.traverse("postorder"):
+    if each_node.is_leaf():
+      position = leaf_position[each_node.name]
+      clade_index[each_node] = (position, position + 1)
     else:
-      for each_column in Label:
-        df.at[each_index, each_column] = 0
-  #下面的代码使热图只显示半个三角
+      clade_index[each_node] = (
+        min(clade_index[each_child][0] for each_child in each_node.children),
+        max(clade_index[each_child][1] for each_child in each_node.children))
+  return clade_index
+
+#按后序遍历找到每个内部节点之后所有物种所共享的杂交事件，依次返回节点和叠加
+#好的γ(下三角)。每个节点叠加后的γ之和以及γ非零的物种数由其子节点已经叠加好
+#的结果相加得到，子节点的结果在父节点用完后即释放。get_leaf_gamma(k)返回Label
+#中第k个物种的γ表格的下三角，可以在前面多一维(例如z值扫描的各个阈值)，所有
+#阈值在同一次遍历中叠加
+def stack_hybrid_in_nodes(t, Label, get_leaf_gamma):
+  clade_index = make_clade_index(t, Label)
   len_Label = len(Label)
-  for each_num_index in range(len_Label):
-    for each_num_index2 in range(len_Label):
-      if each_num_index2 > each_num_index:
-        df.iloc[each_num_index:each_num_index + 1, 
-                each_num_index2:each_num_index2 + 1] = None  
-  return df  
-
-#绘制热图
-def draw_hotmap(pic_name, hyde_output_array):
-  hyde_output_array.to_csv(pic_name + ".csv",index =True ,sep = ',')
-  #创建空背景
-  fig = plt.figure(figsize=(30,30))
+  row, col = np.tril_indices(len_Label)
+  node_stack_dict = {}
+  for each_node in t.traverse("postorder"):
+    if each_node.is_leaf():
+      gamma = get_leaf_gamma(clade_index[each_node][0])
+      node_stack_dict[each_node] = (gamma, (gamma != 0).astype(np.int32))
+      continue
+    children_stack = [node_stack_dict.pop(each_child) 
+                      for each_child in each_node.children]
+    gamma_sum = sum(each_stack[0] for each_stack in children_stack)
+    non_zero_num = sum(each_stack[1] for each_stack in children_stack)
+    node_stack_dict[each_node] = (gamma_sum, non_zero_num)
+
+    #左右两个子分枝中都至少有一个物种检测到杂交信号，且节点之后检测不到杂交
+    #信号的物种不超过一半时，取检测到的γ的平均值
+    start, end = clade_index[each_node]
+    leaf_num = end - start
+    base_species_have_zscore = ((children_stack[0][0] != 0) & 
+                                (children_stack[1][0] != 0))
+    common_gamma = np.where(
+      base_species_have_zscore & ((leaf_num - non_zero_num)/leaf_num <= 0.5),
+      gamma_sum/(non_zero_num + 0.000001), 0)
+    #节点之后的物种不能作为亲本
+    common_gamma[..., ((row >= start) & (row < end)) | 
+                      ((col >= start) & (col < end))] = 0
+    yield each_node, common_gamma
+
+#依次返回每个内部节点和节点模式中叠加好的表格
+def find_common_hybrid_in_nodes(t, Label, gamma_tensor):
+  for each_node, common_gamma in stack_hybrid_in_nodes(
+      t, Label, lambda k: gamma_tensor[k].astype(float)):
+    yield each_node, pd.DataFrame(unpack_gamma_table(common_gamma, len(Label)), 
+                                  index=Label, columns=Label)
+
+#z值扫描的节点模式：只遍历一次树，依次返回每个内部节点和所有阈值下叠加好的
+#表格的列表，与在每个阈值下分别调用find_common_hybrid_in_nodes的结果相同
+def find_common_hybrid_in_nodes_sweep(t, Label, gamma_sweep):
+  for each_node, common_gamma in stack_hybrid_in_nodes(
+      t, Label, lambda k: get_sweep_rows(gamma_sweep, k)):
+    yield each_node, [pd.DataFrame(unpack_gamma_table(each_gamma, len(Label)), 
+                                   index=Label, columns=Label) 
+                      for each_gamma in common_gamma]
+
+#二维前缀和(summed-area table)，第一行和第一列补0。任意矩形区域
+#[r0:r1, c0:c1]的和为S[r1, c1] - S[r0, c1] - S[r1, c0] + S[r0, c0]
+def make_summed_area_table(array):
+  summed_area_table = np.zeros((array.shape[0] + 1, array.shape[1] + 1))
+  summed_area_table[1:, 1:] = array.cumsum(0).cumsum(1)
+  return summed_area_table
+
+#分枝的名称：单个物种时为物种名，否则为分枝在Label中的第一个和最后一个物种
+def get_clade_name(Label, start, end):
+  if end - start == 1:
+    return Label[start]
+  return Label[start] + ".." + Label[end - 1]
+
+#在一张热图中寻找与单系分枝对应的色块。Label是按照树的遍历顺序排列的，每个
+#分枝都是一段连续的区间，任意两个不重叠的分枝(P1分枝在下三角的行，P2分枝在列)
+#围成热图中的一个矩形，用前缀和可以O(1)地得到矩形中检测到γ的格子数(覆盖度)
+#以及这些格子γ的平均值。返回覆盖度不低于min_coverage且至少有min_cells个格子
+#的分枝对；两个物种围成的单个格子本身就是一个检验，不作为色块
+def find_hybrid_blocks(fig_name, hyde_output_array, clade_interval, Label, 
+                       min_coverage, min_cells=2):
+  hyde_output_array = np.asarray(hyde_output_array, dtype=float)
+  detected = np.isfinite(hyde_output_array) & (hyde_output_array != 0)
+  gamma_table = make_summed_area_table(np.where(detected, hyde_output_array, 0))
+  count_table = make_summed_area_table(detected)
+  start = np.array([each_interval[0] for each_interval in clade_interval])
+  end = np.array([each_interval[1] for each_interval in clade_interval])
+  r0, r1 = start[:, None], end[:, None]
+  c0, c1 = start[None, :], end[None, :]
+
+  def block_sum(summed_area_table):
+    return (summed_area_table[r1, c1] - summed_area_table[r0, c1] - 
+            summed_area_table[r1, c0] + summed_area_table[r0, c0])
+
+  cells = (r1 - r0)*(c1 - c0)
+  detected_num = block_sum(count_table)
+  coverage = detected_num/cells
+  #P1分枝在P2分枝之后时矩形才完全位于下三角
+  p1, p2 = np.nonzero((r0 >= c1) & (detected_num > 0) & 
+                      (coverage >= min_coverage) & (cells >= min_cells))
+  return pd.DataFrame({
+    "Figure": fig_name, 
+    "P1_clade": [get_clade_name(Label, start[k], end[k]) for k in p1], 
+    "P2_clade": [get_clade_name(Label, start[k], end[k]) for k in p2], 
+    "Cells": cells[p1, p2], 
+    "Mean_gamma": block_sum(gamma_table)[p1, p2]/detected_num[p1, p2], 
+    "Coverage": coverage[p1, p2], 
+    "Detected": detected_num[p1, p2].astype(int)}, 
+    columns=["Figure", "P1_clade", "P2_clade", "Cells", "Mean_gamma", 
+             "Coverage", "Detected"])
+
+#所有热图中找到的色块按检测到γ的格子数(覆盖度×大小)排序后写出，格子数相同
+#时覆盖度高的在前。只按覆盖度排序时小色块(覆盖度很容易为1)会排在最前面
+def write_hybrid_blocks(csv_file_name, hybrid_blocks):
+  hybrid_blocks = pd.concat(hybrid_blocks, ignore_index=True)
+  hybrid_blocks = hybrid_blocks.sort_values(["Detected", "Coverage"], 
+                                            ascending=False, kind="stable")
+  hybrid_blocks.to_csv(csv_file_name, index=False)
+
+#创建热图的画布。画布、坐标轴、颜色条和方格间的网格线只创建一次，之后每张热图
+#只需要更新图像的数据并重新渲染
+def make_hotmap_renderer(len_Label):
+  #创建空背景，dpi与原先保存"hotmap.png"时一致
+  fig = Figure(figsize=(30,30), dpi = 200)
+  canvas = FigureCanvasAgg(fig)
 
   #设定axes大小，并将其填入fig中
   border_width = 0.00001
@@ -247,44 +564,34 @@ def draw_hotmap(pic_name, hyde_output_array):
               1-2*border_width, 1-2*border_width]  
   ax = fig.add_axes(ax_size)
 
-  #画出热图
-  cmap = []
-  color = 1
-  lucency = 0
-  for each in range(5000):
-    cmap.insert(each, np.array([0,0,color,lucency]))
-    color = color - (1/5000)
-    lucency = lucency + (1/5000)
-  color = 0
-  lucency = 1
-  for each in range(5001, 9999):
-    cmap.insert(each, np.array([color,0,0,lucency]))
-    color = color + (1/5000)
-    lucency = lucency - (1/5000)
-  newcmp = ListedColormap(cmap)
-  im = ax.imshow(hyde_output_array, norm = 
-                 matplotlib.colors.Normalize(vmin=0, vmax=1), cmap = newcmp)
+  #画出热图，先用全为NaN的表格占位
+  im = ax.imshow(np.full((len_Label, len_Label), np.nan), norm = 
+                 matplotlib.colors.Normalize(vmin=0, vmax=1), cmap = hotmap_cmap)
   position=fig.add_axes([0.9, 0.2, 0.05, 0.7])
-  plt.colorbar(im, cax=position)
-  cbar = plt.colorbar(im, cax=position)
-  #labels = [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+  cbar = fig.colorbar(im, cax=position)
   cbar.ax.tick_params(labelsize=50)
-  #norm = matplotlib.colors.Normalize(vmin=0, vmax=0.5) 
   #热图的小方格间加入小空隙
-  ax.set_xticks(np.arange(hyde_output_array.shape[1]+1)-.5, minor=True)
-  ax.set_yticks(np.arange(hyde_output_array.shape[0]+1)-.5, minor=True)
+  ax.set_xticks(np.arange(len_Label+1)-.5, minor=True)
+  ax.set_yticks(np.arange(len_Label+1)-.5, minor=True)
   ax.grid(which="minor", color="black", linestyle='-', linewidth=2)
+  return {"canvas": canvas, "image": im}
 
-  #保存热图至"hotmap.png"中
-  plt.savefig("hotmap.png", dpi = 200)
+#绘制热图，返回热图的图像
+def render_hotmap(hyde_output_array, hotmap_renderer):
+  hotmap_renderer["image"].set_data(np.asarray(hyde_output_array, dtype=float))
+  #直接在内存中渲染热图，不再写出临时文件
+  canvas = hotmap_renderer["canvas"]
+  canvas.draw()
+  return Image.fromarray(np.array(canvas.buffer_rgba()))
 
-  #清理掉内存中的图
-  plt.cla()
-  plt.close("all")
+#写出热图的表格并绘制热图
+def draw_hotmap(pic_name, hyde_output_array, hotmap_renderer):
+  hyde_output_array.to_csv(pic_name + ".csv",index =True ,sep = ',')
+  return render_hotmap(hyde_output_array, hotmap_renderer)
 
-#绘制树
-def draw_tree(tree_file, node_num, highlight_clade, Clade_file, name_len, 
-              picture_size):
+#绘制热图旁边的树。每次运行只绘制一次不带高亮标记的树，同时记录每个节点在图中
+#的像素坐标，之后每张图只需要在这张树图上画出高亮标记即可
+def make_tree_panel(tree_file, Clade_file, name_len, picture_size):
 
   #重新获取物种树
   t = Tree(tree_file)
@@ -316,20 +623,15 @@ def draw_tree(tree_file, node_num, highlight_clade, Clade_file, name_len,
     node.set_style(ns)
 
   #首先绘制内部不许要高亮的节点以及不在用户所定义的分枝列表中的节点。
-  Clade_file_temp_list = [] #先获取用户所定义的分枝列表中的所有叶子
+  Clade_file_temp_list = set() #先获取用户所定义的分枝列表中的所有叶子
   for each1 in Clade_file:
     for each2 in each1:
-      Clade_file_temp_list.append(each2)
+      Clade_file_temp_list.add(each2)
   for each_node in t.traverse():
     #这里的逻辑如下：遍历物种树内部的所有节点，如果是内部节点，则设定树分支的格式。
-    #如果一个节点是叶子节点，如果这个节点是正在检测的物种，则高亮该分支，
-    #如果不在用户所定义的大分枝中，则把他画成黑色
+    #如果一个节点是叶子节点，如果不在用户所定义的大分枝中，则把他画成黑色
     if each_node.is_leaf():
-      if each_node.get_leaf_names()[0] == highlight_clade:
-        node_face = TextFace("o",fsize = 40)
-        node_face.background.color = "red"
-        each_node.add_face(node_face, column=0, position = "branch-right")
-      if each_node.get_leaf_names()[0] not in Clade_file_temp_list:
+      if each_node.name not in Clade_file_temp_list:
         color = None
         node_layout(each_node, color)
     else:
@@ -349,24 +651,96 @@ def draw_tree(tree_file, node_num, highlight_clade, Clade_file, name_len,
       node_layout(Highlight_node, color)
 
   #定义一些其他的树形
-  node_face = TextFace(str(node_num),fsize = 40)
-  node_face.background.color = "LightGreen"
-  t.get_common_ancestor(highlight_clade).add_face(node_face, column=0, 
-                        position = "branch-right")
   ts = TreeStyle()
   ts.scale = 40   
   ts.draw_guiding_lines = True
   ts.show_leaf_name = False
   ts.force_topology = True
   ts.show_scale = False
-  t.render("img_faces.png", h=picture_size*0.8, tree_style=ts)
+  #ete3只能在内存中返回经过base64编码的PNG，解码后直接读取，不再写出临时文件。
+  #ete3按先序遍历的编号(_nid)返回每个节点所占区域的像素坐标
+  for nid, each_node in enumerate(t.traverse("preorder")):
+    each_node.add_feature("_nid", nid)
+  img_data, img_map = t.render("%%return.PNG", h=picture_size*0.8, 
+                               tree_style=ts)
+  treepic = Image.open(BytesIO(base64.b64decode(img_data.data())))
+  treepic.load()
 
+  #计算每个节点枝末端的坐标，即高亮标记的位置。叶子的区域就是它的枝，内部节点
+  #的枝末端即子节点区域的起点，纵坐标为第一个和最后一个子节点的中点。
+  #坐标按节点之后的叶子在Label中的区间(start, end)保存
+  node_areas = img_map["node_areas"]
+  clade_index = make_clade_index(t, t.get_leaf_names())
+  node_position = {}
+  for each_node in t.traverse("postorder"):
+    x1, y1, x2, y2 = node_areas[each_node._nid]
+    if each_node.is_leaf():
+      position = (x2, (y1 + y2)/2)
+    else:
+      children_position = [node_position[clade_index[each_child]] 
+                           for each_child in each_node.children]
+      position = (min(node_areas[each_child._nid][0] 
+                      for each_child in each_node.children),
+                  (children_position[0][1] + children_position[-1][1])/2)
+    node_position[clade_index[each_node]] = position
+  #高亮标记的高度按原先fsize为40的TextFace与叶子名称(fsize为30，上下各留3的
+  #空白)的比例，由叶子所占的高度换算得到
+  leaf_height = np.median([node_areas[each_leaf._nid][3] - 
+                           node_areas[each_leaf._nid][1] 
+                           for each_leaf in t.iter_leaves()])
+  face_size = leaf_height * 40/36
+  return {"image": treepic, "position": node_position, 
+          "face_size": face_size}
+
+#获取绘制高亮标记的字体，Pillow 10.1之前不能指定默认字体的大小，只能使用
+#固定大小的点阵字体
+def get_face_font(face_size):
+  try:
+    return ImageFont.load_default(size=face_size*0.75)
+  except TypeError:
+    return ImageFont.load_default()
+
+#计算树图上高亮标记的位置：叶子模式时在正在检测的物种旁画红色的"o"，节点模式
+#时在节点旁画绿色的节点编号。返回标记的矩形区域、文字和颜色
+def get_tree_marker(tree_panel, node_num, highlight_clade, Label):
+  if isinstance(highlight_clade, str):
+    start = Label.index(highlight_clade)
+    end = start + 1
+    text, color = "o", "red"
+  else:
+    start = Label.index(highlight_clade[0])
+    end = start + len(highlight_clade)
+    text, color = str(node_num), "LightGreen"
+  x, y = tree_panel["position"][(start, end)]
+  face_size = tree_panel["face_size"]
+  face_width = get_face_font(face_size).getlength(text) + face_size/4
+  if isinstance(highlight_clade, str):
+    #叶子的枝末端紧接着叶子名称，标记画在枝末端的左侧
+    x = x - face_width
+  return (x, y - face_size/2, x + face_width, y + face_size/2), text, color
+
+#在树图上画出高亮标记
+def draw_tree(tree_panel, node_num, highlight_clade, Label):
+  box, text, color = get_tree_marker(tree_panel, node_num, highlight_clade, 
+                                     Label)
+  face_size = tree_panel["face_size"]
+  treepic = tree_panel["image"].copy()
+  draw = ImageDraw.Draw(treepic)
+  draw.rectangle(box, fill=color)
+  font = get_face_font(face_size)
+  x, y = box[0] + face_size/8, (box[1] + box[3])/2
+  if isinstance(font, ImageFont.FreeTypeFont):
+    draw.text((x, y), text, fill="black", font=font, anchor="lm")
+  else:
+    #Pillow 10.1之前的默认点阵字体不支持anchor，按文字的范围手动垂直居中
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    draw.text((x - left, y - (top + bottom)/2), text, fill="black", font=font)
+  return treepic
 
 #将已经画好的物种树的图和热图合并到一张图上
-def combine_fig(fig_name, picture_size):
+def make_combined_figure(treepic, hotpic, picture_size):
 
   #先通过树图的大小计算整张图片的面积
-  treepic = Image.open("img_faces.png")
   treepic_size = treepic.size
   combine_fig_size = treepic_size[0] + treepic_size[1]
 
@@ -380,17 +754,342 @@ def combine_fig(fig_name, picture_size):
                 int(treepic_size[1]) - int(picture_size*0.01)))
 
   #讲hotpic粘贴过来
-  hotpic = Image.open("hotmap.png")
   hotpic.thumbnail((treepic_size[1], treepic_size[1]))
   combine.paste(hotpic, (treepic_size[0] - int(picture_size*0.01), 
                  int(picture_size*0.01)))
 
-  #保存图片
-  combine.save(fig_name + ".png")
+  return combine
+
+#合并物种树的图和热图并保存图片
+def combine_fig(fig_name, treepic, hotpic, picture_size):
+  make_combined_figure(treepic, hotpic, picture_size).save(fig_name + ".png")
+
+
+#分块输出时，热图中每个格子在最高分辨率下的边长(像素)以及树图分块的文件名
+tile_cell_size = 16
+tree_tiles_name = "tree_panel"
+
+#写出Deep Zoom格式的索引文件，分块保存在同名的"_files"文件夹中
+def write_dzi(dzi_name, width, height, tile_size):
+  with open(dzi_name + ".dzi", "w") as write_file:
+    write_file.write('<?xml version="1.0" encoding="UTF-8"?>\n' + 
+                     '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"' + 
+                     ' Format="png" Overlap="0" TileSize="' + str(tile_size) + 
+                     '">\n  <Size Width="' + str(width) + '" Height="' + 
+                     str(height) + '"/>\n</Image>\n')
+
+#Deep Zoom的各个层级：最高一层为原始大小，每低一层长宽减半，第0层只有一个像素。
+#依次返回层级、一个像素对应原始图像中的像素数以及该层的宽和高
+def get_dzi_levels(width, height):
+  max_level = int(np.ceil(np.log2(max(width, height, 1))))
+  for level in range(max_level, -1, -1):
+    scale = 2 ** (max_level - level)
+    yield level, scale, -(-width // scale), -(-height // scale)
+
+#把一张图片切成Deep Zoom格式的多分辨率分块，每一层由上一层缩小一半得到
+def write_image_pyramid(dzi_name, image, tile_size):
+  write_dzi(dzi_name, image.size[0], image.size[1], tile_size)
+  level_image = image.convert("RGB")
+  for level, scale, width, height in get_dzi_levels(*image.size):
+    level_image = level_image.resize((width, height), Image.LANCZOS)
+    level_dir = os.path.join(dzi_name + "_files", str(level))
+    os.makedirs(level_dir, exist_ok=True)
+    for row in range(0, height, tile_size):
+      for col in range(0, width, tile_size):
+        level_image.crop((col, row, min(col + tile_size, width), 
+                          min(row + tile_size, height))).save(os.path.join(
+          level_dir, str(col//tile_size) + "_" + str(row//tile_size) + ".png"))
+
+#把热图切成Deep Zoom格式的多分辨率分块。每个分块直接由γ表格生成：分块中的
+#每个像素取其中心所在格子的颜色，所以内存占用只与分块的大小有关，与物种数无关。
+#一个格子至少有4个像素时画出格子间的网格线
+def write_hotmap_pyramid(dzi_name, hyde_output_array, tile_size):
+  hyde_output_array = np.asarray(hyde_output_array, dtype=float)
+  len_Label = len(hyde_output_array)
+  full_size = len_Label * tile_cell_size
+  write_dzi(dzi_name, full_size, full_size, tile_size)
+  for level, scale, size, _ in get_dzi_levels(full_size, full_size):
+    level_dir = os.path.join(dzi_name + "_files", str(level))
+    os.makedirs(level_dir, exist_ok=True)
+    pixel = np.arange(size)
+    cell = np.minimum((pixel*scale + scale//2) // tile_cell_size, len_Label - 1)
+    grid = ((pixel*scale) % tile_cell_size < scale) & (
+      tile_cell_size >= 4*scale)
+    for row in range(0, size, tile_size):
+      rows = slice(row, row + tile_size)
+      for col in range(0, size, tile_size):
+        cols = slice(col, col + tile_size)
+        #γ为0时颜色透明，NaN(上三角)没有颜色，都显示为白色背景
+        rgba = hotmap_cmap(np.clip(hyde_output_array[np.ix_(cell[rows], 
+                                                            cell[cols])], 0, 1), 
+                           bytes=True)
+        alpha = rgba[..., 3:]/255
+        tile = (rgba[..., :3]*alpha + 255*(1 - alpha)).astype(np.uint8)
+        tile[grid[rows][:, None] | grid[cols][None, :]] = 0
+        Image.fromarray(tile).save(os.path.join(
+          level_dir, str(col//tile_size) + "_" + str(row//tile_size) + ".png"))
+
+#分块输出一张图：热图的分块，以及一个记录热图分块、树图分块(每次运行只输出一
+#次)和树图上高亮标记位置的索引文件
+def draw_figure_tiles(fig_name, hyde_output_array, node_num, highlight_clade, 
+                      tree_panel, Label, tile_size):
+  hyde_output_array.to_csv(fig_name + ".csv", index=True, sep=",")
+  write_hotmap_pyramid(fig_name + "_hotmap", hyde_output_array, tile_size)
+  box, text, color = get_tree_marker(tree_panel, node_num, highlight_clade, 
+                                     Label)
+  fig_dir = os.path.dirname(fig_name) or "."
+  tile_index = {
+    "hotmap": os.path.basename(fig_name) + "_hotmap.dzi", 
+    "tree": os.path.relpath(tree_tiles_name + ".dzi", fig_dir), 
+    "tree_marker": {"box": box, "text": text, "color": color}, 
+    "cell_size": tile_cell_size, 
+    "taxa": Label}
+  with open(fig_name + ".json", "w") as write_file:
+    json.dump(tile_index, write_file, indent=1)
+
+#一张图输出的所有文件
+def get_figure_files(fig_name, tile_size):
+  if tile_size:
+    return [fig_name + each_suffix for each_suffix in 
+            (".csv", ".json", "_hotmap.dzi", "_hotmap_files")]
+  return [fig_name + ".csv", fig_name + ".png"]
+
+#绘制一张完整的图：热图、热图旁边的树以及两者的组合。tile_size不为0时改为分块
+#输出
+def draw_figure(fig_name, hyde_output_array, node_num, highlight_clade, 
+                tree_panel, Label, picture_size, tile_size, hotmap_renderer):
+  if tile_size:
+    draw_figure_tiles(fig_name, hyde_output_array, node_num, highlight_clade, 
+                      tree_panel, Label, tile_size)
+    return
+  hotpic = draw_hotmap(fig_name, hyde_output_array, hotmap_renderer)
+  treepic = draw_tree(tree_panel, node_num, highlight_clade, Label)
+  combine_fig(fig_name, treepic, hotpic, picture_size)
+
+#绘图进程共享的数据，由init_worker在每个进程中设置一次。γ张量以内存映射的
+#方式读取，不需要随每个任务传递。draw_args为draw_figure的参数字典，包含
+#tree_panel、Label、picture_size和tile_size
+worker_data = {}
+
+def init_worker(gamma_tensor, Label, draw_args):
+  if isinstance(gamma_tensor, str):
+    gamma_tensor = np.load(gamma_tensor, mmap_mode="r")
+  worker_data["gamma_tensor"] = gamma_tensor
+  worker_data["Label"] = Label
+  worker_data["draw_args"] = draw_args
+  #分块输出时不需要热图的画布
+  worker_data["hotmap_renderer"] = (None if draw_args["tile_size"] else 
+                                    make_hotmap_renderer(len(Label)))
+
+#执行一个绘图任务。hyde_output_array为整数时表示γ张量中的第几个杂交种
+def run_figure_job(job):
+  fig_name, hyde_output_array, node_num, highlight_clade = job
+  if isinstance(hyde_output_array, int):
+    Label = worker_data["Label"]
+    hyde_output_array = pd.DataFrame(
+      unpack_gamma_table(worker_data["gamma_tensor"][hyde_output_array], 
+                         len(Label)), index=Label, columns=Label)
+  draw_figure(fig_name, hyde_output_array, node_num, highlight_clade, 
+              hotmap_renderer=worker_data["hotmap_renderer"], 
+              **worker_data["draw_args"])
+
+#增量绘图的记录文件，保存每张图的输入的哈希值
+figure_manifest_file = "visual_hyde_manifest.json"
+
+def read_figure_manifest():
+  try:
+    with open(figure_manifest_file, "r") as read_file:
+      return json.load(read_file)
+  except (OSError, ValueError):
+    return {}
+
+#先写入临时文件再替换，程序中途退出时不会留下不完整的记录文件
+def write_figure_manifest(figure_hash_dict):
+  with open(figure_manifest_file + ".tmp", "w") as write_file:
+    json.dump(figure_hash_dict, write_file, indent=1)
+  os.replace(figure_manifest_file + ".tmp", figure_manifest_file)
+
+#一张图的输入的哈希值：run_key中包含树、分枝的颜色以及图片大小等参数，
+#再加上这张图的γ表格和高亮的分枝
+def get_figure_hash(run_key, hyde_output_array, node_num, highlight_clade):
+  figure_hash = hashlib.sha1(run_key.encode())
+  figure_hash.update(json.dumps([node_num, highlight_clade]).encode())
+  figure_hash.update(np.ascontiguousarray(hyde_output_array, 
+                                          dtype=np.float64).tobytes())
+  return figure_hash.hexdigest()
+
+#用jobs个进程执行所有的绘图任务。并行时γ张量(如果需要)先写入一个临时的.npy
+#文件，各个进程只内存映射一次；同时等待执行的任务数不超过进程数的两倍，避免
+#节点模式中叠加好的表格在内存中堆积。
+#每张图画好后把其输入的哈希值记录到figure_manifest_file中(每秒最多写出一次)，
+#update为True时跳过输入的哈希值与记录相同且输出文件都存在的图。
+#另一张已经画好的图(例如z值扫描中另一个阈值下的同一张图)的输入与之相同时，
+#直接复制那张图的输出文件，不再重新绘制。图按输入的哈希值建立索引；不使用
+#--update时记录文件中以前画的图可能已经被改动过，只复制本次运行中画好的图
+def run_figure_jobs(figure_jobs, gamma_tensor, Label, draw_args, jobs, 
+                    run_key, update):
+  figure_hash_dict = read_figure_manifest()
+  hash_figure_dict = {}
+  if update:
+    for each_name, each_hash in figure_hash_dict.items():
+      hash_figure_dict.setdefault(each_hash, []).append(each_name)
+  last_write = [time.time()]
+  tile_size = draw_args["tile_size"]
 
-  os.remove("hotmap.png")
-  os.remove("img_faces.png")
+  def have_output(fig_name):
+    return all(os.path.exists(each_file) for each_file in 
+               get_figure_files(fig_name, tile_size))
 
+  def find_same_figure(fig_name, figure_hash):
+    for each_name in hash_figure_dict.get(figure_hash, []):
+      if (each_name != fig_name and 
+          figure_hash_dict.get(each_name) == figure_hash and 
+          have_output(each_name)):
+        return each_name
+    return None
+
+  def changed_jobs():
+    for each_job in figure_jobs:
+      fig_name, hyde_output_array, node_num, highlight_clade = each_job
+      if isinstance(hyde_output_array, int):
+        hyde_output_array = unpack_gamma_table(
+          gamma_tensor[hyde_output_array], len(Label))
+      figure_hash = get_figure_hash(run_key, hyde_output_array, node_num, 
+                                    highlight_clade)
+      if (update and figure_hash_dict.get(fig_name) == figure_hash and 
+          have_output(fig_name)):
+        print("Inputs of figure " + fig_name + " are unchanged, skip it")
+        continue
+      same_figure = find_same_figure(fig_name, figure_hash)
+      if same_figure:
+        print("Inputs of figure " + fig_name + " are the same as figure " + 
+              same_figure + ", copy it")
+        for each_file, each_copy in zip(
+            get_figure_files(same_figure, tile_size), 
+            get_figure_files(fig_name, tile_size)):
+          if os.path.isdir(each_file):
+            shutil.copytree(each_file, each_copy, dirs_exist_ok=True)
+          else:
+            shutil.copyfile(each_file, each_copy)
+        record_figure(fig_name, figure_hash)
+        continue
+      yield each_job, figure_hash
+
+  def record_figure(fig_name, figure_hash):
+    figure_hash_dict[fig_name] = figure_hash
+    hash_figure_dict.setdefault(figure_hash, []).append(fig_name)
+    if time.time() - last_write[0] >= 1:
+      write_figure_manifest(figure_hash_dict)
+      last_write[0] = time.time()
+
+  gamma_file = None
+  try:
+    if jobs <= 1:
+      init_worker(gamma_tensor, Label, draw_args)
+      for each_job, figure_hash in changed_jobs():
+        run_figure_job(each_job)
+        record_figure(each_job[0], figure_hash)
+      return
+    if gamma_tensor is not None:
+      gamma_file = "visual_hyde_gamma_" + str(os.getpid()) + ".npy"
+      np.save(gamma_file, gamma_tensor)
+    #某个进程异常退出(例如内存不足)时会抛出异常，而不是一直等待下去
+    with ProcessPoolExecutor(jobs, initializer=init_worker, 
+                             initargs=(gamma_file, Label, draw_args)) as p:
+      pending = deque()
+      for each_job, figure_hash in changed_jobs():
+        pending.append((p.submit(run_figure_job, each_job), each_job[0], 
+                        figure_hash))
+        if len(pending) >= 2 * jobs:
+          future, fig_name, figure_hash = pending.popleft()
+          future.result()
+          record_figure(fig_name, figure_hash)
+      while pending:
+        future, fig_name, figure_hash = pending.popleft()
+        future.result()
+        record_figure(fig_name, figure_hash)
+  finally:
+    #已经画好的图都记录下来，中途出错时下次运行也可以跳过它们
+    write_figure_manifest(figure_hash_dict)
+    if gamma_file:
+      os.remove(gamma_file)
+
+#以下为供其他python程序调用的接口，不经过命令行。除了save_gamma_tensor以及
+#compute_gamma_tensor指定cache=True时，不写出任何文件。
+#树可以是树文件的路径或newick字符串，hyde结果可以是hyde输出文件的路径或
+#含有P1、Hybrid、P2、Zscore和Gamma列的DataFrame
+
+#计算γ张量。返回的字典中gamma_tensor的第k行为hybrids[k]的热图表格的下三角，
+#taxa为热图坐标轴上按树排列的物种。cache为True时与命令行相同，在hyde输出
+#文件旁边写出并使用二进制缓存(<hyde输出>.vhcache)
+def compute_gamma_tensor(tree_file, hyde_output, zscore=3, hybrid_list=None, 
+                         cache=False):
+  Label = Tree(tree_file).get_leaf_names()
+  if isinstance(hyde_output, pd.DataFrame):
+    hyde_table = hyde_output
+  else:
+    hyde_table = load_hyde_output(hyde_output, zscore, cache)
+  if hybrid_list is None:
+    hybrid_list = Label
+  return {"taxa": Label, "hybrids": list(hybrid_list), 
+          "gamma_tensor": make_gamma_tensor(Label, hyde_table, zscore, 
+                                            hybrid_list)}
+
+#取出某个杂交种的完整的γ表格
+def get_gamma_table(gamma_result, hypothesis_hybrid_species):
+  Label = gamma_result["taxa"]
+  k = gamma_result["hybrids"].index(hypothesis_hybrid_species)
+  return pd.DataFrame(unpack_gamma_table(gamma_result["gamma_tensor"][k], 
+                                         len(Label)), index=Label, columns=Label)
+
+#按后序遍历依次返回每个内部节点和节点模式中叠加好的γ表格，γ张量中需要包含
+#所有物种
+def compute_node_tables(tree_file, gamma_result):
+  if gamma_result["hybrids"] != gamma_result["taxa"]:
+    raise ValueError("node tables need the gamma tables of all taxa")
+  return find_common_hybrid_in_nodes(Tree(tree_file), gamma_result["taxa"], 
+                                     gamma_result["gamma_tensor"])
+
+#准备绘图需要的树图和热图画布，之后可以用render_figure绘制任意多张图。
+#没有给出预先定义的大分枝文件时自动定义大分枝
+def make_figure_renderer(tree_file, Predefined_clade_file=None, 
+                         picture_size=4000):
+  if Predefined_clade_file:
+    t, Label, clade_file, name_len = parse_tree(tree_file, 
+                                                Predefined_clade_file)
+  else:
+    t = Tree(tree_file)
+    Label = t.get_leaf_names()
+    clade_file = find_predefined_clades(t)
+    name_len = get_name_len(Label)
+  return {"tree_panel": make_tree_panel(tree_file, clade_file, name_len, 
+                                        picture_size), 
+          "Label": Label, "picture_size": picture_size, 
+          "hotmap_renderer": make_hotmap_renderer(len(Label))}
+
+#绘制一张完整的图并返回PIL图像。叶子模式时highlight_clade为杂交种的名称，
+#节点模式时为节点之后的物种列表，node_num为节点编号
+def render_figure(figure_renderer, gamma_table, highlight_clade, node_num=0):
+  hotpic = render_hotmap(gamma_table, figure_renderer["hotmap_renderer"])
+  treepic = draw_tree(figure_renderer["tree_panel"], node_num, highlight_clade, 
+                      figure_renderer["Label"])
+  return make_combined_figure(treepic, hotpic, figure_renderer["picture_size"])
+
+#把γ张量保存为一个.npy文件，物种名称保存在旁边的.taxa.json中。
+#load_gamma_tensor以内存映射的方式读取，不需要复制数据
+def save_gamma_tensor(npy_file, gamma_result):
+  np.save(npy_file, gamma_result["gamma_tensor"])
+  with open(npy_file + ".taxa.json", "w") as write_file:
+    json.dump({"taxa": gamma_result["taxa"], 
+               "hybrids": gamma_result["hybrids"], 
+               "layout": "row k: lower triangle of the table of hybrids[k], "
+                         "taxa i >= j at i*(i+1)/2+j"}, write_file, indent=1)
+
+def load_gamma_tensor(npy_file):
+  with open(npy_file + ".taxa.json", "r") as read_file:
+    taxa_index = json.load(read_file)
+  return {"taxa": taxa_index["taxa"], "hybrids": taxa_index["hybrids"], 
+          "gamma_tensor": np.load(npy_file, mmap_mode="r")}
 
 #主程序
 def main():
@@ -427,9 +1126,47 @@ def main():
                           default=4000, metavar='\b', 
                           help="Size of the output figure, default = 4000")
   additional.add_argument('-z', '--zscore', action="store", type=float, 
-                          default=3, metavar='\b', 
+                          nargs="+", default=[3], metavar='\b', 
                           help='''threshold of Z-score of hyde output, 
-                          default = 3''')
+                          default = 3. If several thresholds are given, the 
+                          figures of each threshold are written to the 
+                          directory zscore_<threshold> and the number of 
+                          squares left in each heatmap is written to 
+                          zscore_sweep_summary.csv''')
+  additional.add_argument('-j', '--jobs', action="store", type=int, 
+                          default=1, metavar='\b', 
+                          help='''number of processes used to draw the 
+                          figures, default = 1''')
+  additional.add_argument('-u', '--update', action="store_true", 
+                          default=False, help='''Only redraw the figures 
+                          whose inputs (gamma values, tree, clades and figure 
+                          size) changed since the last run in this directory''')
+  additional.add_argument('-p', '--tiles', action="store", type=int, 
+                          default=0, metavar='\b', 
+                          help='''Write each heatmap as a multi-resolution 
+                          pyramid of tiles of this size (Deep Zoom format) 
+                          instead of one PNG, for very large trees. The tree is 
+                          written once as tree_panel.dzi and each figure has a 
+                          .json index with the position of its highlight on 
+                          the tree''')
+  additional.add_argument('-e', '--export', action="store", type=str, 
+                          metavar='\b', help='''Also save the gamma tables 
+                          of all hybrids as one .npy file (lower triangles, 
+                          float32) with the taxa in <file>.taxa.json, which can 
+                          be memory-mapped by load_gamma_tensor''')
+  additional.add_argument('-b', '--blocks', action="store", type=float, 
+                          default=0, metavar='\b', 
+                          help='''Detect blocks of squares formed by two 
+                          monophyletic clades in every heatmap and write the 
+                          clade pairs in which at least this fraction of 
+                          squares has a gamma value to hybrid_blocks.csv, 
+                          ranked by the number of squares with a gamma value 
+                          (fraction x size of the block)''')
+  additional.add_argument('--block_cells', action="store", type=int, 
+                          default=2, metavar='\b', 
+                          help='''(with -b) Minimum number of squares of a 
+                          block, default = 2, i.e. at least one of the two 
+                          clades has more than one leaf''')
 
 
   args                           = parser.parse_args()
@@ -439,7 +1176,13 @@ def main():
   Predefined_clade_file          = args.preclade
   hypothesis_hybrid_species      = args.leaves  
   picture_size                   = args.picturesize
-  zscore                         = args.zscore
+  zscore_list                    = sorted(set(args.zscore))
+  jobs                           = args.jobs
+  update                         = args.update
+  tile_size                      = args.tiles
+  block_coverage                 = args.blocks
+  block_cells                    = args.block_cells
+  export_file                    = args.export
    
   #检查树是否置根，且外群只有一个
   input_tree = Tree(tree_file)
@@ -459,35 +1202,24 @@ def main():
 
  
   #检查树中的物种名称是否和hyde软件输出结果中的物种名称一一对应
-  leaves_name_in_hyde_output = []
-  with open(csv_file_name, "r") as read_file:
-    for each_line in read_file.readlines()[1:]:
-      if each_line.split("\t")[0] not in leaves_name_in_hyde_output:
-        leaves_name_in_hyde_output.append(each_line.split("\t")[0])
-      if each_line.split("\t")[1] not in leaves_name_in_hyde_output:
-        leaves_name_in_hyde_output.append(each_line.split("\t")[1])
-      if each_line.split("\t")[2] not in leaves_name_in_hyde_output:
-        leaves_name_in_hyde_output.append(each_line.split("\t")[2])
-  leaves_name_in_hyde_output.sort()
-  leaves_name_in_species_tree = []
+  #hyde结果只按最低的z值阈值读取一次，之后所有阈值的热图都从同一个表格中生成
+  hyde_table = load_hyde_output(csv_file_name, zscore_list[0])
+  leaves_name_in_hyde_output = set(hyde_table["Hybrid"].cat.categories)
   if (len(input_tree.children[0].get_leaf_names()) > 
       len(input_tree.children[1].get_leaf_names())):
     ingroup_list = input_tree.children[0].get_leaf_names()
   else:
     ingroup_list = input_tree.children[1].get_leaf_names()
-  for each_line in ingroup_list:
-    if each_line not in leaves_name_in_species_tree:
-      leaves_name_in_species_tree.append(each_line)
-  leaves_name_in_species_tree.sort()
+  leaves_name_in_species_tree = set(ingroup_list)
   if leaves_name_in_hyde_output == leaves_name_in_species_tree:
     pass
   else:
-    for each_name in leaves_name_in_hyde_output:
-      if each_name not in leaves_name_in_species_tree:
-        print(each_name + " in hyde output but not in species tree")
-    for each_name in leaves_name_in_species_tree:
-      if each_name not in leaves_name_in_hyde_output:
-        print(each_name + " in species tree but not in hyde output")
+    for each_name in sorted(leaves_name_in_hyde_output - 
+                            leaves_name_in_species_tree):
+      print(each_name + " in hyde output but not in species tree")
+    for each_name in sorted(leaves_name_in_species_tree - 
+                            leaves_name_in_hyde_output):
+      print(each_name + " in species tree but not in hyde output")
     print('''The sample names of ingroups in input tree and sample names of hyde file are not uniform, script end''')
     sys.exit(0)
 
@@ -498,61 +1230,135 @@ def main():
   else:
     print('''No preclade file specified, script will defines up some clade automatically''')
     make_predefined_clade_file(tree_file)
-  Predefined_clade_file = "Predefined_clade.txt"
+    Predefined_clade_file = "Predefined_clade.txt"
 
 
   #开始绘制热图 
+  #获取输入树的一些信息
+  t, Label, clade_file, name_len = parse_tree(tree_file, Predefined_clade_file)
+  #热图旁边的树只绘制一次
+  tree_panel = make_tree_panel(tree_file, clade_file, name_len, picture_size)
+  draw_args = {"tree_panel": tree_panel, "Label": Label, 
+               "picture_size": picture_size, "tile_size": tile_size}
+  if tile_size:
+    write_image_pyramid(tree_tiles_name, tree_panel["image"], tile_size)
+  #树、分枝的颜色、图片大小和输出方式相同时，输入相同的图不需要重新绘制
+  with open(tree_file, "r") as read_file:
+    run_key = json.dumps([read_file.read(), clade_file, picture_size, 
+                          tile_size])
   if node_model:  #使用节点模式运行，计算各个节点的杂交情况
     print('''Run in node model, the heatmap shows the hybridization events that common to all the samples after the node''')
-    #获取输入树的一些信息
-    t, Label, clade_file, name_len = parse_tree(tree_file, 
-                                                Predefined_clade_file)
-    #将所有sample的heatmap表格存入到一个字典中，方便之后的步骤调用
-    hyde_output_array_dict = make_hyde_output_array_dict(Label, csv_file_name, 
-                                                         zscore)
-    #开始遍历系统发育树
-    node_num = 0
-    for each_node in t.traverse("postorder"):
-      if each_node.is_leaf():
-        pass
+    hybrid_list = Label
+  elif hypothesis_hybrid_species: #如果用户指定了-l参数，则只画该sample
+    print("Run in leaves model, the script will draw the heatmap for sample: " + hypothesis_hybrid_species)
+    hybrid_list = [hypothesis_hybrid_species]
+  else: #如果用户没有指定-l参数，则画所有sample
+    print('''Run in leaves model and no leaf name specified, the script will draw the heatmap for each sample''')
+    hybrid_list = Label
+
+  #给出多个z值阈值时，每个阈值的图写出到各自的文件夹中。γ张量只在最低的阈值
+  #下建立一次，其他阈值的γ表格由每个格子通过的阈值筛选得到
+  zscore_sweep = len(zscore_list) > 1
+  out_dir_list = []
+  for zscore in zscore_list:
+    if zscore_sweep:
+      out_dir_list.append("zscore_" + format(zscore, "g"))
+      os.makedirs(out_dir_list[-1], exist_ok=True)
+    else:
+      out_dir_list.append("")
+  if zscore_sweep:
+    gamma_sweep = make_gamma_sweep(Label, hyde_table, zscore_list, hybrid_list)
+    gamma_tensor = gamma_sweep["gamma_tensor"]
+  else:
+    gamma_tensor = make_gamma_tensor(Label, hyde_table, zscore_list[0], 
+                                     hybrid_list)
+  report_gamma_tensor_memory(gamma_tensor, len(Label))
+  sweep_summary = []
+  hybrid_blocks = [[] for zscore in zscore_list]
+  #每个分枝在Label中的区间，用于寻找与分枝对应的色块
+  clade_interval = sorted(set(make_clade_index(t, Label).values()))
+
+  #第m个阈值下的γ张量
+  def get_gamma_tensor(m):
+    if zscore_sweep:
+      return get_sweep_tensor(gamma_sweep, m)
+    return gamma_tensor
+
+  #记录第m个阈值下一张图中剩下的格子数以及找到的色块
+  def add_figure(m, fig_name, hyde_output_array):
+    if zscore_sweep:
+      sweep_summary.append((zscore_list[m], fig_name, 
+                            count_surviving_cells(hyde_output_array)))
+    if block_coverage:
+      hybrid_blocks[m].append(find_hybrid_blocks(
+        fig_name, hyde_output_array, clade_interval, Label, block_coverage, 
+        block_cells))
+
+  if export_file:
+    for m in range(len(zscore_list)):
+      save_gamma_tensor(os.path.join(out_dir_list[m], export_file), 
+                        {"taxa": Label, "hybrids": list(hybrid_list), 
+                         "gamma_tensor": get_gamma_tensor(m)})
+
+  if node_model:
+    #开始遍历系统发育树，将每个分支所有sample的热图叠加成一张，
+    #叠加好的热图和热图旁边儿的树组合成一张图。z值扫描时只遍历一次树，每个
+    #节点同时叠加出所有阈值下的表格
+    def node_jobs():
+      if zscore_sweep:
+        node_tables = find_common_hybrid_in_nodes_sweep(t, Label, gamma_sweep)
       else:
+        node_tables = ((each_node, [hyde_output_array]) for 
+                       each_node, hyde_output_array in 
+                       find_common_hybrid_in_nodes(t, Label, gamma_tensor))
+      node_num = 0
+      for each_node, table_list in node_tables:
         node_num = node_num + 1
         print("Drawing figure of node " + str(node_num) + " " + str(node_num) + "/" + str(len(t.get_leaf_names())-1))
-        #将某个分支所有sample的热图叠加成一张
-        hyde_output_array = find_common_hybrid_in_nodes(hyde_output_array_dict, 
-                                                        each_node, Label)
-        #绘制叠加好的热图
-        draw_hotmap(str(node_num), hyde_output_array)
-        #绘制热图旁边儿的树
-        draw_tree(tree_file, node_num, each_node.get_leaf_names(), clade_file, 
-                  name_len, picture_size)
-        #组合热图和树
-        combine_fig(str(node_num), picture_size)
-
-
-  else:   #使用非节点模式，为每个sample都画一张热图
-    #画图
-    def run(hypothesis_hybrid_species, Predefined_clade_file, fig_num):
-      t, Label, clade_file, name_len = parse_tree(tree_file, 
-                                                  Predefined_clade_file)
-      hyde_output_array = make_hotmap_table_gamma(Label, 
-                              hypothesis_hybrid_species, csv_file_name, zscore)
-      draw_hotmap(fig_num + hypothesis_hybrid_species, hyde_output_array)
-      draw_tree(tree_file, "", hypothesis_hybrid_species, clade_file, 
-                name_len, picture_size)
-      combine_fig((fig_num + hypothesis_hybrid_species), picture_size)
-    
-    if hypothesis_hybrid_species: #如果用户指定了-l参数，则只画该sample
-      print("Run in leaves model, the script will draw the heatmap for sample: " + hypothesis_hybrid_species)
-      run(hypothesis_hybrid_species, Predefined_clade_file, "")
-    else: #如果用户没有指定-l参数，则画所有sample
-      print('''Run in leaves model and no leaf name specified, the script will draw the heatmap for each sample''')
-      t = Tree(tree_file)
-      n = 0
-      for hypothesis_hybrid_species in t.get_leaf_names():
-        n = n + 1
-        print("Start drawing figure of sample: " + hypothesis_hybrid_species + " " + str(n) + "/" + str(len(t.get_leaf_names())))
-        run(hypothesis_hybrid_species, Predefined_clade_file, str(n))        
+        for m, hyde_output_array in enumerate(table_list):
+          add_figure(m, str(node_num), hyde_output_array)
+          yield (os.path.join(out_dir_list[m], str(node_num)), 
+                 hyde_output_array, node_num, each_node.get_leaf_names())
+    #节点模式的任务中已经包含叠加好的表格，绘图进程不需要γ张量
+    run_figure_jobs(node_jobs(), None, Label, draw_args, jobs, run_key, 
+                    update)
+  else:
+    for m, zscore in enumerate(zscore_list):
+      if zscore_sweep:
+        print("Drawing figures of Z-score threshold " + format(zscore, "g"))
+      out_dir = out_dir_list[m]
+      gamma_tensor_m = get_gamma_tensor(m)
+      if hypothesis_hybrid_species:
+        add_figure(m, hypothesis_hybrid_species, 
+                   unpack_gamma_table(gamma_tensor_m[0], len(Label)))
+        leaf_jobs = [(os.path.join(out_dir, hypothesis_hybrid_species), 0, "", 
+                      hypothesis_hybrid_species)]
+        run_figure_jobs(leaf_jobs, gamma_tensor_m, Label, draw_args, 1, 
+                        run_key, update)
+      else:
+        def leaf_jobs():
+          n = 0
+          for hypothesis_hybrid_species in Label:
+            n = n + 1
+            print("Start drawing figure of sample: " + hypothesis_hybrid_species + " " + str(n) + "/" + str(len(Label)))
+            add_figure(m, hypothesis_hybrid_species, 
+                       unpack_gamma_table(gamma_tensor_m[n - 1], len(Label)))
+            yield (os.path.join(out_dir, str(n) + hypothesis_hybrid_species), 
+                   n - 1, "", hypothesis_hybrid_species)
+        run_figure_jobs(leaf_jobs(), gamma_tensor_m, Label, draw_args, jobs, 
+                        run_key, update)
+  if block_coverage:
+    for m in range(len(zscore_list)):
+      write_hybrid_blocks(os.path.join(out_dir_list[m], "hybrid_blocks.csv"), 
+                          hybrid_blocks[m])
+
+  #每个阈值下每张热图中剩下的格子数
+  if zscore_sweep:
+    sweep_summary = pd.DataFrame(sweep_summary, 
+                                 columns=["Zscore", "Figure", "Cells"])
+    sweep_summary.sort_values("Zscore", kind="stable").to_csv(
+      "zscore_sweep_summary.csv", index=False)
+  report_peak_memory()
 
 if __name__ == "__main__":
   main()  
\ No newline at end of file